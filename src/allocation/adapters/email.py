@@ -1,2 +1,6 @@
 def send(*args):
     print("SENDING EMAIL:", *args)
+
+
+async def send_async(*args):
+    print("SENDING EMAIL:", *args)
@@ -1,3 +1,5 @@
+from collections import deque
+
 from sqlalchemy import (
     Column,
     Date,
@@ -6,6 +8,7 @@ from sqlalchemy import (
     MetaData,
     String,
     Table,
+    Text,
     event,
 )
 from sqlalchemy.orm import registry, relationship
@@ -52,13 +55,33 @@ allocations = Table(
 allocations_view = Table(
     "allocations_view",
     metadata,
-    Column("orderid", String(255)),
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("orderid", String(255), index=True),
     Column("sku", String(255)),
     Column("batchref", String(255)),
 )
 
+stock_view = Table(
+    "stock_view",
+    metadata,
+    Column("sku", String(255), primary_key=True),
+    Column("purchased", Integer, nullable=False),
+    Column("allocated", Integer, nullable=False),
+)
+
+# integration events written in the same commit as the change that raised
+# them, drained and published by entrypoints/outbox_relay.py
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("sku", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+)
+
 
-def start_mappers():
+def start_mappers(batches_loading: str = "selectin", allocations_loading: str = "selectin"):
     lines_mapper = mapper_registry.map_imperatively(model.OrderLine, order_lines)
     batches_mapper = mapper_registry.map_imperatively(
         model.Batch,
@@ -68,16 +91,52 @@ def start_mappers():
                 lines_mapper,
                 secondary=allocations,
                 collection_class=set,
+                lazy=allocations_loading,
             )
         },
     )
     mapper_registry.map_imperatively(
         model.Product,
         products,
-        properties={"batches": relationship(batches_mapper)},
+        properties={
+            "batches": relationship(
+                batches_mapper, lazy=batches_loading, order_by=batches.c.id
+            )
+        },
+        # UPDATE ... WHERE version_number = <version we loaded>, the model
+        # bumps the number itself on every change to the aggregate
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
     )
 
 
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
-    product.events = []
+    product.events = deque()
+    product._batch_index = None
+
+
+@event.listens_for(model.Product, "expire")
+@event.listens_for(model.Product, "refresh")
+def receive_expire(product, *args):
+    # the index was built from the batches' allocations as they were, the
+    # object is None if it was garbage collected
+    if product is not None:
+        product._batch_index = None
+
+
+@event.listens_for(model.Batch, "load")
+def receive_batch_load(batch, _):
+    batch._allocated_quantity = None
+
+
+@event.listens_for(model.Batch, "expire")
+def receive_batch_expire(batch, attrs):
+    if batch is not None and (attrs is None or "_allocations" in attrs):
+        batch._allocated_quantity = None
+
+
+@event.listens_for(model.Batch, "refresh")
+def receive_batch_refresh(batch, _, attrs):
+    if attrs is None or "_allocations" in attrs:
+        batch._allocated_quantity = None
\ No newline at end of file
@@ -1,20 +1,75 @@
 import abc
+import threading
+from collections import OrderedDict, deque
+
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.orm import defaultload, joinedload, lazyload, selectinload, subqueryload
+from sqlalchemy.orm.exc import StaleDataError
 
 from allocation.adapters import orm
-from allocation.domain import model
+from allocation.domain import events, model
+
+
+class ProductCache:
+    # Products are checked out of the cache while a unit of work uses them
+    # and put back once it commits and their events are collected, so an
+    # entry is never shared between two sessions and neither uncommitted
+    # changes nor pending events reach the cache.
+    def __init__(self, max_products: int = 1024, max_objects: int = 1_000_000):
+        self.max_products = max_products
+        self.max_objects = max_objects
+        self.objects = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, tuple[model.Product, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def checkout(self, sku, version_number) -> model.Product | None:
+        with self._lock:
+            product, size = self._entries.pop(sku, (None, 0))
+            self.objects -= size
+            if product is None or product.version_number != version_number:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return product
+
+    def put(self, product: model.Product):
+        # batches, order lines and the product itself
+        size = 1 + sum(1 + len(b._allocations) for b in product.batches)
+        with self._lock:
+            _, old_size = self._entries.pop(product.sku, (None, 0))
+            self._entries[product.sku] = (product, size)
+            self.objects += size - old_size
+            while len(self._entries) > self.max_products or self.objects > self.max_objects:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.objects -= evicted_size
+                self.evictions += 1
 
 
 class AbstractProductRepository(abc.ABC):
 
-    def __init__(self):
+    def __init__(self, cache: ProductCache | None = None):
         self.seen: set[model.Product] = set()
+        self.cache = cache
+        self._written_back_later: set[model.Product] = set()
+        # raised by changes made without loading the aggregate
+        self.events: deque[events.Event] = deque()
+        # products whose version_number such a change compares and swaps
+        self.swapped_skus: set[str] = set()
 
     def add(self, product: model.Product):
         self._add(product)
         self.seen.add(product)
 
     def get(self, sku) -> model.Product:
-        product = self._get(sku)
+        product = self._get_cached(sku) if self.cache is not None else None
+        if product is None:
+            product = self._get(sku)
         if product:
             self.seen.add(product)
         return product
@@ -25,6 +80,51 @@ class AbstractProductRepository(abc.ABC):
             self.seen.add(product)
         return product
 
+    def add_batches(self, batches: list[model.Batch]):
+        for batch in batches:
+            product = self.get(batch.sku)
+            if product is None:
+                product = model.Product(batch.sku, batches=[])
+                self.add(product)
+            product.add_batch(batch)
+
+    def write_back(self):
+        # a product goes back once its events are collected, until then
+        # another unit of work could check it out and handle them again
+        if self.cache is not None:
+            for product in self.seen:
+                if product.events:
+                    self._written_back_later.add(product)
+                else:
+                    self._put_back(product)
+
+    def events_collected(self, product: model.Product):
+        if product in self._written_back_later:
+            self._written_back_later.remove(product)
+            self._put_back(product)
+
+    def _put_back(self, product: model.Product):
+        # out of this session first, the next one to check it out takes it
+        self._detach(product)
+        self.cache.put(product)
+
+    def _get_cached(self, sku) -> model.Product | None:
+        product = next((p for p in self.seen if p.sku == sku), None)
+        if product is None:
+            product = self.cache.checkout(sku, self._get_version_number(sku))
+            if product is not None:
+                self._attach(product)
+        return product
+
+    def _get_version_number(self, sku) -> int | None:
+        raise NotImplementedError
+
+    def _attach(self, product: model.Product):
+        raise NotImplementedError
+
+    def _detach(self, product: model.Product):
+        raise NotImplementedError
+
     @abc.abstractmethod
     def _add(self, product: model.Product):
         raise NotImplementedError
@@ -38,26 +138,163 @@ class AbstractProductRepository(abc.ABC):
         raise NotImplementedError
 
 
+LOADERS = {
+    "select": lazyload,
+    "selectin": selectinload,
+    "joined": joinedload,
+    "subquery": subqueryload,
+}
+
+
+def loader(name: str | None):
+    # None keeps the strategy configured in orm.start_mappers
+    if name is None:
+        return defaultload
+    if name not in LOADERS:
+        raise ValueError(f"Unknown loading strategy {name!r}, expected one of {', '.join(LOADERS)}")
+    return LOADERS[name]
+
+
 class SqlAlchemyRepository(AbstractProductRepository):
 
-    def __init__(self, session) -> None:
-        super().__init__()
+    def __init__(
+        self,
+        session,
+        batches_loading: str | None = None,
+        allocations_loading: str | None = None,
+        cache: ProductCache | None = None,
+    ) -> None:
+        super().__init__(cache)
         self.session = session
+        self.batches_loading = batches_loading
+        self.allocations_loading = allocations_loading
+        self._batches_loader = loader(batches_loading)
+        self._allocations_loader = loader(allocations_loading)
 
     def _add(self, product: model.Product) -> None:
         self.session.add(product)
 
     def _get(self, sku) -> model.Product:
         return (
-            self.session.query(model.Product)
+            self._query()
             .filter_by(sku=sku)
             .first()
         )
 
     def _get_by_batchref(self, batchref):
         return (
-            self.session.query(model.Product)
+            self._query()
             .join(model.Batch)
             .filter(orm.batches.c.reference == batchref)
             .first()
         )
+
+    def _query(self):
+        batches = self._batches_loader(model.Product.batches)
+        allocations = self._allocations_loader(model.Batch._allocations)
+        return self.session.query(model.Product).options(batches.options(allocations))
+
+    def _get_version_number(self, sku) -> int | None:
+        return self.session.execute(
+            select(orm.products.c.version_number).where(orm.products.c.sku == sku)
+        ).scalar_one_or_none()
+
+    def _attach(self, product: model.Product):
+        self.session.add(product)
+
+    def _detach(self, product: model.Product):
+        # expunge doesn't cascade along these relationships, and the
+        # session may already be closed
+        for batch in product.batches:
+            for obj in (*batch._allocations, batch):
+                if obj in self.session:
+                    self.session.expunge(obj)
+        if product in self.session:
+            self.session.expunge(product)
+
+    def find_batch_for(
+        self, line: model.OrderLine
+    ) -> tuple[int, int | None, str | None, str | None] | None:
+        # (version_number, batch id, batch reference) of the batch that
+        # Product.allocate would pick, batch id is None when out of stock,
+        # and the reference of the batch the line is already allocated to;
+        # there is no row at all for an unknown sku
+        b, lines, allocations = orm.batches, orm.order_lines, orm.allocations
+        candidate = b.alias("candidate")
+        allocated = (
+            select(func.coalesce(func.sum(lines.c.qty), 0))
+            .select_from(allocations.join(lines, allocations.c.orderline_id == lines.c.id))
+            .where(allocations.c.batch_id == candidate.c.id)
+            .correlate(candidate)
+            .scalar_subquery()
+        )
+        best_batch = (
+            select(candidate.c.id)
+            .where(candidate.c.sku == orm.products.c.sku)
+            .where(candidate.c._purchased_quantity - allocated >= line.qty)
+            .order_by(candidate.c.eta.is_not(None), candidate.c.eta, candidate.c.id)
+            .limit(1)
+            .correlate(orm.products)
+            .scalar_subquery()
+        )
+        holder = b.alias("holder")
+        allocated_to = (
+            select(holder.c.reference)
+            .select_from(
+                allocations.join(lines, allocations.c.orderline_id == lines.c.id)
+                .join(holder, allocations.c.batch_id == holder.c.id)
+            )
+            .where(lines.c.orderid == line.orderid)
+            .where(lines.c.sku == line.sku)
+            .where(lines.c.qty == line.qty)
+            .limit(1)
+            .scalar_subquery()
+        )
+        row = self.session.execute(
+            select(orm.products.c.version_number, b.c.id, b.c.reference, allocated_to)
+            .select_from(orm.products.outerjoin(b, b.c.id == best_batch))
+            .where(orm.products.c.sku == line.sku)
+        ).first()
+        return tuple(row) if row else None
+
+    def add_batches(self, batches: list[model.Batch]):
+        # bulk inserts instead of loading each product, the version bump
+        # makes concurrent allocations retry and see the new batches
+        p = orm.products
+        skus = {b.sku for b in batches}
+        existing = set(self.session.execute(select(p.c.sku).where(p.c.sku.in_(skus))).scalars())
+        if skus - existing:
+            self.session.execute(
+                insert(p), [dict(sku=sku, version_number=1) for sku in sorted(skus - existing)]
+            )
+        if existing:
+            self.session.execute(
+                update(p).where(p.c.sku.in_(existing)).values(version_number=p.c.version_number + 1)
+            )
+        self.session.execute(
+            insert(orm.batches),
+            [
+                dict(reference=b.reference, sku=b.sku, _purchased_quantity=b._purchased_quantity, eta=b.eta)
+                for b in batches
+            ],
+        )
+        self.events.extend(
+            events.BatchCreated(b.reference, b.sku, b._purchased_quantity, b.eta) for b in batches
+        )
+
+    def add_allocation(self, line: model.OrderLine, batch_id: int, version_number: int):
+        self.swapped_skus.add(line.sku)
+        bumped = self.session.execute(
+            update(orm.products)
+            .where(orm.products.c.sku == line.sku)
+            .where(orm.products.c.version_number == version_number)
+            .values(version_number=version_number + 1)
+        )
+        if bumped.rowcount != 1:
+            raise StaleDataError(f"products row for {line.sku} changed since it was read")
+        orderline_id = self.session.execute(
+            insert(orm.order_lines).values(orderid=line.orderid, sku=line.sku, qty=line.qty)
+        ).inserted_primary_key[0]
+        self.session.execute(
+            insert(orm.allocations).values(orderline_id=orderline_id, batch_id=batch_id)
+        )
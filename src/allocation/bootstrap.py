@@ -1,46 +1,158 @@
+import functools
 import inspect
 from typing import Callable
 
+from allocation import views
 from allocation.adapters import email, orm
+from allocation.domain import commands
 from allocation.entrypoints import redis_eventpublisher
-from allocation.service_layer import handlers, messagebus, unit_of_work
+from allocation.service_layer import (
+    handlers,
+    messagebus,
+    metrics,
+    sharding,
+    tracing,
+    unit_of_work,
+)
 
 
-def inject_dependencies(handler, dependencies):
+def inject_dependencies(handler, dependencies, metrics=None):
     params = inspect.signature(handler).parameters
     deps = {
         name: dependency
         for name, dependency in dependencies.items()
         if name in params
     }
-    return lambda message: handler(message, **deps)
+
+    @functools.wraps(handler)
+    def injected(message):
+        return handler(message, **deps)
+
+    if metrics is not None:
+        return metrics.instrument(handler.__name__, injected)
+    return injected
 
 
 def bootstrap(
     start_orm: bool = True,
-    uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
+    uow: unit_of_work.AbstractUnitOfWork | None = None,
     send_mail: Callable = email.send,
     publish: Callable = redis_eventpublisher.publish,
+    retry_attempts: int = 3,
+    retry_backoff: float = 0.05,
+    sql_allocation: bool = False,
+    read_model_in_transaction: bool = False,
+    outbox: bool = False,
+    bus_class: type[messagebus.MessageBus] = messagebus.MessageBus,
+    metrics: metrics.Metrics | None = None,
+    tracer: tracing.Tracer | None = None,
+    allocations_cache: views.AllocationsCache | None = None,
 ) -> messagebus.MessageBus:
 
     if start_orm:
         orm.start_mappers()
 
-    dependencies = {"uow": uow, "send_mail": send_mail, "publish": publish}
+    if uow is None:
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+
+    if metrics is not None:
+        metrics.watch_sql()
+        uow.metrics = metrics
+    if tracer is not None:
+        tracer.watch_sql()
+
+    # projections replace their handlers inside the command's own
+    # transaction, and there's nothing to invalidate without a cache
+    skipped = set()
+    if read_model_in_transaction:
+        uow.projections = (
+            *uow.projections,
+            handlers.project_allocations,
+            handlers.project_stock,
+        )
+        skipped.update(handlers.READ_MODEL_HANDLERS)
+    if outbox:
+        uow.projections = (*uow.projections, handlers.add_to_outbox)
+        skipped.update(handlers.PUBLISH_HANDLERS)
+    if allocations_cache is None:
+        skipped.add(handlers.invalidate_cached_allocations)
+    handlers_by_event = {
+        event_type: [h for h in hs if h not in skipped]
+        for event_type, hs in handlers.EVENT_HANDLERS.items()
+    }
+
+    dependencies = {
+        "uow": uow,
+        "send_mail": send_mail,
+        "publish": publish,
+        "allocations_cache": allocations_cache,
+    }
     injected_event_handlers = {
         event_type: [
-            inject_dependencies(handler, dependencies)
+            inject_dependencies(handler, dependencies, metrics)
             for handler in event_handlers
         ]
-        for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
+        for event_type, event_handlers in handlers_by_event.items()
     }
+    command_handlers = dict(handlers.COMMAND_HANDLERS)
+    if sql_allocation:
+        command_handlers[commands.Allocate] = handlers.allocate_with_sql
     injected_command_handlers = {
-        command_type: inject_dependencies(handler, dependencies)
-        for command_type, handler in handlers.COMMAND_HANDLERS.items()
+        command_type: inject_dependencies(handler, dependencies, metrics)
+        for command_type, handler in command_handlers.items()
     }
 
-    return messagebus.MessageBus(
+    # a buffered publisher sends what each dispatch raised once it's done
+    after_handle = None
+    if isinstance(publish, redis_eventpublisher.BufferedPublisher):
+        if issubclass(bus_class, messagebus.AsyncMessageBus):
+            raise ValueError("the async bus publishes with publish_async, unbuffered")
+        after_handle = publish.flush
+
+    return bus_class(
         uow=uow,
         event_handlers=injected_event_handlers,
         command_handlers=injected_command_handlers,
+        retry_attempts=retry_attempts,
+        retry_backoff=retry_backoff,
+        metrics=metrics,
+        tracer=tracer,
+        after_handle=after_handle,
+    )
+
+
+def bootstrap_async(
+    send_mail: Callable = email.send_async,
+    publish: Callable = redis_eventpublisher.publish_async,
+    **kwargs,
+) -> messagebus.AsyncMessageBus:
+    return bootstrap(
+        send_mail=send_mail,
+        publish=publish,
+        bus_class=messagebus.AsyncMessageBus,
+        **kwargs,
+    )
+
+
+def bootstrap_sharded(
+    workers: int = 4,
+    start_orm: bool = True,
+    uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork] = unit_of_work.SqlAlchemyUnitOfWork,
+    sku_for_batch: Callable[[str], str | None] | None = None,
+    **kwargs,
+) -> sharding.ShardedExecutor:
+    if start_orm:
+        orm.start_mappers()
+
+    if sku_for_batch is None:
+        # thread-safe, the lookups come from whichever thread submits
+        lookup_uow = uow_factory()
+        sku_for_batch = lambda batchref: views.sku_for_batch(batchref, lookup_uow)
+
+    return sharding.ShardedExecutor(
+        buses=[
+            bootstrap(start_orm=False, uow=uow_factory(), **kwargs)
+            for _ in range(workers)
+        ],
+        sku_for_batch=sku_for_batch,
     )
@@ -9,6 +9,53 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_db_pool_settings():
+    return dict(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        pool_pre_ping=os.environ.get("DB_POOL_PRE_PING", "1") == "1",
+    )
+
+
+def get_bus_workers():
+    return int(os.environ.get("BUS_WORKERS", 4))
+
+
+def get_read_model_in_transaction():
+    return os.environ.get("READ_MODEL_IN_TRANSACTION", "1") == "1"
+
+
+def get_allocations_cache_settings():
+    return dict(
+        max_entries=int(os.environ.get("ALLOCATIONS_CACHE_SIZE", 10_000)),
+        ttl=float(os.environ.get("ALLOCATIONS_CACHE_TTL", 30)),
+    )
+
+
+def get_publish_buffer_settings():
+    return dict(
+        max_batch=int(os.environ.get("PUBLISH_MAX_BATCH", 500)),
+        flush_interval=float(os.environ.get("PUBLISH_FLUSH_INTERVAL_MS", 100)) / 1000,
+    )
+
+
+def get_coalescing_settings():
+    return dict(
+        window=float(os.environ.get("COALESCE_WINDOW_MS", 50)) / 1000,
+        max_pending=int(os.environ.get("COALESCE_MAX_PENDING", 1000)),
+    )
+
+
+def get_stream_settings():
+    return dict(
+        count=int(os.environ.get("STREAM_READ_COUNT", 100)),
+        block_ms=int(os.environ.get("STREAM_BLOCK_MS", 1000)),
+        claim_idle_ms=int(os.environ.get("STREAM_CLAIM_IDLE_MS", 30_000)),
+        max_deliveries=int(os.environ.get("STREAM_MAX_DELIVERIES", 5)),
+    )
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else 80
@@ -13,6 +13,12 @@ class Allocate(Command):
     qty: int
 
 
+@dataclass
+class AllocateOrder(Command):
+    orderid: str
+    lines: list[tuple[str, int]]
+
+
 @dataclass
 class CreateBatch(Command):
     ref: str
@@ -21,6 +27,11 @@ class CreateBatch(Command):
     eta: date | None = None
 
 
+@dataclass
+class CreateBatches(Command):
+    batches: list[CreateBatch]
+
+
 @dataclass
 class ChangeBatchQuantity(Command):
     ref: str
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from datetime import date
 
 
 class Event:
@@ -23,3 +24,20 @@ class Deallocated(Event):
     orderid: str
     sku: str
     qty: int
+    batchref: str
+
+
+@dataclass
+class BatchCreated(Event):
+    ref: str
+    sku: str
+    qty: int
+    eta: date | None = None
+
+
+@dataclass
+class BatchQuantityChanged(Event):
+    ref: str
+    sku: str
+    qty: int
+    previous_qty: int
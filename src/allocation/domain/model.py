@@ -1,4 +1,6 @@
 from __future__ import annotations
+import bisect
+from collections import deque
 from dataclasses import dataclass
 from datetime import date
 
@@ -23,6 +25,7 @@ class Batch:
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations: set[OrderLine] = set()
+        self._allocated_quantity: int | None = 0
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -43,19 +46,28 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
+            self._allocated_quantity = self.allocated_quantity + line.qty
             self._allocations.add(line)
 
     def deallocate(self, line: OrderLine):
         if line in self._allocations:
+            self._allocated_quantity = self.allocated_quantity - line.qty
             self._allocations.remove(line)
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated_quantity = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated_quantity - line.qty
+        return line
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # running total, reset to None by the ORM when _allocations is loaded,
+        # expired or refreshed
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -65,36 +77,110 @@ class Batch:
         return self.sku == line.sku and self.available_quantity >= line.qty
 
 
+class BatchIndex:
+    # batches with stock left, warehouse stock (eta=None) first then by eta,
+    # ties kept in the order the batches were added, and the batch each
+    # allocated line is in
+    def __init__(self, batches: list[Batch]):
+        self.size = 0
+        self.allocated: dict[OrderLine, Batch] = {}
+        self._positions: dict[Batch, tuple] = {}
+        self._keys: list[tuple] = []
+        self._batches: list[Batch] = []
+        for batch in batches:
+            self.add(batch)
+
+    def __iter__(self):
+        return iter(self._batches)
+
+    def add(self, batch: Batch):
+        self._positions[batch] = (batch.eta is not None, batch.eta or date.min, self.size)
+        self.size += 1
+        self.allocated.update(dict.fromkeys(batch._allocations, batch))
+        self.update(batch)
+
+    def update(self, batch: Batch):
+        key = self._positions[batch]
+        i = bisect.bisect_left(self._keys, key)
+        indexed = i < len(self._keys) and self._keys[i] == key
+        if batch.available_quantity > 0 and not indexed:
+            self._keys.insert(i, key)
+            self._batches.insert(i, batch)
+        elif batch.available_quantity <= 0 and indexed:
+            del self._keys[i]
+            del self._batches[i]
+
+
 class Product:
     def __init__(self, sku: str, batches: list[Batch], version_number: int = 0):
         self.sku = sku
         self.version_number = version_number
         self.batches = batches
-        self.events: list[events.Event] = []
+        self.events: deque[events.Event | commands.Command] = deque()
+        self._batch_index: BatchIndex | None = None
+
+    def add_batch(self, batch: Batch):
+        index = self._allocation_index()
+        self.batches.append(batch)
+        index.add(batch)
+        self.version_number += 1
+        self.events.append(
+            events.BatchCreated(batch.reference, batch.sku, batch._purchased_quantity, batch.eta)
+        )
 
     def allocate(self, line: OrderLine):
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
+        [batchref] = self.allocate_many([line])
+        return batchref
+
+    def allocate_many(self, lines: list[OrderLine]) -> list[str | None]:
+        index = self._allocation_index()
+        allocated = [self._allocate_line(index, line) for line in lines]
+        if any(added for _, added in allocated):
             self.version_number += 1
-            self.events.append(
-                events.Allocated(
-                    orderid=line.orderid,
-                    sku=line.sku,
-                    qty=line.qty,
-                    batchref=batch.reference,
-                )
-            )
-            return batch.reference
-        except StopIteration:
+        return [batchref for batchref, _ in allocated]
+
+    def _allocate_line(self, index: BatchIndex, line: OrderLine) -> tuple[str | None, bool]:
+        # a line that's already allocated is reported where it is, not added again
+        if line in index.allocated:
+            return index.allocated[line].reference, False
+        batch = next((b for b in index if b.can_allocate(line)), None)
+        if batch is None:
             self.events.append(events.OutOfStock(line.sku))
-            return None
+            return None, False
+        batch.allocate(line)
+        index.update(batch)
+        index.allocated[line] = batch
+        self.events.append(
+            events.Allocated(
+                orderid=line.orderid,
+                sku=line.sku,
+                qty=line.qty,
+                batchref=batch.reference,
+            )
+        )
+        return batch.reference, True
 
     def change_batch_quantity(self, ref: str, qty: int):
         batch = next(b for b in self.batches if b.reference == ref)
+        self.events.append(
+            events.BatchQuantityChanged(ref, self.sku, qty, batch._purchased_quantity)
+        )
         batch._purchased_quantity = qty
+        self.version_number += 1
+        index = self._allocation_index()
         while batch.available_quantity < 0:
             line = batch.deallocate_one()
+            index.allocated.pop(line, None)
+            self.events.append(
+                events.Deallocated(line.orderid, line.sku, line.qty, batch.reference)
+            )
             self.events.append(
                 commands.Allocate(line.orderid, line.sku, line.qty)
             )
+        index.update(batch)
+
+    def _allocation_index(self) -> BatchIndex:
+        # rebuilt if batches were appended to self.batches directly
+        if self._batch_index is None or self._batch_index.size != len(self.batches):
+            self._batch_index = BatchIndex(self.batches)
+        return self._batch_index
@@ -0,0 +1,135 @@
+import codecs
+import json
+import logging
+from datetime import date
+from itertools import islice
+from typing import IO, Iterable, Iterator
+
+from allocation.domain import commands
+
+logger = logging.getLogger(__name__)
+
+
+def iter_ndjson(stream: IO[bytes]) -> Iterator:
+    # a line that isn't JSON becomes that row's error, not the request's
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield ValueError(f"invalid JSON: {e}")
+
+
+NUMBER_CHARS = frozenset("0123456789+-.eE")
+
+
+def iter_json_array(stream: IO[bytes], read_size: int = 1 << 16) -> Iterator:
+    # yields the array's elements while the rest of the body is still being read
+    decode = codecs.getincrementaldecoder("utf-8")().decode
+    decoder = json.JSONDecoder()
+    buffer, position, eof = "", 0, False
+
+    def fill():
+        nonlocal buffer, position, eof
+        data = stream.read(read_size)
+        eof = not data
+        buffer = buffer[position:] + decode(data, final=eof)
+        position = 0
+
+    def next_char():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if eof:
+                return ""
+            fill()
+
+    if next_char() != "[":
+        raise ValueError("expected a JSON array")
+    position += 1
+    if next_char() == "]":
+        return
+    while True:
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            # a number could carry on in the next read, 1786.45 is decoded
+            # as 1786 while the read stops at "1786."
+            if not eof and type(value) in (int, float) and (
+                end == len(buffer) or buffer[end] in NUMBER_CHARS
+            ):
+                fill()
+                continue
+            break
+        position = end
+        yield value
+        separator = next_char()
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError(f"expected ',' or ']' at {separator!r}")
+        position += 1
+
+
+def batch_from_row(row) -> commands.CreateBatch:
+    if isinstance(row, Exception):
+        raise row
+    if not isinstance(row, dict):
+        raise ValueError("expected an object")
+    ref, sku, qty, eta = row.get("ref"), row.get("sku"), row.get("qty"), row.get("eta")
+    if not isinstance(ref, str) or not ref:
+        raise ValueError("ref must be a non-empty string")
+    if not isinstance(sku, str) or not sku:
+        raise ValueError("sku must be a non-empty string")
+    if not isinstance(qty, int) or isinstance(qty, bool) or qty < 0:
+        raise ValueError("qty must be a non-negative integer")
+    if eta is not None:
+        if not isinstance(eta, str):
+            raise ValueError("eta must be an ISO date or null")
+        eta = date.fromisoformat(eta)
+    return commands.CreateBatch(ref, sku, qty, eta)
+
+
+def ingest_batches(rows: Iterable, bus, chunk_size: int = 1000) -> Iterator[dict]:
+    # one CreateBatches command, so one transaction, per chunk of rows, and
+    # a result per row in the order they came in
+    rows = enumerate(rows)
+    unreadable = None
+    while unreadable is None:
+        chunk = []
+        try:
+            chunk.extend(islice(rows, chunk_size))
+        except ValueError as e:
+            unreadable = e
+        if not chunk:
+            break
+        results: list[dict] = []
+        valid: list[commands.CreateBatch] = []
+        for number, row in chunk:
+            try:
+                batch = batch_from_row(row)
+            except ValueError as e:
+                results.append({"row": number, "status": "error", "error": str(e)})
+            else:
+                valid.append(batch)
+                results.append({"row": number, "ref": batch.ref, "status": "created"})
+        if valid:
+            try:
+                bus.handle(commands.CreateBatches(valid))
+            except Exception as e:
+                logger.exception("Exception ingesting %d batches", len(valid))
+                for result in results:
+                    if result["status"] == "created":
+                        result.update(status="error", error=f"not saved: {e}")
+        yield from results
+    if unreadable is not None:
+        yield {"status": "error", "error": f"unreadable body: {unreadable}"}
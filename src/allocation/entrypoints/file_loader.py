@@ -0,0 +1,259 @@
+import argparse
+import csv
+import logging
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+from allocation import bootstrap, config
+from allocation.domain import commands
+from allocation.entrypoints import bulk, redis_eventpublisher
+from allocation.service_layer import messagebus, sharding
+
+logger = logging.getLogger(__name__)
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        description="Load purchase batches or replay order lines from a CSV file"
+    )
+    parser.add_argument("kind", choices=["batches", "orders"])
+    parser.add_argument("path", help="CSV file with a header row, - for stdin")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument(
+        "--workers", type=int, default=0, help="dispatch in parallel, partitioned by SKU"
+    )
+    parser.add_argument(
+        "--notify", action="store_true", help="publish events and send mail as usual"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    kwargs = dict(read_model_in_transaction=config.get_read_model_in_transaction())
+    if args.notify:
+        kwargs.update(
+            publish=redis_eventpublisher.BufferedPublisher(**config.get_publish_buffer_settings())
+        )
+    else:
+        kwargs.update(publish=lambda *args: None, send_mail=lambda *args: None)
+    if args.workers:
+        bus = bootstrap.bootstrap_sharded(workers=args.workers, **kwargs)
+    else:
+        bus = bootstrap.bootstrap(**kwargs)
+    load = load_batches if args.kind == "batches" else load_orders
+    try:
+        if args.path == "-":
+            progress = load(csv.DictReader(sys.stdin), bus, chunk_size=args.chunk_size)
+        else:
+            with open(args.path, newline="") as f:
+                progress = load(csv.DictReader(f), bus, chunk_size=args.chunk_size)
+    finally:
+        if args.workers:
+            bus.shutdown()
+    return 1 if progress.failed else 0
+
+
+class Progress:
+    def __init__(
+        self,
+        kind: str,
+        report_every: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.kind = kind
+        self.report_every = report_every
+        self.clock = clock
+        self.started = self._reported = clock()
+        self.read = self.loaded = self.failed = self.unallocated = 0
+
+    def update(self, loaded: int = 0, failed: int = 0, unallocated: int = 0) -> None:
+        self.loaded += loaded
+        self.failed += failed
+        self.unallocated += unallocated
+        if self.clock() - self._reported >= self.report_every:
+            self.report()
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.loaded / max(self.clock() - self.started, 1e-9)
+
+    def report(self) -> None:
+        self._reported = self.clock()
+        logger.info(
+            "%s: %d read, %d loaded, %d failed, %d unallocated, %.0f rows/s",
+            self.kind, self.read, self.loaded, self.failed,
+            self.unallocated, self.rows_per_second,
+        )
+
+
+def batch_from_csv(row: dict) -> commands.CreateBatch:
+    try:
+        qty = int(row["qty"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("qty must be a non-negative integer")
+    return bulk.batch_from_row(
+        dict(ref=row.get("ref"), sku=row.get("sku"), qty=qty, eta=row.get("eta") or None)
+    )
+
+
+def order_line_from_csv(row: dict) -> tuple[str, str, int]:
+    orderid, sku = row.get("orderid"), row.get("sku")
+    if not orderid or not sku:
+        raise ValueError("orderid and sku are required")
+    try:
+        qty = int(row["qty"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("qty must be an integer")
+    if qty <= 0:
+        raise ValueError("qty must be positive")
+    return orderid, sku, qty
+
+
+def load_batches(
+    rows: Iterable[dict],
+    bus: messagebus.MessageBus | sharding.ShardedExecutor,
+    chunk_size: int = 1000,
+    progress: Progress | None = None,
+) -> Progress:
+    # one CreateBatches, so one transaction, per chunk, or per shard of a
+    # chunk when the bus is sharded
+    progress = progress or Progress("batches")
+    with Dispatcher(bus, progress) as dispatcher:
+        for chunk in _chunks(rows, chunk_size, progress):
+            valid = []
+            for number, row in chunk:
+                try:
+                    valid.append(batch_from_csv(row))
+                except ValueError as e:
+                    logger.warning("row %d: %s", number, e)
+                    progress.update(failed=1)
+            for batches in dispatcher.partition(valid):
+                dispatcher.submit(commands.CreateBatches(batches), len(batches))
+    return progress
+
+
+def load_orders(
+    rows: Iterable[dict],
+    bus: messagebus.MessageBus | sharding.ShardedExecutor,
+    chunk_size: int = 1000,
+    progress: Progress | None = None,
+) -> Progress:
+    # consecutive lines of one order are allocated together, in one
+    # transaction, lines for one SKU are allocated in file order
+    progress = progress or Progress("orders")
+    with Dispatcher(bus, progress) as dispatcher:
+        orderid, order_lines = None, []
+        for chunk in _chunks(rows, chunk_size, progress):
+            for number, row in chunk:
+                try:
+                    line = order_line_from_csv(row)
+                except ValueError as e:
+                    logger.warning("row %d: %s", number, e)
+                    progress.update(failed=1)
+                    continue
+                if line[0] != orderid:
+                    _submit_order(dispatcher, orderid, order_lines)
+                    orderid, order_lines = line[0], []
+                order_lines.append(line[1:])
+        _submit_order(dispatcher, orderid, order_lines)
+    return progress
+
+
+def _submit_order(dispatcher: "Dispatcher", orderid: str, lines: list[tuple[str, int]]):
+    if len(lines) == 1:
+        [(sku, qty)] = lines
+        dispatcher.submit(commands.Allocate(orderid, sku, qty), 1)
+    elif lines:
+        dispatcher.submit(commands.AllocateOrder(orderid, lines), len(lines))
+
+
+def _chunks(rows: Iterable[dict], chunk_size: int, progress: Progress) -> Iterator[list]:
+    # numbered from 2, the header is line 1
+    numbered = enumerate(rows, start=2)
+    while chunk := list(islice(numbered, chunk_size)):
+        progress.read += len(chunk)
+        yield chunk
+
+
+class Dispatcher:
+    # Runs commands on a plain bus as they come, or submits them to a sharded
+    # one with a bounded number in flight, so a huge file isn't queued up in
+    # memory ahead of the shards. An order spanning shards waits for, and
+    # holds back, everything else, or later lines for its SKUs could
+    # overtake it on their own shards.
+    def __init__(
+        self,
+        bus: messagebus.MessageBus | sharding.ShardedExecutor,
+        progress: Progress,
+        max_in_flight: int | None = None,
+    ) -> None:
+        self.bus = bus
+        self.progress = progress
+        self.sharded = isinstance(bus, sharding.ShardedExecutor)
+        self.max_in_flight = max_in_flight or (4 * len(bus.buses) if self.sharded else 0)
+        self._in_flight: deque[tuple[Future, commands.Command, int]] = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._drain(0)
+        self.progress.report()
+
+    def partition(self, batches: list[commands.CreateBatch]) -> list[list[commands.CreateBatch]]:
+        if not self.sharded:
+            return [batches] if batches else []
+        by_shard: dict[int, list[commands.CreateBatch]] = {}
+        for batch in batches:
+            by_shard.setdefault(self.bus.shard_for(batch), []).append(batch)
+        return list(by_shard.values())
+
+    def submit(self, command: commands.Command, rows: int) -> None:
+        if not self.sharded:
+            future = Future()
+            try:
+                future.set_result(self.bus.handle(command))
+            except Exception as e:
+                future.set_exception(e)
+            self._finish(future, command, rows)
+            return
+        spans_shards = self._spans_shards(command)
+        if spans_shards:
+            self._drain(0)
+        self._in_flight.append((self.bus.submit(command), command, rows))
+        self._drain(0 if spans_shards else self.max_in_flight)
+
+    def _spans_shards(self, command: commands.Command) -> bool:
+        if not isinstance(command, commands.AllocateOrder):
+            return False
+        shards = {
+            self.bus.shard_for(commands.Allocate(command.orderid, sku, qty))
+            for sku, qty in command.lines
+        }
+        return len(shards) > 1
+
+    def _drain(self, limit: int) -> None:
+        while len(self._in_flight) > limit:
+            self._finish(*self._in_flight.popleft())
+
+    def _finish(self, future: Future, command: commands.Command, rows: int) -> None:
+        try:
+            result = future.result()[0]
+        except Exception as e:
+            logger.warning("%s failed: %s", command, e)
+            self.progress.update(failed=rows)
+            return
+        if isinstance(command, commands.AllocateOrder):
+            unallocated = result.count(None)
+        elif isinstance(command, commands.Allocate):
+            unallocated = int(result is None)
+        else:
+            unallocated = 0
+        self.progress.update(loaded=rows, unallocated=unallocated)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,52 @@
+import json
+import os
+import threading
 from datetime import datetime
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 
-from allocation import bootstrap, views
+from allocation import bootstrap, config, views
 from allocation.domain import commands
-from allocation.service_layer import messagebus, unit_of_work
-from allocation.service_layer.handlers import InvalidSku
+from allocation.entrypoints import bulk, redis_eventconsumer, redis_eventpublisher
+from allocation.service_layer import metrics, sharding, unit_of_work
+from allocation.service_layer.handlers import DuplicateLine, InvalidSku
 
 app = Flask(__name__)
-bus = bootstrap.bootstrap()
+_bus = None
+_bus_lock = threading.Lock()
+_metrics = metrics.Metrics()
+_allocations_cache = views.AllocationsCache(**config.get_allocations_cache_settings())
+_metrics.watch_cache("allocations_view", _allocations_cache)
+_listener_pid = None
+
+
+def get_bus() -> sharding.ShardedExecutor:
+    # bootstrapped on the first request rather than at import time
+    global _bus
+    with _bus_lock:
+        if _bus is None:
+            _bus = bootstrap.bootstrap_sharded(
+                workers=config.get_bus_workers(),
+                read_model_in_transaction=config.get_read_model_in_transaction(),
+                publish=redis_eventpublisher.BufferedPublisher(
+                    **config.get_publish_buffer_settings()
+                ),
+                metrics=_metrics,
+                allocations_cache=_allocations_cache,
+            )
+        return _bus
+
+
+def get_allocations_cache() -> views.AllocationsCache:
+    # kept fresh by this process's bus and by other processes' events; the
+    # listener is started on first use and again in each forked child, it
+    # connects in its own thread so requests never wait on redis
+    global _listener_pid
+    with _bus_lock:
+        if _listener_pid != os.getpid():
+            redis_eventconsumer.listen_for_invalidations(_allocations_cache)
+            _listener_pid = os.getpid()
+        return _allocations_cache
 
 
 @app.route("/add_batch", methods=["POST"])
@@ -19,27 +57,105 @@ def add_batch():
     cmd = commands.CreateBatch(
         request.json["ref"], request.json["sku"], request.json["qty"], eta
     )
-    bus.handle(cmd)
+    get_bus().handle(cmd)
     return "OK", 201
 
 
+@app.route("/add_batches", methods=["POST"])
+def add_batches():
+    # NDJSON or a JSON array, read as it arrives, answered with one NDJSON
+    # result per row
+    if request.mimetype == "application/x-ndjson":
+        rows = bulk.iter_ndjson(request.stream)
+    else:
+        rows = bulk.iter_json_array(request.stream)
+    results = bulk.ingest_batches(rows, get_bus())
+    return Response(
+        stream_with_context(ndjson_chunks(results)), mimetype="application/x-ndjson"
+    )
+
+
 @app.route("/allocate", methods=["POST"])
 def allocate_endpoint():
     try:
         cmd = commands.Allocate(
             request.json["orderid"], request.json["sku"], request.json["qty"]
         )
-        bus.handle(cmd)
+        get_bus().handle(cmd)
     except InvalidSku as e:
         return jsonify({'message': str(e)}), 400
 
     return jsonify({'message': 'Allocated'}), 202
 
 
+@app.route("/allocate_order", methods=["POST"])
+def allocate_order_endpoint():
+    lines = [(line["sku"], line["qty"]) for line in request.json["lines"]]
+    try:
+        cmd = commands.AllocateOrder(request.json["orderid"], lines)
+        [batchrefs, *_] = get_bus().handle(cmd)
+    except (InvalidSku, DuplicateLine) as e:
+        return jsonify({'message': str(e)}), 400
+
+    return jsonify([
+        {"sku": sku, "qty": qty, "batchref": batchref}
+        for (sku, qty), batchref in zip(lines, batchrefs)
+    ]), 202
+
+
 @app.route("/allocations/<orderid>", methods=["GET"])
 def allocations_view_endpoint(orderid):
     uow = unit_of_work.SqlAlchemyUnitOfWork()
-    result = views.allocations(orderid, uow)
+    result = views.allocations(orderid, uow, cache=get_allocations_cache())
     if not result:
         return "not found", 404
     return jsonify(result), 200
+
+
+@app.route("/stock/<sku>", methods=["GET"])
+def stock_view_endpoint(sku):
+    uow = unit_of_work.SqlAlchemyUnitOfWork()
+    result = views.stock(sku, uow)
+    if result is None:
+        return "not found", 404
+    return jsonify(result), 200
+
+
+MAX_ORDERS_PER_LOOKUP = 500
+
+
+@app.route("/allocations", methods=["GET"])
+def allocations_for_orders_endpoint():
+    orderids = request.args.getlist("orderid")
+    if not orderids or len(orderids) > MAX_ORDERS_PER_LOOKUP:
+        return jsonify({'message': f'Pass 1 to {MAX_ORDERS_PER_LOOKUP} orderid parameters'}), 400
+    uow = unit_of_work.SqlAlchemyUnitOfWork()
+    result = views.allocations_for_orders(orderids, uow, cache=get_allocations_cache())
+    return jsonify(result), 200
+
+
+@app.route("/export/allocations", methods=["GET"])
+def export_allocations_endpoint():
+    rows = views.export_allocations(
+        unit_of_work.SqlAlchemyUnitOfWork(),
+        sku=request.args.get("sku"),
+        batchref=request.args.get("batchref"),
+        after=request.args.get("after", 0, type=int),
+    )
+    return Response(stream_with_context(ndjson_chunks(rows)), mimetype="application/x-ndjson")
+
+
+def ndjson_chunks(rows, lines_per_chunk=1000):
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(row) + "\n")
+        if len(chunk) == lines_per_chunk:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return _metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
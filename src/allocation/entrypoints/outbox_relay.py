@@ -0,0 +1,52 @@
+import logging
+import time
+from typing import Callable
+
+from sqlalchemy.sql import bindparam, text
+
+from allocation.entrypoints import redis_eventpublisher
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def relay(
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    publish_many: Callable = redis_eventpublisher.publish_many,
+    batch_size: int = 500,
+) -> int:
+    # Rows are only deleted once the whole batch is published, so a crash
+    # or a broker error means they are sent again (at least once). Rows are
+    # sent in id order, which for one sku is the order its commits landed in.
+    with uow:
+        rows = uow.session.execute(
+            text("SELECT id, channel, payload FROM outbox ORDER BY id LIMIT :limit"),
+            dict(limit=batch_size),
+        ).all()
+        if not rows:
+            return 0
+        publish_many([(channel, payload) for _, channel, payload in rows])
+        uow.session.execute(
+            text("DELETE FROM outbox WHERE id IN :ids").bindparams(
+                bindparam("ids", expanding=True)
+            ),
+            dict(ids=[id_ for id_, _, _ in rows]),
+        )
+        uow.commit()
+    return len(rows)
+
+
+def main(batch_size: int = 500, idle_wait: float = 0.1):
+    uow = unit_of_work.SqlAlchemyUnitOfWork()
+    while True:
+        try:
+            relayed = relay(uow, batch_size=batch_size)
+        except Exception:
+            logger.exception("Exception relaying outbox")
+            relayed = 0
+        if relayed < batch_size:
+            time.sleep(idle_wait)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,144 @@
 import json
 import logging
+import threading
+import time
+from typing import Callable
 
 import redis
 
-from allocation import bootstrap, config
+from allocation import bootstrap, config, views
 from allocation.adapters import orm
 from allocation.domain import commands
-from allocation.service_layer import messagebus, unit_of_work
+from allocation.entrypoints import redis_eventpublisher
+from allocation.service_layer import sharding
 
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
-
-bus = bootstrap.bootstrap()
-
 
 def main():
+    bus = bootstrap.bootstrap_sharded(
+        workers=config.get_bus_workers(),
+        read_model_in_transaction=config.get_read_model_in_transaction(),
+        publish=redis_eventpublisher.BufferedPublisher(**config.get_publish_buffer_settings()),
+    )
+    coalescer = Coalescer(bus, **config.get_coalescing_settings())
+    r = redis.Redis(**config.get_redis_host_and_port())
     pubsub = r.pubsub(ignore_subscribe_messages=True)
     pubsub.subscribe("change_batch_quantity")
-    for m in pubsub.listen():
-        handle_change_batch_quantity(m)
+    while True:
+        m = pubsub.get_message(timeout=coalescer.time_to_flush())
+        if m is not None:
+            handle_change_batch_quantity(m, coalescer)
+        coalescer.flush_due()
 
 
-def handle_change_batch_quantity(m):
+def handle_change_batch_quantity(m, coalescer: "Coalescer"):
     logging.debug("handling %s", m)
     data = json.loads(m["data"])
-    cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
-    bus.handle(cmd)
+    coalescer.add(commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"]))
+
+
+class Coalescer:
+    # A recount sends bursts of quantities for the same batch and only the
+    # last one matters, so commands wait up to `window` seconds after the
+    # first of them arrived, a later one replacing any earlier one for its
+    # batchref, and are then submitted together. That is also the most
+    # delay this adds, and max_pending batchrefs flush early.
+    def __init__(
+        self,
+        bus: sharding.ShardedExecutor,
+        window: float = 0.05,
+        max_pending: int = 1000,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.bus = bus
+        self.window = window
+        self.max_pending = max_pending
+        self.clock = clock
+        self._pending: dict[str, commands.ChangeBatchQuantity] = {}
+        self._deadline: float | None = None
+        self.received = self.coalesced = self.dispatched = 0
+
+    def add(self, command: commands.ChangeBatchQuantity) -> None:
+        self.received += 1
+        if command.ref in self._pending:
+            self.coalesced += 1
+        elif not self._pending:
+            self._deadline = self.clock() + self.window
+        self._pending[command.ref] = command
+        if len(self._pending) >= self.max_pending or self.window <= 0:
+            self.flush()
+
+    def time_to_flush(self) -> float | None:
+        if self._deadline is None:
+            return None
+        return max(self._deadline - self.clock(), 0.0)
+
+    def flush_due(self) -> None:
+        if self._deadline is not None and self.clock() >= self._deadline:
+            self.flush()
+
+    def flush(self) -> None:
+        for command in self._pending.values():
+            # don't wait, so the next message can start on another shard
+            self.bus.submit(command).add_done_callback(log_failure)
+        self.dispatched += len(self._pending)
+        if self.coalesced:
+            logger.debug(
+                "%d received, %d coalesced, %d dispatched",
+                self.received, self.coalesced, self.dispatched,
+            )
+        self._pending.clear()
+        self._deadline = None
+
 
+def log_failure(future):
+    if future.exception() is not None:
+        logger.error("Exception handling message", exc_info=future.exception())
+
+
+INVALIDATING_CHANNELS = ("line_allocated", "line_deallocated")
+
+
+def listen_for_invalidations(
+    cache: views.AllocationsCache, r: redis.Redis | None = None, retry_wait: float = 1.0
+):
+    # other processes' Allocated and Deallocated events, this one's were
+    # already handled by the bus
+    r = r or redis.Redis(**config.get_redis_host_and_port())
+    thread = threading.Thread(target=keep_invalidating, args=(r, cache, retry_wait), daemon=True)
+    thread.start()
+    return thread
+
+
+def keep_invalidating(r: redis.Redis, cache: views.AllocationsCache, retry_wait: float):
+    # Subscribes again whenever the subscription fails. Invalidations sent
+    # meanwhile are lost, so the whole cache is dropped each time it's back,
+    # until then the TTL bounds how stale it gets.
+    failing = False
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(*INVALIDATING_CHANNELS)
+            cache.clear()
+            if failing:
+                logger.warning("Subscribed to allocation invalidations again")
+            failing = False
+            invalidate_cached_allocations(pubsub, cache)
+        except Exception:
+            if not failing:
+                logger.exception(
+                    "Lost the allocation invalidations, retrying every %ss", retry_wait
+                )
+            failing = True
+        time.sleep(retry_wait)
+
+
+def invalidate_cached_allocations(pubsub, cache: views.AllocationsCache):
+    for m in pubsub.listen():
+        logging.debug("invalidating for %s", m)
+        cache.invalidate(json.loads(m["data"])["orderid"])
 
 if __name__ == "__main__":
     main()
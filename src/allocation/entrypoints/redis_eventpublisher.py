@@ -1,15 +1,95 @@
 from dataclasses import asdict
 import json
 import logging
+import threading
+import time
+from typing import Callable
 
 import redis
+import redis.asyncio
 
 from allocation import config
 from allocation.domain import events
 
-r = redis.Redis(**config.get_redis_host_and_port())
+_client = None
+_async_client = None
+
+
+def get_client() -> redis.Redis:
+    # redis-py replaces its pooled connections itself after a fork
+    global _client
+    if _client is None:
+        _client = redis.Redis(**config.get_redis_host_and_port())
+    return _client
 
 
 def publish(channel, event: events.Event):
     logging.debug("publishing: channel=%s, event=%s", channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+    get_client().publish(channel, json.dumps(asdict(event)))
+
+
+def get_async_client() -> redis.asyncio.Redis:
+    global _async_client
+    if _async_client is None:
+        _async_client = redis.asyncio.Redis(**config.get_redis_host_and_port())
+    return _async_client
+
+
+async def publish_async(channel, event: events.Event):
+    logging.debug("publishing: channel=%s, event=%s", channel, event)
+    await get_async_client().publish(channel, json.dumps(asdict(event)))
+
+
+def publish_many(messages: list[tuple[str, str]], client: redis.Redis | None = None):
+    # already serialized (channel, payload) pairs, sent in order on one
+    # connection without waiting for each reply
+    pipeline = (client or get_client()).pipeline(transaction=False)
+    for channel, payload in messages:
+        pipeline.publish(channel, payload)
+    pipeline.execute()
+
+
+class BufferedPublisher:
+    # Stands in for publish: events are serialized as publish would, kept
+    # per thread (one bus dispatch runs on one thread) and sent with
+    # publish_many by flush(), which the bus calls after each top-level
+    # dispatch. A long cascade is sent early once max_batch events are
+    # waiting or the oldest has waited flush_interval seconds.
+    def __init__(
+        self,
+        publish_many: Callable[[list[tuple[str, str]]], None] = publish_many,
+        max_batch: int = 500,
+        flush_interval: float = 0.1,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.publish_many = publish_many
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self._local = threading.local()
+
+    @property
+    def _buffer(self) -> list[tuple[str, str]]:
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = []
+        return buffer
+
+    def __call__(self, channel, event: events.Event):
+        logging.debug("buffering: channel=%s, event=%s", channel, event)
+        buffer = self._buffer
+        if not buffer:
+            self._local.since = self.clock()
+        buffer.append((channel, json.dumps(asdict(event))))
+        waited = self.clock() - self._local.since
+        if len(buffer) >= self.max_batch or waited >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        buffer = self._buffer
+        if not buffer:
+            return
+        # cleared first, a failed batch isn't sent again with the next one
+        messages = list(buffer)
+        buffer.clear()
+        self.publish_many(messages)
@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import socket
+import time
+
+import redis
+
+from allocation import bootstrap, config
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventpublisher
+from allocation.service_layer import sharding
+
+logger = logging.getLogger(__name__)
+
+STREAM = "change_batch_quantity"
+GROUP = "allocation"
+
+
+def main():
+    bus = bootstrap.bootstrap_sharded(
+        workers=config.get_bus_workers(),
+        read_model_in_transaction=config.get_read_model_in_transaction(),
+        publish=redis_eventpublisher.BufferedPublisher(**config.get_publish_buffer_settings()),
+    )
+    client = redis.Redis(**config.get_redis_host_and_port(), decode_responses=True)
+    consumer = StreamConsumer(
+        client, bus, name=f"{socket.gethostname()}-{os.getpid()}", **config.get_stream_settings()
+    )
+    consumer.create_group()
+    while True:
+        try:
+            consumer.poll()
+        except redis.ConnectionError:
+            logger.exception("Lost the connection to redis")
+            time.sleep(1)
+
+
+class StreamConsumer:
+    # Reads change_batch_quantity entries in batches as one member of a
+    # consumer group and hands them to the sharded bus, so a batch is handled
+    # in parallel across SKUs and in stream order for each one. An entry is
+    # acked once its command succeeds. Anything left pending by a consumer
+    # that died, or by a failure here, is claimed again after claim_idle_ms,
+    # and moved to the dead-letter stream after max_deliveries attempts.
+    # A reclaimed entry older than one already handled for its batchref is
+    # acked without being applied, it would only put back a stale quantity.
+    # Order per batchref only holds within one consumer, so run more than
+    # one in a group for failover rather than for throughput.
+    def __init__(
+        self,
+        client: redis.Redis,
+        bus: sharding.ShardedExecutor,
+        name: str,
+        stream: str = STREAM,
+        group: str = GROUP,
+        count: int = 100,
+        block_ms: int = 1000,
+        claim_idle_ms: int = 30_000,
+        max_deliveries: int = 5,
+    ) -> None:
+        self.client = client
+        self.bus = bus
+        self.name = name
+        self.stream = stream
+        self.group = group
+        self.count = count
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self.dead_letters = f"{stream}:dead"
+        self._claim_from = "0-0"
+        # highest entry id handled per batchref
+        self._handled_upto: dict[str, tuple[int, int]] = {}
+        self.handled = self.coalesced = self.failed = self.claimed = self.dead_lettered = 0
+
+    def create_group(self) -> None:
+        try:
+            self.client.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def poll(self) -> int:
+        entries = self._claim() or self._read()
+        if entries:
+            self.process(entries)
+        return len(entries)
+
+    def process(self, entries: list[tuple[str, dict]]) -> None:
+        # only the latest quantity for a batchref in the batch is applied,
+        # in its place in the stream, the ones it replaced are acked with it
+        done, failed, unreadable, latest = [], [], [], {}
+        for entry_id, fields in entries:
+            try:
+                command = change_batch_quantity_from(fields)
+            except (KeyError, TypeError, ValueError):
+                logger.exception("Unreadable entry %s %s", entry_id, fields)
+                unreadable.append((entry_id, fields))
+                continue
+            handled_upto = self._handled_upto.get(command.ref)
+            if handled_upto is not None and stream_id(entry_id) < handled_upto:
+                done.append(entry_id)
+                continue
+            replaced = latest.pop(command.ref, None)
+            if replaced is not None:
+                done.append(replaced[0])
+            latest[command.ref] = (entry_id, fields, command)
+        self.coalesced += len(done)
+        futures = [
+            (entry_id, fields, command.ref, self.bus.submit(command))
+            for entry_id, fields, command in latest.values()
+        ]
+        for entry_id, fields, batchref, future in futures:
+            if future.exception() is None:
+                done.append(entry_id)
+                self._handled_upto[batchref] = max(
+                    stream_id(entry_id), self._handled_upto.get(batchref, (0, 0))
+                )
+            else:
+                logger.error("Exception handling entry %s", entry_id, exc_info=future.exception())
+                failed.append((entry_id, fields))
+        self.handled += len(futures) - len(failed)
+        self.failed += len(failed) + len(unreadable)
+        # no point retrying what can't be read
+        given_up = unreadable + [(i, f) for i, f in failed if self._given_up_on(i)]
+        done += self._dead_letter(given_up)
+        if done:
+            self.client.xack(self.stream, self.group, *done)
+
+    def _claim(self) -> list[tuple[str, dict]]:
+        self._claim_from, entries, *_ = self.client.xautoclaim(
+            self.stream,
+            self.group,
+            self.name,
+            self.claim_idle_ms,
+            start_id=self._claim_from,
+            count=self.count,
+        )
+        self.claimed += len(entries)
+        return entries
+
+    def _read(self) -> list[tuple[str, dict]]:
+        response = self.client.xreadgroup(
+            self.group, self.name, {self.stream: ">"}, count=self.count, block=self.block_ms
+        )
+        return response[0][1] if response else []
+
+    def _given_up_on(self, entry_id: str) -> bool:
+        [pending] = self.client.xpending_range(self.stream, self.group, entry_id, entry_id, 1)
+        return pending["times_delivered"] >= self.max_deliveries
+
+    def _dead_letter(self, entries: list[tuple[str, dict]]) -> list[str]:
+        for entry_id, fields in entries:
+            logger.error("Moving entry %s to %s", entry_id, self.dead_letters)
+            self.client.xadd(self.dead_letters, fields)
+        self.dead_lettered += len(entries)
+        return [entry_id for entry_id, _ in entries]
+
+
+def stream_id(entry_id: str) -> tuple[int, int]:
+    ms, _, sequence = entry_id.partition("-")
+    return int(ms), int(sequence or 0)
+
+
+def change_batch_quantity_from(fields: dict) -> commands.ChangeBatchQuantity:
+    # same payload as the pub/sub channel, in a "data" field
+    data = json.loads(fields["data"])
+    return commands.ChangeBatchQuantity(ref=data["batchref"], qty=int(data["qty"]))
+
+
+if __name__ == "__main__":
+    main()
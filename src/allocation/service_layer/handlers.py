@@ -1,11 +1,13 @@
+import itertools
+import json
+from collections import defaultdict
 from dataclasses import asdict
 from typing import Callable
 
 from sqlalchemy.sql import text
 
-from allocation.adapters import email
+from allocation import views
 from allocation.domain import commands, events, model
-from allocation.entrypoints import redis_eventpublisher
 from allocation.service_layer import unit_of_work
 
 
@@ -13,6 +15,10 @@ class InvalidSku(Exception):
     pass
 
 
+class DuplicateLine(Exception):
+    pass
+
+
 def add_batch(
     command: commands.CreateBatch,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -22,7 +28,18 @@ def add_batch(
         if product is None:
             product = model.Product(command.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(model.Batch(command.ref, command.sku, command.qty, command.eta))
+        product.add_batch(model.Batch(command.ref, command.sku, command.qty, command.eta))
+        uow.commit()
+
+
+def add_batches(
+    command: commands.CreateBatches,
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> None:
+    with uow:
+        uow.products.add_batches(
+            [model.Batch(b.ref, b.sku, b.qty, b.eta) for b in command.batches]
+        )
         uow.commit()
 
 
@@ -40,11 +57,75 @@ def allocate(
         return batchref
 
 
-def reallocate(
-    event: events.Deallocated,
+def allocate_with_sql(
+    command: commands.Allocate,
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+) -> str | None:
+    line = model.OrderLine(command.orderid, command.sku, command.qty)
+    with uow:
+        found = uow.products.find_batch_for(line)
+        if found is None:
+            raise InvalidSku(f"Invalid sku {line.sku}")
+        version_number, batch_id, batchref, allocated_to = found
+        if allocated_to is not None:
+            return allocated_to
+        if batch_id is None:
+            uow.products.events.append(events.OutOfStock(line.sku))
+            return None
+        uow.products.add_allocation(line, batch_id, version_number)
+        uow.products.events.append(
+            events.Allocated(
+                orderid=line.orderid, sku=line.sku, qty=line.qty, batchref=batchref
+            )
+        )
+        uow.commit()
+        return batchref
+
+
+def allocate_order(
+    command: commands.AllocateOrder,
     uow: unit_of_work.AbstractUnitOfWork,
-):
-    allocate(commands.Allocate(**asdict(event)), uow=uow)
+) -> list[str | None]:
+    lines = [model.OrderLine(command.orderid, sku, qty) for sku, qty in command.lines]
+    # an order line is its orderid, sku and qty, so a repeat would be allocated once
+    if len(set(lines)) < len(lines):
+        line = next(line for i, line in enumerate(lines) if line in lines[:i])
+        raise DuplicateLine(f"Duplicate line {line.sku} x {line.qty}")
+    positions_by_sku: dict[str, list[int]] = defaultdict(list)
+    for position, line in enumerate(lines):
+        positions_by_sku[line.sku].append(position)
+
+    batchrefs: list[str | None] = [None] * len(lines)
+    with uow:
+        for sku, positions in positions_by_sku.items():
+            product = uow.products.get(sku=sku)
+            if product is None:
+                raise InvalidSku(f"Invalid sku {sku}")
+            allocated = product.allocate_many([lines[p] for p in positions])
+            for position, batchref in zip(positions, allocated):
+                batchrefs[position] = batchref
+        uow.commit()
+    return batchrefs
+
+
+INSERT_ALLOCATION = text(
+    """
+    INSERT INTO allocations_view (orderid, sku, batchref)
+    VALUES (:orderid, :sku, :batchref)
+    """
+)
+
+# one row, an order can have several lines for a SKU
+DELETE_ALLOCATION = text(
+    """
+    DELETE FROM allocations_view
+    WHERE id = (
+        SELECT id FROM allocations_view
+        WHERE orderid = :orderid AND sku = :sku AND batchref = :batchref
+        LIMIT 1
+    )
+    """
+)
 
 
 def add_allocation_to_read_model(
@@ -53,12 +134,7 @@ def add_allocation_to_read_model(
 ):
     with uow:
         uow.session.execute(
-            text(
-                """
-                INSERT INTO allocations_view (orderid, sku, batchref)
-                VALUES (:orderid, :sku, :batchref)
-                """
-            ),
+            INSERT_ALLOCATION,
             dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
         )
         uow.commit()
@@ -70,22 +146,89 @@ def remove_allocation_from_read_model(
 ):
     with uow:
         uow.session.execute(
-            text(
-                """
-                DELETE FROM allocations_view
-                WHERE orderid = :orderid AND sku = :sku
-                """
-            ),
-            dict(orderid=event.orderid, sku=event.sku),
+            DELETE_ALLOCATION,
+            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
         )
         uow.commit()
 
 
+def project_allocations(session, new_events: list[events.Event]):
+    # runs inside the command's own transaction instead of the two handlers
+    # above, each run of consecutive events of one type is one executemany
+    relevant = (e for e in new_events if isinstance(e, (events.Allocated, events.Deallocated)))
+    for event_type, run in itertools.groupby(relevant, type):
+        if event_type is events.Allocated:
+            session.execute(
+                INSERT_ALLOCATION,
+                [dict(orderid=e.orderid, sku=e.sku, batchref=e.batchref) for e in run],
+            )
+        else:
+            session.execute(
+                DELETE_ALLOCATION,
+                [dict(orderid=e.orderid, sku=e.sku, batchref=e.batchref) for e in run],
+            )
+
+
+UPDATE_STOCK = text(
+    """
+    INSERT INTO stock_view (sku, purchased, allocated)
+    VALUES (:sku, :purchased, :allocated)
+    ON CONFLICT (sku) DO UPDATE SET
+        purchased = stock_view.purchased + excluded.purchased,
+        allocated = stock_view.allocated + excluded.allocated
+    """
+)
+
+
+def stock_changes(new_events: list[events.Event]) -> list[dict]:
+    # net purchased and allocated quantity per SKU
+    changes: dict[str, dict] = {}
+    for e in new_events:
+        if isinstance(e, events.BatchCreated):
+            purchased, allocated = e.qty, 0
+        elif isinstance(e, events.BatchQuantityChanged):
+            purchased, allocated = e.qty - e.previous_qty, 0
+        elif isinstance(e, events.Allocated):
+            purchased, allocated = 0, e.qty
+        elif isinstance(e, events.Deallocated):
+            purchased, allocated = 0, -e.qty
+        else:
+            continue
+        change = changes.setdefault(e.sku, dict(sku=e.sku, purchased=0, allocated=0))
+        change["purchased"] += purchased
+        change["allocated"] += allocated
+    return list(changes.values())
+
+
+def update_stock_view(
+    event: events.Event,
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+):
+    with uow:
+        uow.session.execute(UPDATE_STOCK, stock_changes([event]))
+        uow.commit()
+
+
+def project_stock(session, new_events: list[events.Event]):
+    # one upsert per SKU however long the cascade that changed it
+    changes = stock_changes(new_events)
+    if changes:
+        session.execute(UPDATE_STOCK, changes)
+
+
+def invalidate_cached_allocations(
+    event: events.Allocated | events.Deallocated,
+    allocations_cache: views.AllocationsCache,
+):
+    allocations_cache.invalidate(event.orderid)
+
+
 def send_out_of_stock_notification(
     event: events.OutOfStock,
-    uow: unit_of_work.AbstractUnitOfWork,
+    send_mail: Callable,
 ):
-    email.send(
+    # returned so the async bus can await an async send_mail
+    return send_mail(
         "stock@made.com",
         f"Out of stock for {event.sku}",
     )
@@ -101,27 +244,71 @@ def change_batch_quantity(
         uow.commit()
 
 
+PUBLISHED_CHANNELS: dict[type[events.Event], str] = {
+    events.Allocated: "line_allocated",
+    events.Deallocated: "line_deallocated",
+}
+
+
 def publish_allocated_event(
     event: events.Allocated,
-    uow: unit_of_work.AbstractUnitOfWork,
+    publish: Callable,
 ):
-    redis_eventpublisher.publish("line_allocated", event)
+    return publish(PUBLISHED_CHANNELS[events.Allocated], event)
+
+
+def publish_deallocated_event(
+    event: events.Deallocated,
+    publish: Callable,
+):
+    return publish(PUBLISHED_CHANNELS[events.Deallocated], event)
+
+
+def add_to_outbox(session, new_events: list[events.Event]):
+    # replaces publish_allocated_event when bootstrapped with outbox=True
+    rows = [
+        dict(channel=PUBLISHED_CHANNELS[type(e)], sku=e.sku, payload=json.dumps(asdict(e)))
+        for e in new_events
+        if type(e) in PUBLISHED_CHANNELS
+    ]
+    if rows:
+        session.execute(
+            text("INSERT INTO outbox (channel, sku, payload) VALUES (:channel, :sku, :payload)"),
+            rows,
+        )
 
 
 EVENT_HANDLERS: dict[type[events.Event], list[Callable]] = {
     events.Allocated: [
         publish_allocated_event,
         add_allocation_to_read_model,
+        update_stock_view,
+        invalidate_cached_allocations,
     ],
+    # the product reallocates the line itself with an Allocate command
     events.Deallocated: [
+        publish_deallocated_event,
         remove_allocation_from_read_model,
-        reallocate
+        update_stock_view,
+        invalidate_cached_allocations,
     ],
     events.OutOfStock: [send_out_of_stock_notification],
+    events.BatchCreated: [update_stock_view],
+    events.BatchQuantityChanged: [update_stock_view],
 } 
 
+READ_MODEL_HANDLERS = (
+    add_allocation_to_read_model,
+    remove_allocation_from_read_model,
+    update_stock_view,
+)
+
+PUBLISH_HANDLERS = (publish_allocated_event, publish_deallocated_event)
+
 COMMAND_HANDLERS: dict[type[commands.Command], Callable] = {
     commands.Allocate: allocate,
+    commands.AllocateOrder: allocate_order,
     commands.CreateBatch: add_batch,
+    commands.CreateBatches: add_batches,
     commands.ChangeBatchQuantity: change_batch_quantity,
 }
@@ -1,15 +1,31 @@
+import asyncio
+import functools
+import inspect
 import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from typing import Callable
 
-from tenacity import Retrying, RetryError, stop_after_attempt, wait_exponential
+from tenacity import (
+    Retrying,
+    RetryError,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+    wait_random,
+)
 
 from allocation.domain import commands, events
-from allocation.service_layer import handlers, unit_of_work
+from allocation.service_layer import handlers, metrics, tracing, unit_of_work
 
 logger = logging.getLogger()
 
 Message = commands.Command | events.Event
 
+NOT_TRACED = nullcontext()
+
 
 class MessageBus:
     def __init__(
@@ -17,40 +33,217 @@ class MessageBus:
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: dict[type[events.Event], list[Callable]],
         command_handlers: dict[type[commands.Command], Callable],
+        retry_attempts: int = 3,
+        retry_backoff: float = 0.05,
+        retry_max_backoff: float = 1.0,
+        metrics: metrics.Metrics | None = None,
+        tracer: tracing.Tracer | None = None,
+        after_handle: Callable[[], None] | None = None,
     ) -> None:
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.retry_attempts = retry_attempts
+        self.retry_wait = wait_exponential(
+            multiplier=retry_backoff, max=retry_max_backoff
+        ) + wait_random(0, retry_backoff)
+        # per SKU, updated from every thread dispatching on this bus
+        self.conflicts: Counter[str] = Counter()
+        self.retries: Counter[str] = Counter()
+        self._counts_lock = threading.Lock()
+        self.metrics = metrics
+        self.tracer = tracer
+        self.after_handle = after_handle
+        self._local = threading.local()
 
+    @property
+    def _span(self) -> tracing.Span | None:
+        # the handler span running on this thread, parent to nested dispatches
+        return getattr(self._local, "span", None)
 
-    def handle(self, message: Message) -> None:
-        self.queue = [message]
-        while self.queue:
-            message = self.queue.pop(0)
-            if isinstance(message, events.Event):
-                self.handle_event(message)
-            elif isinstance(message, commands.Command):
-                self.handle_command(message)
-            else:
-                raise Exception(f"{message} was not an Event or Command")
+    @_span.setter
+    def _span(self, span: tracing.Span | None) -> None:
+        self._local.span = span
 
-    def handle_event(self, event: events.Event) -> None:
-        for handler in self.event_handlers[type(event)]:
-            try:
-                logger.debug("handling event %s with handler %s", event, handler)
-                handler(event)
-                self.queue.extend(self.uow.collect_new_events())
-            except Exception:
-                logger.exception("Exception handling event %s", event)
-                continue
-
-    def handle_command(self, command: commands.Command) -> None:
+    def handle(self, message: Message) -> list:
+        if self.after_handle is None:
+            return self._traced(message)
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        try:
+            return self._traced(message)
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                self._after_handle()
+
+    def _traced(self, message: Message) -> list:
+        if self.tracer is None or self._span is not None:
+            return self._handle(message)
+        with self.tracer.profiling(message):
+            return self._handle(message)
+
+    def _after_handle(self) -> None:
+        # like an event handler, its failure is logged, not the caller's
+        try:
+            self.after_handle()
+        except Exception:
+            logger.exception("Exception after handling a message")
+
+    def _handle(self, message: Message) -> list:
+        # local to each dispatch so a nested handle() can't clobber it
+        results = []
+        queue = deque([message])
+        try:
+            while queue:
+                message = queue.popleft()
+                if self.metrics is not None:
+                    self.metrics.observe_queue_depth(len(queue))
+                if isinstance(message, events.Event):
+                    self.handle_event(message, queue)
+                elif isinstance(message, commands.Command):
+                    results.append(self.handle_command(message, queue))
+                else:
+                    raise Exception(f"{message} was not an Event or Command")
+        finally:
+            if self.tracer is not None:
+                self.tracer.forget(queue)
+        return results
+
+    def handle_event(self, event: events.Event, queue: deque) -> None:
+        with self._message_span(event) as span:
+            for handler in self.event_handlers[type(event)]:
+                try:
+                    logger.debug("handling event %s with handler %s", event, handler)
+                    self._call_event_handler(handler, event, queue, span)
+                except Exception:
+                    logger.exception("Exception handling event %s", event)
+                    continue
+
+    def handle_command(self, command: commands.Command, queue: deque):
         logger.debug("handling command %s", command)
         try:
-            handler = self.command_handlers[type(command)]
-            handler(command)
-            self.queue.extend(self.uow.collect_new_events())
+            with self._message_span(command) as span:
+                handler = self.command_handlers[type(command)]
+                with self._handler_span(handler, span) as handler_span:
+                    for attempt in Retrying(
+                        stop=stop_after_attempt(self.retry_attempts),
+                        wait=self.retry_wait,
+                        retry=retry_if_exception_type(unit_of_work.ConcurrencyError),
+                        before_sleep=self._record_retry,
+                        reraise=True,
+                    ):
+                        with attempt:
+                            result = self._run_command_handler(handler, command)
+                self._collect_new_events(queue, handler_span)
+                return result
         except Exception:
             logger.exception("Exception handling command %s", command)
             raise
 
+    def _call_event_handler(self, handler: Callable, event: events.Event, queue: deque, span):
+        with self._handler_span(handler, span) as handler_span:
+            result = handler(event)
+        self._collect_new_events(queue, handler_span)
+        return result
+
+    def _collect_new_events(self, queue: deque, span) -> None:
+        if self.tracer is None:
+            queue.extend(self.uow.collect_new_events())
+            return
+        new_events = list(self.uow.collect_new_events())
+        self.tracer.link(new_events, span)
+        queue.extend(new_events)
+
+    def _message_span(self, message: Message):
+        if self.tracer is None:
+            return NOT_TRACED
+        return self.tracer.message_span(message, self._span.id if self._span else None)
+
+    def _handler_span(self, handler: Callable, parent):
+        if self.tracer is None:
+            return NOT_TRACED
+        return self._traced_handler(handler, parent)
+
+    @contextmanager
+    def _traced_handler(self, handler: Callable, parent: tracing.Span):
+        outer = self._span
+        with self.tracer.span("handler", handler.__name__, parent.id) as span:
+            self._span = span
+            try:
+                yield span
+            finally:
+                self._span = outer
+
+    def _run_command_handler(self, handler: Callable, command: commands.Command):
+        try:
+            return handler(command)
+        except unit_of_work.ConcurrencyError as e:
+            with self._counts_lock:
+                self.conflicts.update(e.skus)
+            if self.metrics is not None:
+                self.metrics.observe_conflict(e.skus)
+            raise
+
+    def _record_retry(self, retry_state) -> None:
+        error = retry_state.outcome.exception()
+        logger.warning("retrying after %s (attempt %d)", error, retry_state.attempt_number)
+        with self._counts_lock:
+            self.retries.update(error.skus)
+        if self.metrics is not None:
+            self.metrics.observe_retry(error.skus)
+
+
+
+class AsyncMessageBus(MessageBus):
+    # Handlers still run one at a time, on a worker thread, because they
+    # share the unit of work. Awaitables they return (async publish and
+    # send_mail) are run on the event loop alongside the remaining handlers
+    # for the same event, and all of them finish before the next message.
+    def __init__(self, *args, executor: Executor | None = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+
+    async def handle(self, message: Message) -> list:
+        results = []
+        queue = deque([message])
+        try:
+            while queue:
+                message = queue.popleft()
+                if self.metrics is not None:
+                    self.metrics.observe_queue_depth(len(queue))
+                if isinstance(message, events.Event):
+                    await self.handle_event(message, queue)
+                elif isinstance(message, commands.Command):
+                    results.append(await self.handle_command(message, queue))
+                else:
+                    raise Exception(f"{message} was not an Event or Command")
+        finally:
+            if self.tracer is not None:
+                self.tracer.forget(queue)
+        return results
+
+    async def handle_event(self, event: events.Event, queue: deque) -> None:
+        pending = []
+        with self._message_span(event) as span:
+            for handler in self.event_handlers[type(event)]:
+                try:
+                    logger.debug("handling event %s with handler %s", event, handler)
+                    result = await self._in_executor(
+                        self._call_event_handler, handler, event, queue, span
+                    )
+                    if inspect.isawaitable(result):
+                        pending.append(asyncio.ensure_future(result))
+                except Exception:
+                    logger.exception("Exception handling event %s", event)
+            outcomes = await asyncio.gather(*pending, return_exceptions=True)
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                logger.error("Exception handling event %s", event, exc_info=outcome)
+
+    async def handle_command(self, command: commands.Command, queue: deque):
+        return await self._in_executor(super().handle_command, command, queue)
+
+    def _in_executor(self, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, functools.partial(fn, *args))
@@ -0,0 +1,172 @@
+import bisect
+import functools
+import threading
+import time
+from collections import Counter
+from typing import Callable, Iterable
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 25, 100, 1000)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: str):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}'
+        labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+        yield f"{name}_sum{labels} {self.sum}"
+        yield f"{name}_count{labels} {self.count}"
+
+
+class HandlerStats:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.errors = 0
+        self.statements = 0
+
+
+class Metrics:
+    # Shared by every bus bootstrapped with it, so updates take a lock. SQL
+    # statements are counted per thread and attributed to whichever handler
+    # is running on that thread.
+    def __init__(self):
+        self.handlers: dict[tuple[str, str], HandlerStats] = {}
+        self.queue_depth = Histogram(DEPTH_BUCKETS)
+        self.commit_latency = Histogram(LATENCY_BUCKETS)
+        # lost version_number compare-and-swaps and retries, per SKU
+        self.conflicts: Counter[str] = Counter()
+        self.retries: Counter[str] = Counter()
+        # anything with hits, misses, evictions and a length
+        self.caches: dict[str, object] = {}
+        self._lock = threading.Lock()
+        self._sql = threading.local()
+        self._watching_sql = False
+
+    def watch_sql(self) -> None:
+        if not self._watching_sql:
+            event.listen(Engine, "before_cursor_execute", self._count_statement)
+            self._watching_sql = True
+
+    def stop_watching_sql(self) -> None:
+        if self._watching_sql:
+            event.remove(Engine, "before_cursor_execute", self._count_statement)
+            self._watching_sql = False
+
+    def watch_cache(self, name: str, cache) -> None:
+        self.caches[name] = cache
+
+    def instrument(self, handler_name: str, handler: Callable) -> Callable:
+        statements = self._statements
+        perf_counter = time.perf_counter
+        lock = self._lock
+        stats = None
+
+        @functools.wraps(handler)
+        def instrumented(message):
+            nonlocal stats
+            if stats is None:
+                stats = self._stats_for(handler_name, type(message).__name__)
+            started_statements = statements()
+            start = perf_counter()
+            try:
+                return handler(message)
+            except Exception:
+                with lock:
+                    stats.errors += 1
+                raise
+            finally:
+                elapsed = perf_counter() - start
+                executed = statements() - started_statements
+                with lock:
+                    stats.latency.observe(elapsed)
+                    stats.statements += executed
+
+        return instrumented
+
+    def observe_queue_depth(self, depth: int) -> None:
+        with self._lock:
+            self.queue_depth.observe(depth)
+
+    def observe_commit(self, seconds: float) -> None:
+        with self._lock:
+            self.commit_latency.observe(seconds)
+
+    def observe_conflict(self, skus: Iterable[str]) -> None:
+        with self._lock:
+            self.conflicts.update(skus)
+
+    def observe_retry(self, skus: Iterable[str]) -> None:
+        with self._lock:
+            self.retries.update(skus)
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                "# HELP allocation_handler_seconds Time spent in each handler.",
+                "# TYPE allocation_handler_seconds histogram",
+            ]
+            for (handler, message), stats in sorted(self.handlers.items()):
+                labels = f'handler="{handler}",message="{message}",'
+                lines.extend(stats.latency.samples("allocation_handler_seconds", labels))
+            for name, attribute, help_text in (
+                ("allocation_handler_errors_total", "errors", "Exceptions raised by each handler."),
+                ("allocation_handler_sql_statements_total", "statements", "SQL statements run by each handler."),
+            ):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} counter")
+                for (handler, message), stats in sorted(self.handlers.items()):
+                    value = getattr(stats, attribute)
+                    lines.append(f'{name}{{handler="{handler}",message="{message}"}} {value}')
+            lines.append("# HELP allocation_bus_queue_depth Messages waiting when each one is dispatched.")
+            lines.append("# TYPE allocation_bus_queue_depth histogram")
+            lines.extend(self.queue_depth.samples("allocation_bus_queue_depth", ""))
+            lines.append("# HELP allocation_uow_commit_seconds Time spent committing a unit of work.")
+            lines.append("# TYPE allocation_uow_commit_seconds histogram")
+            lines.extend(self.commit_latency.samples("allocation_uow_commit_seconds", ""))
+            for name, counts, help_text in (
+                ("allocation_concurrency_conflicts_total", self.conflicts, "Commands that lost a concurrent update, per SKU."),
+                ("allocation_concurrency_retries_total", self.retries, "Commands retried after a concurrent update, per SKU."),
+            ):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} counter")
+                lines.extend(f'{name}{{sku="{sku}"}} {count}' for sku, count in sorted(counts.items()))
+        for attribute in ("hits", "misses", "evictions"):
+            name = f"allocation_cache_{attribute}_total"
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(
+                f'{name}{{cache="{cache_name}"}} {getattr(cache, attribute)}'
+                for cache_name, cache in self.caches.items()
+            )
+        lines.append("# TYPE allocation_cache_entries gauge")
+        lines.extend(
+            f'allocation_cache_entries{{cache="{cache_name}"}} {len(cache)}'
+            for cache_name, cache in self.caches.items()
+        )
+        return "\n".join(lines) + "\n"
+
+    def _stats_for(self, handler_name: str, message_name: str) -> HandlerStats:
+        # each injected handler serves one message type, so this runs once
+        with self._lock:
+            return self.handlers.setdefault((handler_name, message_name), HandlerStats())
+
+    def _statements(self) -> int:
+        return getattr(self._sql, "count", 0)
+
+    def _count_statement(self, *args) -> None:
+        self._sql.count = getattr(self._sql, "count", 0) + 1
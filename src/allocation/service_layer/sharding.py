@@ -0,0 +1,63 @@
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from allocation.domain import commands
+from allocation.service_layer import messagebus
+
+
+class ShardedExecutor:
+    # Each shard is a bus with its own unit of work, driven by one thread, so
+    # messages for one SKU run in the order they were submitted while
+    # different SKUs run in parallel. Events raised by a command are handled
+    # by the same shard.
+    def __init__(
+        self,
+        buses: list[messagebus.MessageBus],
+        sku_for_batch: Callable[[str], str | None],
+    ) -> None:
+        self.buses = buses
+        self.sku_for_batch = sku_for_batch
+        self._threads = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"shard-{i}")
+            for i in range(len(buses))
+        ]
+        # a batch never moves to another SKU, so lookups can be kept
+        self._skus_by_batchref: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def shard_for(self, message: messagebus.Message) -> int:
+        key = self._key(message)
+        return zlib.crc32(key.encode()) % len(self.buses)
+
+    def submit(self, message: messagebus.Message) -> Future:
+        shard = self.shard_for(message)
+        return self._threads[shard].submit(self.buses[shard].handle, message)
+
+    def handle(self, message: messagebus.Message) -> list:
+        return self.submit(message).result()
+
+    def shutdown(self, wait: bool = True) -> None:
+        for thread in self._threads:
+            thread.shutdown(wait=wait)
+
+    def _key(self, message: messagebus.Message) -> str:
+        if isinstance(message, commands.ChangeBatchQuantity):
+            return self._sku_for_batch(message.ref) or message.ref
+        if isinstance(message, commands.AllocateOrder):
+            # an order spanning several SKUs can't sit on all of their
+            # shards, its other products are protected by the version check
+            return min((sku for sku, _ in message.lines), default=message.orderid)
+        if isinstance(message, commands.CreateBatches):
+            return min((b.sku for b in message.batches), default="")
+        return message.sku
+
+    def _sku_for_batch(self, batchref: str) -> str | None:
+        sku = self._skus_by_batchref.get(batchref)
+        if sku is None:
+            sku = self.sku_for_batch(batchref)
+            if sku is not None:
+                with self._lock:
+                    self._skus_by_batchref[batchref] = sku
+        return sku
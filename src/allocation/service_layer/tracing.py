@@ -0,0 +1,170 @@
+import cProfile
+import io
+import itertools
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from allocation.domain import commands
+
+
+@dataclass
+class Span:
+    id: int
+    parent_id: int | None
+    kind: str
+    name: str
+    thread_id: int
+    start: float
+    duration: float = 0.0
+    sql_seconds: float = 0.0
+    sql_statements: int = 0
+    error: str | None = None
+
+
+class Tracer:
+    # Records one span per message and one per handler call. A message's
+    # parent is the handler span that raised it, so a ChangeBatchQuantity
+    # and everything it cascades into form one tree.
+    def __init__(
+        self,
+        max_spans: int = 100_000,
+        profile_sample_rate: float = 0.0,
+        profile_threshold: float = 0.1,
+        profile_lines: int = 25,
+    ):
+        self.spans: deque[Span] = deque(maxlen=max_spans)
+        self.profiles: deque[dict] = deque(maxlen=100)
+        self.profile_sample_rate = profile_sample_rate
+        self.profile_threshold = profile_threshold
+        self.profile_lines = profile_lines
+        self._ids = itertools.count(1)
+        self._parents: dict[int, int] = {}
+        self._local = threading.local()
+        self._watching_sql = False
+
+    def watch_sql(self) -> None:
+        if not self._watching_sql:
+            event.listen(Engine, "before_cursor_execute", self._before_sql)
+            event.listen(Engine, "after_cursor_execute", self._after_sql)
+            self._watching_sql = True
+
+    def stop_watching_sql(self) -> None:
+        if self._watching_sql:
+            event.remove(Engine, "before_cursor_execute", self._before_sql)
+            event.remove(Engine, "after_cursor_execute", self._after_sql)
+            self._watching_sql = False
+
+    @contextmanager
+    def span(self, kind: str, name: str, parent_id: int | None):
+        local = self._local
+        sql_seconds = getattr(local, "sql_seconds", 0.0)
+        sql_statements = getattr(local, "sql_statements", 0)
+        span = Span(
+            id=next(self._ids),
+            parent_id=parent_id,
+            kind=kind,
+            name=name,
+            thread_id=threading.get_ident(),
+            start=time.perf_counter(),
+        )
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            span.duration = time.perf_counter() - span.start
+            span.sql_seconds = getattr(local, "sql_seconds", 0.0) - sql_seconds
+            span.sql_statements = getattr(local, "sql_statements", 0) - sql_statements
+            self.spans.append(span)
+
+    def message_span(self, message, parent_id: int | None):
+        # messages raised by a handler were linked to it when they were queued
+        parent_id = self._parents.pop(id(message), parent_id)
+        kind = "command" if isinstance(message, commands.Command) else "event"
+        return self.span(kind, type(message).__name__, parent_id)
+
+    def link(self, messages, span: Span) -> None:
+        for message in messages:
+            self._parents[id(message)] = span.id
+
+    def forget(self, messages) -> None:
+        for message in messages:
+            self._parents.pop(id(message), None)
+
+    @contextmanager
+    def profiling(self, message):
+        # samples top-level messages only, cProfile can't nest
+        if (
+            not self.profile_sample_rate
+            or getattr(self._local, "profiling", False)
+            or random.random() >= self.profile_sample_rate
+        ):
+            yield
+            return
+        profile = cProfile.Profile()
+        self._local.profiling = True
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.profiling = False
+            seconds = time.perf_counter() - start
+            if seconds >= self.profile_threshold:
+                out = io.StringIO()
+                stats = pstats.Stats(profile, stream=out)
+                stats.sort_stats("cumulative").print_stats(self.profile_lines)
+                self.profiles.append(
+                    dict(message=repr(message), seconds=seconds, stats=out.getvalue())
+                )
+
+    def to_json(self) -> str:
+        return json.dumps(
+            dict(spans=[vars(s) for s in self.spans], profiles=list(self.profiles))
+        )
+
+    def to_chrome_trace(self) -> str:
+        # the trace-event format used by chrome://tracing and Perfetto
+        pid = os.getpid()
+        return json.dumps({
+            "displayTimeUnit": "ms",
+            "traceEvents": [
+                {
+                    "name": s.name,
+                    "cat": s.kind,
+                    "ph": "X",
+                    "ts": s.start * 1e6,
+                    "dur": s.duration * 1e6,
+                    "pid": pid,
+                    "tid": s.thread_id,
+                    "args": dict(
+                        id=s.id,
+                        parent_id=s.parent_id,
+                        sql_ms=s.sql_seconds * 1e3,
+                        sql_statements=s.sql_statements,
+                        error=s.error,
+                    ),
+                }
+                for s in self.spans
+            ],
+        })
+
+    def _before_sql(self, *args) -> None:
+        self._local.sql_started = time.perf_counter()
+
+    def _after_sql(self, *args) -> None:
+        local = self._local
+        local.sql_seconds = getattr(local, "sql_seconds", 0.0) + time.perf_counter() - local.sql_started
+        local.sql_statements = getattr(local, "sql_statements", 0) + 1
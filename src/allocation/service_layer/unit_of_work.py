@@ -1,23 +1,49 @@
+import os
+import threading
+import time
 from contextlib import AbstractContextManager
 from abc import abstractmethod
+from typing import Callable
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
 
 from allocation import config
 from allocation.adapters import repository
 
 
+class ConcurrencyError(Exception):
+    def __init__(self, skus):
+        super().__init__(f"Concurrent update of {', '.join(sorted(skus))}")
+        self.skus = skus
+
+
 class AbstractUnitOfWork(AbstractContextManager):
     products: repository.AbstractProductRepository
+    # called with the session and the new events just before each commit
+    projections: tuple[Callable, ...] = ()
+    metrics = None
 
     def commit(self):
-            self._commit()
+        start = time.perf_counter()
+        self._commit()
+        if self.metrics is not None:
+            self.metrics.observe_commit(time.perf_counter() - start)
+        self.products.write_back()
 
     def collect_new_events(self):
         for product in self.products.seen:
             while product.events:
-                yield product.events.pop(0)
+                yield product.events.popleft()
+            self.products.events_collected(product)
+        while self.products.events:
+            yield self.products.events.popleft()
+
+    def peek_new_events(self):
+        for product in self.products.seen:
+            yield from product.events
+        yield from self.products.events
 
     @abstractmethod
     def _commit(self):
@@ -28,29 +54,107 @@ class AbstractUnitOfWork(AbstractContextManager):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
-    )
-)
+SERIALIZATION_FAILURES = {"40001", "40P01"}
+
+
+def is_concurrent_update(error: BaseException) -> bool:
+    # a lost version_number compare-and-swap, or postgres giving up on a
+    # REPEATABLE READ transaction (serialization failure or deadlock)
+    if isinstance(error, StaleDataError):
+        return True
+    return getattr(getattr(error, "orig", None), "pgcode", None) in SERIALIZATION_FAILURES
+
+
+_engine = None
+_engine_pid = None
+_default_session_factory = None
+_lock = threading.Lock()
+
+
+def default_session_factory() -> sessionmaker:
+    # built on first use and again in each forked child, so importing this
+    # module doesn't connect and workers never share pooled connections
+    global _engine, _engine_pid, _default_session_factory
+    with _lock:
+        if _engine_pid != os.getpid():
+            if _engine is not None:
+                _engine.dispose(close=False)
+            _engine = create_engine(
+                config.get_postgres_uri(),
+                isolation_level="REPEATABLE READ",
+                **config.get_db_pool_settings(),
+            )
+            _engine_pid = os.getpid()
+            _default_session_factory = sessionmaker(bind=_engine)
+        return _default_session_factory
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    # The session, repository and projection state live in thread-local
+    # storage, so one instance can be shared by every thread of a threaded
+    # server, each dispatch getting its own session.
+    def __init__(
+        self,
+        session_factory=None,
+        batches_loading: str | None = None,
+        allocations_loading: str | None = None,
+        cache: repository.ProductCache | None = None,
+    ):
+        # a misspelt strategy fails here rather than on first use
+        repository.loader(batches_loading)
+        repository.loader(allocations_loading)
         self.session_factory = session_factory
+        self.batches_loading = batches_loading
+        self.allocations_loading = allocations_loading
+        self.cache = cache
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        return self._local.session
+
+    @property
+    def products(self) -> repository.SqlAlchemyRepository:
+        return self._local.products
+
+    @property
+    def _projected(self) -> set[int]:
+        return self._local.projected
 
     def __enter__(self):
-        self.session = self.session_factory()
-        self.products = repository.SqlAlchemyRepository(self.session)
+        local = self._local
+        local.session = (self.session_factory or default_session_factory())()
+        if self.cache is not None:
+            # cached products must stay usable once the session is closed
+            local.session.expire_on_commit = False
+        local.products = repository.SqlAlchemyRepository(
+            local.session,
+            batches_loading=self.batches_loading,
+            allocations_loading=self.allocations_loading,
+            cache=self.cache,
+        )
+        local.projected = set()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        conflict = exc_value is not None and is_concurrent_update(exc_value)
+        if conflict:
+            # attributes can't be loaded once the flush has failed
+            states = map(inspect, self.products.seen)
+            skus = {state.identity[0] for state in states if state.identity}
+            skus |= self.products.swapped_skus
         self.session.rollback()
         self.session.close()
+        if conflict:
+            raise ConcurrencyError(skus) from exc_value
 
     def rollback(self):
         self.session.rollback()
 
     def _commit(self):  #(1)
+        if self.projections:
+            new_events = [e for e in self.peek_new_events() if id(e) not in self._projected]
+            for project in self.projections:
+                project(self.session, new_events)
+            self._projected.update(map(id, new_events))
         self.session.commit()
@@ -1,15 +1,168 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator
+
+from sqlalchemy import bindparam
 from sqlalchemy.sql import text
 
 from allocation.service_layer import unit_of_work
 
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+class AllocationsCache:
+    # Entries are dropped when an Allocated or Deallocated event for the
+    # order is handled, in this process or (through redis) another one; the
+    # TTL bounds how stale a missed invalidation can leave them.
+    def __init__(self, max_entries: int = 10_000, ttl: float = 30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()
+        self._invalidations = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, orderid: str) -> tuple[list[dict] | None, int]:
+        # the token lets put() refuse rows read before an invalidation
+        with self._lock:
+            expires, rows = self._entries.get(orderid, (0.0, None))
+            if rows is not None and expires > time.monotonic():
+                self._entries.move_to_end(orderid)
+                self.hits += 1
+                return rows, self._invalidations
+            self._entries.pop(orderid, None)
+            self.misses += 1
+            return None, self._invalidations
+
+    def put(self, orderid: str, rows: list[dict], token: int) -> None:
+        with self._lock:
+            if token != self._invalidations:
+                return
+            self._entries[orderid] = (time.monotonic() + self.ttl, rows)
+            self._entries.move_to_end(orderid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, orderid: str) -> None:
+        with self._lock:
+            self._invalidations += 1
+            self._entries.pop(orderid, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+
+
+def allocations(
+    orderid: str,
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    cache: AllocationsCache | None = None,
+):
+    if cache is not None:
+        rows, token = cache.get(orderid)
+        if rows is not None:
+            return rows
     with uow:
         results = uow.session.execute(
             text("SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid"),
             {"orderid": orderid}
         )
-    return [{"sku": sku, "batchref": batchref} for sku, batchref in results]
+    rows = [{"sku": sku, "batchref": batchref} for sku, batchref in results]
+    if cache is not None:
+        cache.put(orderid, rows, token)
+    return rows
+
+
+ALLOCATIONS_FOR_ORDERS = text(
+    "SELECT orderid, sku, batchref FROM allocations_view WHERE orderid IN :orderids"
+).bindparams(bindparam("orderids", expanding=True))
+
+
+def allocations_for_orders(
+    orderids: list[str],
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    cache: AllocationsCache | None = None,
+) -> dict[str, list[dict]]:
+    # one statement for every order the cache can't answer
+    found: dict[str, list[dict]] = {}
+    tokens: dict[str, int] = {}
+    for orderid in dict.fromkeys(orderids):
+        rows, token = cache.get(orderid) if cache is not None else (None, 0)
+        if rows is not None:
+            found[orderid] = rows
+        else:
+            tokens[orderid] = token
+    if tokens:
+        fetched: dict[str, list[dict]] = {orderid: [] for orderid in tokens}
+        with uow:
+            results = uow.session.execute(ALLOCATIONS_FOR_ORDERS, {"orderids": list(tokens)})
+            for orderid, sku, batchref in results:
+                fetched[orderid].append({"sku": sku, "batchref": batchref})
+        if cache is not None:
+            for orderid, rows in fetched.items():
+                cache.put(orderid, rows, tokens[orderid])
+        found.update(fetched)
+    return {orderid: found[orderid] for orderid in dict.fromkeys(orderids)}
+
+
+def stock(sku: str, uow: unit_of_work.SqlAlchemyUnitOfWork) -> dict | None:
+    with uow:
+        row = uow.session.execute(
+            text("SELECT purchased, allocated FROM stock_view WHERE sku = :sku"),
+            {"sku": sku}
+        ).first()
+    if row is None:
+        return None
+    purchased, allocated = row
+    return {
+        "sku": sku,
+        "purchased": purchased,
+        "allocated": allocated,
+        "available": purchased - allocated,
+    }
+
+
+def export_allocations(
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    sku: str | None = None,
+    batchref: str | None = None,
+    after: int = 0,
+    page_size: int = 10_000,
+) -> Iterator[dict]:
+    # keyset pages on the primary key, each streamed from a server-side
+    # cursor in its own short transaction, so neither memory nor the time a
+    # snapshot is held grows with the table
+    conditions = ["id > :after"]
+    params: dict = {"limit": page_size}
+    if sku is not None:
+        conditions.append("sku = :sku")
+        params["sku"] = sku
+    if batchref is not None:
+        conditions.append("batchref = :batchref")
+        params["batchref"] = batchref
+    query = text(
+        "SELECT id, orderid, sku, batchref FROM allocations_view"
+        f" WHERE {' AND '.join(conditions)} ORDER BY id LIMIT :limit"
+    )
+    while True:
+        rows = 0
+        with uow:
+            results = uow.session.execute(
+                query,
+                dict(params, after=after),
+                execution_options={"yield_per": min(page_size, 1000)},
+            )
+            for after, orderid, row_sku, row_batchref in results:
+                rows += 1
+                yield {"id": after, "orderid": orderid, "sku": row_sku, "batchref": row_batchref}
+        if rows < page_size:
+            return
 
 
 def allocation(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
@@ -19,3 +172,11 @@ def allocation(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
             {"orderid": orderid}
         )
     return [dict(r) for r in results]
+
+
+def sku_for_batch(batchref: str, uow: unit_of_work.SqlAlchemyUnitOfWork) -> str | None:
+    with uow:
+        return uow.session.execute(
+            text("SELECT sku FROM batches WHERE reference = :batchref"),
+            {"batchref": batchref}
+        ).scalar()
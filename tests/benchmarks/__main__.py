@@ -0,0 +1,9 @@
+import importlib
+import pkgutil
+
+import tests.benchmarks as package
+
+
+for module in pkgutil.iter_modules(package.__path__):
+    if module.name.startswith("bench_"):
+        importlib.import_module(f"{package.__name__}.{module.name}").main()
@@ -0,0 +1,30 @@
+from datetime import date, timedelta
+
+from allocation.domain import model
+from tests.benchmarks.common import report, timed
+
+SKU = "LONG-LIVED-SKU"
+
+
+def product_with_allocations(existing_allocations, batch_count=10):
+    batches = [
+        model.Batch(f"batch-{i}", SKU, 10**9, eta=date.today() + timedelta(days=i))
+        for i in range(batch_count)
+    ]
+    for i in range(existing_allocations):
+        batches[i % batch_count].allocate(model.OrderLine(f"old-{i}", SKU, 1))
+    return model.Product(SKU, batches)
+
+
+def main(allocations_per_run=1000):
+    rows = []
+    for existing in (100, 1_000, 10_000, 100_000):
+        product = product_with_allocations(existing)
+        lines = iter(model.OrderLine(f"new-{i}", SKU, 1) for i in range(10**9))
+        elapsed = timed(lambda: product.allocate(next(lines)), repeat=allocations_per_run)
+        rows.append((existing, f"{elapsed * 1e6:.1f}"))
+    report("Product.allocate vs existing allocations", rows, ["allocations", "us/allocate"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+from allocation import bootstrap
+from allocation.domain import commands
+from tests.benchmarks.common import InMemoryUnitOfWork, report, timed
+
+SKU = "ASYNC-BENCH-SKU"
+LATENCY = 0.002
+ALLOCATIONS = 200
+
+
+def sync_bus():
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=InMemoryUnitOfWork(LATENCY),
+        send_mail=lambda *args: time.sleep(LATENCY),
+        publish=lambda *args: time.sleep(LATENCY),
+    )
+
+
+def async_bus():
+    async def io(*args):
+        await asyncio.sleep(LATENCY)
+
+    return bootstrap.bootstrap_async(
+        start_orm=False, uow=InMemoryUnitOfWork(LATENCY), send_mail=io, publish=io
+    )
+
+
+def run_sync():
+    bus = sync_bus()
+    bus.handle(commands.CreateBatch("batch", SKU, ALLOCATIONS, None))
+    for i in range(ALLOCATIONS):
+        bus.handle(commands.Allocate(f"order-{i}", SKU, 1))
+
+
+def run_async():
+    bus = async_bus()
+
+    async def scenario():
+        await bus.handle(commands.CreateBatch("batch", SKU, ALLOCATIONS, None))
+        for i in range(ALLOCATIONS):
+            await bus.handle(commands.Allocate(f"order-{i}", SKU, 1))
+
+    asyncio.run(scenario())
+
+
+def main():
+    rows = []
+    for name, run in (("sync", run_sync), ("async", run_async)):
+        elapsed = timed(run)
+        rows.append((name, ALLOCATIONS, f"{elapsed:.2f}", f"{ALLOCATIONS / elapsed:,.0f}"))
+    report(
+        f"Allocate with {LATENCY * 1000:.0f}ms publish and read-model round trips",
+        rows,
+        ["bus", "allocations", "seconds", "allocations/s"],
+    )
+
+
+if __name__ == "__main__":
+    main()
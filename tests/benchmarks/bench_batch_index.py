@@ -0,0 +1,38 @@
+from datetime import date, timedelta
+
+from allocation.domain import model
+from tests.benchmarks.common import report, timed
+
+SKU = "MANY-BATCHES-SKU"
+
+
+def product_with_batches(batch_count, exhausted):
+    product = model.Product(SKU, batches=[])
+    for i in range(batch_count):
+        qty = 1 if i < exhausted else 10**9
+        product.add_batch(model.Batch(f"batch-{i}", SKU, qty, eta=date.today() + timedelta(days=i)))
+    for i in range(exhausted):
+        product.allocate(model.OrderLine(f"old-{i}", SKU, 1))
+    return product
+
+
+def main(allocations_per_run=1000):
+    rows = []
+    for batch_count in (10, 100, 1_000):
+        product = product_with_batches(batch_count, exhausted=batch_count // 2)
+        lines = iter(model.OrderLine(f"new-{i}", SKU, 1) for i in range(10**9))
+        elapsed = timed(lambda: product.allocate(next(lines)), repeat=allocations_per_run)
+        add = timed(
+            lambda: product.add_batch(model.Batch(f"late-{next(lines).orderid}", SKU, 1, eta=None)),
+            repeat=allocations_per_run,
+        )
+        rows.append((batch_count, f"{elapsed * 1e6:.1f}", f"{add * 1e6:.1f}"))
+    report(
+        "Product.allocate vs open batches (half exhausted)",
+        rows,
+        ["batches", "us/allocate", "us/add_batch"],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import io
+import json
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.entrypoints import bulk
+from allocation.service_layer import unit_of_work
+from tests.benchmarks.common import report, timed
+
+SKUS = 1_000
+
+
+def sqlite_bus():
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    orm.metadata.create_all(engine)
+    return bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        read_model_in_transaction=True,
+    )
+
+
+def ndjson_body(batches):
+    return b"".join(
+        json.dumps(dict(ref=f"batch-{i}", sku=f"SKU-{i % SKUS}", qty=100, eta=None)).encode() + b"\n"
+        for i in range(batches)
+    )
+
+
+def one_by_one(bus, batches):
+    for i in range(batches):
+        bus.handle(commands.CreateBatch(f"batch-{i}", f"SKU-{i % SKUS}", 100, None))
+
+
+def bulk_ingest(bus, body):
+    results = list(bulk.ingest_batches(bulk.iter_ndjson(io.BytesIO(body)), bus))
+    assert all(r["status"] == "created" for r in results)
+
+
+def main():
+    rows = []
+    for batches in (1_000, 10_000, 100_000):
+        body = ndjson_body(batches)
+        bus = sqlite_bus()
+        try:
+            bulk_seconds = timed(lambda: bulk_ingest(bus, body))
+        finally:
+            clear_mappers()
+        # one command per batch is too slow to run at full size
+        sample = min(batches, 2_000)
+        bus = sqlite_bus()
+        try:
+            single_seconds = timed(lambda: one_by_one(bus, sample)) * batches / sample
+        finally:
+            clear_mappers()
+        rows.append((
+            batches,
+            f"{single_seconds:.2f}",
+            f"{bulk_seconds:.2f}",
+            f"{batches / bulk_seconds:,.0f}",
+        ))
+    report(
+        "Loading batches into SQLite",
+        rows,
+        ["batches", "CreateBatch each (s)", "add_batches (s)", "bulk rows/s"],
+    )
+
+
+if __name__ == "__main__":
+    main()
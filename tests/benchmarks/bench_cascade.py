@@ -0,0 +1,30 @@
+import time
+
+from allocation.domain import commands
+from tests.benchmarks.common import in_memory_bus, report
+
+SKU = "CASCADING-SKU"
+
+
+def main():
+    rows = []
+    for allocations in (1_000, 10_000, 50_000):
+        bus = in_memory_bus()
+        bus.handle(commands.CreateBatch("shrinking", SKU, allocations, None))
+        bus.handle(commands.CreateBatch("spare", SKU, allocations, eta=None))
+        for i in range(allocations):
+            bus.handle(commands.Allocate(f"order-{i}", SKU, 1))
+
+        start = time.perf_counter()
+        results = bus.handle(commands.ChangeBatchQuantity("shrinking", 0))
+        elapsed = time.perf_counter() - start
+
+        # the command and BatchQuantityChanged, then for every line a
+        # Deallocated event, an Allocate command and an Allocated event
+        messages = 2 + 3 * (len(results) - 1)
+        rows.append((allocations, messages, f"{elapsed:.2f}", f"{messages / elapsed:,.0f}"))
+    report("ChangeBatchQuantity cascade", rows, ["allocations", "messages", "seconds", "messages/s"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+from tests.benchmarks.common import InMemoryUnitOfWork, report, timed
+
+# the read model's round trip for each command's events
+LATENCY = 0.001
+BATCHES = 20
+# a recount: every batch's quantity sent this many times in a burst
+UPDATES_PER_BATCH = 50
+
+
+def run(window):
+    skus_by_batchref = {f"batch-{i}": f"RECOUNT-{i}" for i in range(BATCHES)}
+    executor = bootstrap.bootstrap_sharded(
+        workers=4,
+        start_orm=False,
+        uow_factory=lambda: InMemoryUnitOfWork(LATENCY),
+        sku_for_batch=skus_by_batchref.get,
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+    )
+    for batchref, sku in skus_by_batchref.items():
+        executor.handle(commands.CreateBatch(batchref, sku, 100, None))
+    coalescer = redis_eventconsumer.Coalescer(executor, window=window)
+
+    def burst():
+        for i in range(UPDATES_PER_BATCH):
+            for batchref in skus_by_batchref:
+                coalescer.add(commands.ChangeBatchQuantity(batchref, 100 + i))
+        coalescer.flush()
+        executor.shutdown()
+
+    return timed(burst), coalescer
+
+
+def main():
+    rows = []
+    for window in (0, 0.05):
+        elapsed, coalescer = run(window)
+        rows.append((
+            f"{window * 1000:.0f}",
+            coalescer.received,
+            coalescer.dispatched,
+            f"{elapsed:.3f}",
+        ))
+    report(
+        f"Recount burst over {BATCHES} batches, {LATENCY * 1000:.0f}ms read-model round trip",
+        rows,
+        ["window (ms)", "received", "dispatched", "seconds"],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.sql import text
+
+from allocation import views
+from allocation.adapters import orm
+from allocation.service_layer import unit_of_work
+from tests.benchmarks.common import report
+
+
+def seeded_uow(rows):
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    orm.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            orm.allocations_view.insert(),
+            [dict(orderid=f"order-{i}", sku=f"sku-{i % 100}", batchref=f"batch-{i % 7}") for i in range(rows)],
+        )
+    return unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+
+
+def fetch_all(uow):
+    with uow:
+        return uow.session.execute(
+            text("SELECT id, orderid, sku, batchref FROM allocations_view")
+        ).all()
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    rows = []
+    for count in (10_000, 100_000, 500_000):
+        uow = seeded_uow(count)
+        for name, fn in (
+            ("fetch all", lambda: fetch_all(uow)),
+            ("export_allocations", lambda: sum(1 for _ in views.export_allocations(uow))),
+        ):
+            elapsed, peak = measure(fn)
+            rows.append((name, count, f"{elapsed:.2f}", f"{peak / 2**20:.2f}"))
+    report("Exporting allocations_view", rows, ["strategy", "rows", "seconds", "peak MiB"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import csv
+import io
+import tempfile
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.entrypoints import file_loader
+from allocation.service_layer import unit_of_work
+from tests.benchmarks.common import report, timed
+
+SKUS = 2_000
+BATCHES = 20_000
+ORDER_LINES = 5_000
+
+
+def batches_csv():
+    lines = ["ref,sku,qty,eta"]
+    lines += [f"batch-{i},SKU-{i % SKUS},100," for i in range(BATCHES)]
+    return "\n".join(lines) + "\n"
+
+
+def orders_csv():
+    lines = ["orderid,sku,qty"]
+    # two lines per order, for the same SKU
+    lines += [f"order-{i // 2},SKU-{i // 2 % SKUS},1" for i in range(ORDER_LINES)]
+    return "\n".join(lines) + "\n"
+
+
+def load(path, workers, batches, orders):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30})
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    kwargs = dict(
+        start_orm=True,
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        read_model_in_transaction=True,
+        retry_attempts=20,
+    )
+    if workers:
+        bus = bootstrap.bootstrap_sharded(
+            workers=workers,
+            uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+            **kwargs,
+        )
+    else:
+        bus = bootstrap.bootstrap(uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory), **kwargs)
+    progresses = []
+    try:
+        seconds = {
+            kind: timed(lambda: progresses.append(fn(csv.DictReader(io.StringIO(text)), bus)))
+            for kind, fn, text in (
+                ("batches", file_loader.load_batches, batches),
+                ("orders", file_loader.load_orders, orders),
+            )
+        }
+    finally:
+        if workers:
+            bus.shutdown()
+        clear_mappers()
+    assert not any(p.failed for p in progresses)
+    return seconds
+
+
+def main():
+    batches, orders = batches_csv(), orders_csv()
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in (0, 4):
+            seconds = load(Path(tmp) / f"load-{workers}.db", workers, batches, orders)
+            rows.append((
+                workers or "one bus",
+                f"{BATCHES / seconds['batches']:,.0f}",
+                f"{ORDER_LINES / seconds['orders']:,.0f}",
+            ))
+    # SQLite takes one writer at a time, so shards mostly queue for its lock
+    report(
+        "Loading CSV files into SQLite",
+        rows,
+        ["workers", "batches/s", "order lines/s"],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import time
+from datetime import date
+
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventpublisher
+from tests.benchmarks.common import InMemoryUnitOfWork, report, timed
+from tests.fake_broker import FakeBroker, FakePipeline
+
+# a round trip to redis
+LATENCY = 0.0005
+
+
+class SlowBroker(FakeBroker):
+    def publish(self, channel, payload):
+        time.sleep(LATENCY)
+        super().publish(channel, payload)
+
+    def pipeline(self, transaction=True):
+        return SlowPipeline(self)
+
+
+class SlowPipeline(FakePipeline):
+    def execute(self):
+        time.sleep(LATENCY)
+        super().execute()
+
+
+def reallocation_cascade(publish, lines):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=InMemoryUnitOfWork(),
+        send_mail=lambda *args: None,
+        publish=publish,
+    )
+    bus.handle(commands.CreateBatch("first", "CASCADE-SKU", lines, None))
+    bus.handle(commands.CreateBatch("second", "CASCADE-SKU", lines, date.today()))
+    for i in range(lines):
+        bus.handle(commands.Allocate(f"order-{i}", "CASCADE-SKU", 1))
+    # every line moves to the second batch, a Deallocated and an Allocated each
+    return lambda: bus.handle(commands.ChangeBatchQuantity("first", 0))
+
+
+def main():
+    broker = SlowBroker()
+    redis_eventpublisher._client = broker
+    rows = []
+    try:
+        for lines in (10, 100, 500):
+            publishers = {
+                "PUBLISH per event": redis_eventpublisher.publish,
+                "buffered pipeline": redis_eventpublisher.BufferedPublisher(),
+            }
+            results = []
+            for name, publish in publishers.items():
+                cascade = reallocation_cascade(publish, lines)
+                broker.published.clear()
+                results.append(timed(cascade))
+                assert len(broker.published) == 2 * lines
+            per_event, buffered = results
+            rows.append((lines * 2, f"{per_event * 1e3:.1f}", f"{buffered * 1e3:.1f}"))
+    finally:
+        redis_eventpublisher._client = None
+    report(
+        f"Publishing a reallocation cascade, {LATENCY * 1e3:.1f}ms round trip",
+        rows,
+        ["events", "PUBLISH per event (ms)", "buffered (ms)"],
+    )
+
+
+if __name__ == "__main__":
+    main()
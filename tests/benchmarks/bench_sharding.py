@@ -0,0 +1,52 @@
+from allocation import bootstrap
+from allocation.domain import commands
+from tests.benchmarks.common import InMemoryUnitOfWork, report, timed
+
+# the read model's round trip, the part that overlaps across shards
+LATENCY = 0.001
+SKUS = 32
+ALLOCATIONS_PER_SKU = 25
+
+
+def run(workers):
+    executor = bootstrap.bootstrap_sharded(
+        workers=workers,
+        start_orm=False,
+        uow_factory=lambda: InMemoryUnitOfWork(LATENCY),
+        sku_for_batch=lambda batchref: None,
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+    )
+    skus = [f"SHARD-BENCH-{i}" for i in range(SKUS)]
+    for sku in skus:
+        executor.handle(commands.CreateBatch(f"{sku}-batch", sku, ALLOCATIONS_PER_SKU, None))
+
+    def allocate():
+        futures = [
+            executor.submit(commands.Allocate(f"o{i}", sku, 1))
+            for i in range(ALLOCATIONS_PER_SKU)
+            for sku in skus
+        ]
+        for future in futures:
+            future.result()
+
+    elapsed = timed(allocate)
+    executor.shutdown()
+    return elapsed
+
+
+def main():
+    allocations = SKUS * ALLOCATIONS_PER_SKU
+    rows = []
+    for workers in (1, 2, 4, 8):
+        elapsed = run(workers)
+        rows.append((workers, allocations, f"{elapsed:.2f}", f"{allocations / elapsed:,.0f}"))
+    report(
+        f"Sharded allocation over {SKUS} SKUs, {LATENCY * 1000:.0f}ms read-model round trip",
+        rows,
+        ["workers", "allocations", "seconds", "allocations/s"],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import json
+import subprocess
+import sys
+
+from tests.benchmarks.common import report
+
+SCRIPT = """
+import json, time
+start = time.perf_counter()
+import {module} as entrypoint
+imported = time.perf_counter()
+{boot}
+booted = time.perf_counter()
+print(json.dumps([imported - start, booted - imported]))
+"""
+
+ENTRYPOINTS = {
+    "allocation.entrypoints.flask_app": "entrypoint.get_bus()",
+    "allocation.entrypoints.redis_eventconsumer": "entrypoint.bootstrap.bootstrap()",
+}
+
+
+def measure(module, boot, runs):
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", SCRIPT.format(module=module, boot=boot)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        timings.append(json.loads(output))
+    return [min(t[i] for t in timings) for i in (0, 1)]
+
+
+def main(runs=5):
+    rows = []
+    for module, boot in ENTRYPOINTS.items():
+        imported, booted = measure(module, boot, runs)
+        rows.append((module, f"{imported * 1e3:.1f}", f"{booted * 1e3:.1f}"))
+    report("Entry point startup (best of %d)" % runs, rows, ["module", "import ms", "boot ms"])
+
+
+if __name__ == "__main__":
+    main()
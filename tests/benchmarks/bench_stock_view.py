@@ -0,0 +1,66 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from allocation import views
+from allocation.adapters import orm
+from allocation.service_layer import unit_of_work
+from tests.benchmarks.common import report, timed
+
+SKU = "POPULAR-SKU"
+BATCHES = 10
+
+
+def seed(session_factory, allocations):
+    session = session_factory()
+    session.execute(orm.products.insert(), dict(sku=SKU, version_number=1))
+    session.execute(
+        orm.batches.insert(),
+        [dict(reference=f"batch-{i}", sku=SKU, _purchased_quantity=allocations) for i in range(BATCHES)],
+    )
+    session.execute(
+        orm.order_lines.insert(),
+        [dict(orderid=f"order-{i}", sku=SKU, qty=1) for i in range(allocations)],
+    )
+    session.execute(
+        orm.allocations.insert(),
+        [dict(orderline_id=i + 1, batch_id=i % BATCHES + 1) for i in range(allocations)],
+    )
+    session.execute(
+        orm.stock_view.insert(),
+        dict(sku=SKU, purchased=BATCHES * allocations, allocated=allocations),
+    )
+    session.commit()
+
+
+def available_from_aggregate(uow):
+    with uow:
+        product = uow.products.get(SKU)
+        return sum(b.available_quantity for b in product.batches)
+
+
+def main():
+    rows = []
+    for allocations in (100, 1_000, 10_000):
+        engine = create_engine("sqlite://", poolclass=StaticPool)
+        orm.metadata.create_all(engine)
+        session_factory = sessionmaker(bind=engine)
+        seed(session_factory, allocations)
+        uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+        orm.start_mappers()
+        try:
+            assert views.stock(SKU, uow)["available"] == available_from_aggregate(uow)
+            aggregate = timed(lambda: available_from_aggregate(uow), 20)
+            view = timed(lambda: views.stock(SKU, uow), 20)
+        finally:
+            clear_mappers()
+        rows.append((allocations, f"{aggregate * 1e3:.2f}", f"{view * 1e3:.3f}"))
+    report(
+        "Available quantity for one SKU",
+        rows,
+        ["allocations", "load Product (ms)", "stock_view (ms)"],
+    )
+
+
+if __name__ == "__main__":
+    main()
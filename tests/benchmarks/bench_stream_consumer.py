@@ -0,0 +1,59 @@
+import json
+
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.entrypoints import redis_streamconsumer
+from tests.benchmarks.common import InMemoryUnitOfWork, report, timed
+from tests.fake_broker import FakeBroker
+
+# the read model's round trip, the part that overlaps across shards
+LATENCY = 0.001
+BATCHES = 64
+MESSAGES = 2_000
+
+
+def run(workers, count):
+    skus_by_batchref = {f"batch-{i}": f"STREAM-BENCH-{i}" for i in range(BATCHES)}
+    executor = bootstrap.bootstrap_sharded(
+        workers=workers,
+        start_orm=False,
+        uow_factory=lambda: InMemoryUnitOfWork(LATENCY),
+        sku_for_batch=skus_by_batchref.get,
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+    )
+    for batchref, sku in skus_by_batchref.items():
+        executor.handle(commands.CreateBatch(batchref, sku, 100, None))
+    broker = FakeBroker()
+    consumer = redis_streamconsumer.StreamConsumer(
+        broker, executor, "bench", count=count, block_ms=0
+    )
+    consumer.create_group()
+    for i in range(MESSAGES):
+        payload = {"batchref": f"batch-{i % BATCHES}", "qty": 100 + i}
+        broker.xadd(redis_streamconsumer.STREAM, {"data": json.dumps(payload)})
+
+    def consume():
+        while consumer.poll():
+            pass
+
+    elapsed = timed(consume)
+    executor.shutdown()
+    assert consumer.handled + consumer.coalesced == MESSAGES
+    return elapsed
+
+
+def main():
+    rows = []
+    for workers, count in ((1, 1), (1, 100), (4, 1), (4, 100), (8, 100)):
+        elapsed = run(workers, count)
+        rows.append((workers, count, f"{elapsed:.2f}", f"{MESSAGES / elapsed:,.0f}"))
+    report(
+        f"Stream consumer over {BATCHES} batches, {LATENCY * 1000:.0f}ms read-model round trip",
+        rows,
+        ["workers", "COUNT", "seconds", "messages/s"],
+    )
+
+
+if __name__ == "__main__":
+    main()
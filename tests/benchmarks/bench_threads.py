@@ -0,0 +1,75 @@
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation import bootstrap, views
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from tests.benchmarks.common import report
+
+# a database round trip, sleeping without the GIL like a real driver
+LATENCY = 0.0005
+SKUS = 16
+REQUESTS = 800
+
+
+def run(threads, directory):
+    engine = create_engine(
+        f"sqlite:///{directory / f'threads-{threads}.db'}",
+        connect_args={"timeout": 30},
+        pool_size=threads,
+    )
+    orm.metadata.create_all(engine)
+    event.listen(engine, "before_cursor_execute", lambda *args: time.sleep(LATENCY))
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+    bus = bootstrap.bootstrap(
+        uow=uow,
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        retry_attempts=50,
+        retry_backoff=0.001,
+    )
+    try:
+        for i in range(SKUS):
+            bus.handle(commands.CreateBatch(f"batch-{i}", f"SKU-{i}", REQUESTS, None))
+
+        def serve(thread):
+            # storefront traffic, mostly polling with some checkouts
+            for i in range(thread, REQUESTS, threads):
+                if i % 4 == 0:
+                    bus.handle(commands.Allocate(f"order-{i}", f"SKU-{i % SKUS}", 1))
+                else:
+                    views.allocations(f"order-{i - i % 4}", uow)
+
+        workers = [threading.Thread(target=serve, args=(t,)) for t in range(threads)]
+        start = time.perf_counter()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return time.perf_counter() - start, sum(bus.retries.values())
+    finally:
+        clear_mappers()
+        engine.dispose()
+
+
+def main():
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for threads in (1, 2, 4, 8):
+            elapsed, retries = run(threads, Path(directory))
+            rows.append((threads, REQUESTS, f"{elapsed:.2f}", f"{REQUESTS / elapsed:,.0f}", retries))
+    report(
+        f"One shared bus under threaded requests, {LATENCY * 1000:.1f}ms per statement",
+        rows,
+        ["threads", "requests", "seconds", "requests/s", "retries"],
+    )
+
+
+if __name__ == "__main__":
+    main()
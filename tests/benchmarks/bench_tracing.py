@@ -0,0 +1,45 @@
+import time
+
+from allocation.domain import commands
+from allocation.service_layer import tracing
+from tests.benchmarks.common import in_memory_bus, report
+
+SKU = "TRACED-CASCADE-SKU"
+ALLOCATIONS = 10_000
+
+
+def run(tracer):
+    bus = in_memory_bus(tracer=tracer)
+    bus.handle(commands.CreateBatch("shrinking", SKU, ALLOCATIONS, None))
+    bus.handle(commands.CreateBatch("spare", SKU, ALLOCATIONS, None))
+    for i in range(ALLOCATIONS):
+        bus.handle(commands.Allocate(f"order-{i}", SKU, 1))
+    if tracer is not None:
+        tracer.spans.clear()
+
+    start = time.perf_counter()
+    bus.handle(commands.ChangeBatchQuantity("shrinking", 0))
+    return time.perf_counter() - start
+
+
+def main():
+    rows = []
+    for name, tracer in (
+        ("off", None),
+        ("spans", tracing.Tracer()),
+        ("spans + cProfile", tracing.Tracer(profile_sample_rate=1.0)),
+    ):
+        elapsed = run(tracer)
+        spans = len(tracer.spans) if tracer else 0
+        rows.append((name, spans, f"{elapsed:.2f}"))
+        if tracer is not None:
+            tracer.stop_watching_sql()
+    report(
+        f"Tracing a ChangeBatchQuantity that reallocates {ALLOCATIONS} lines",
+        rows,
+        ["tracing", "spans", "seconds"],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from allocation import bootstrap, views
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from tests.benchmarks.common import report, timed
+
+ORDERS = 10_000
+PAGE = 50
+
+
+def main():
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    orm.metadata.create_all(engine)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+    bus = bootstrap.bootstrap(
+        uow=uow,
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        read_model_in_transaction=True,
+    )
+    try:
+        bus.handle(commands.CreateBatch("batch", "HISTORY-SKU", ORDERS, None))
+        bus.handle(
+            commands.AllocateOrder("bulk", [("HISTORY-SKU", 1)] * ORDERS)
+        )
+        with engine.begin() as conn:
+            conn.exec_driver_sql(
+                "UPDATE allocations_view SET orderid = 'order-' || rowid"
+            )
+        page = [f"order-{i}" for i in range(1, PAGE + 1)]
+
+        one_by_one = timed(lambda: [views.allocations(o, uow) for o in page], 20)
+        batched = timed(lambda: views.allocations_for_orders(page, uow), 20)
+    finally:
+        clear_mappers()
+
+    report(
+        f"Allocations for a page of {PAGE} orders out of {ORDERS}",
+        [
+            ("one query per order", PAGE, f"{one_by_one * 1e3:.1f}"),
+            ("allocations_for_orders", 1, f"{batched * 1e3:.1f}"),
+        ],
+        ["lookup", "queries", "ms per page"],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from allocation import bootstrap, views
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from tests.benchmarks.common import report, timed
+
+ORDERS = 200
+POLLS_PER_ORDER = 20
+
+
+def run(cache):
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    orm.metadata.create_all(engine)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+    bus = bootstrap.bootstrap(
+        uow=uow,
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        allocations_cache=cache,
+    )
+    try:
+        bus.handle(commands.CreateBatch("batch", "POLLED-SKU", ORDERS, None))
+
+        def checkout_and_poll():
+            # the storefront polls each order straight after allocating it
+            for i in range(ORDERS):
+                bus.handle(commands.Allocate(f"order-{i}", "POLLED-SKU", 1))
+                for _ in range(POLLS_PER_ORDER):
+                    views.allocations(f"order-{i}", uow, cache)
+
+        return timed(checkout_and_poll)
+    finally:
+        clear_mappers()
+
+
+def main():
+    polls = ORDERS * POLLS_PER_ORDER
+    rows = []
+    for name, cache in (("off", None), ("on", views.AllocationsCache())):
+        elapsed = run(cache)
+        hit_rate = f"{cache.hits / polls:.0%}" if cache else ""
+        rows.append((name, polls, f"{elapsed:.2f}", hit_rate))
+    report(
+        f"Polling allocations for {ORDERS} orders after checkout",
+        rows,
+        ["cache", "polls", "seconds", "hit rate"],
+    )
+
+
+if __name__ == "__main__":
+    main()
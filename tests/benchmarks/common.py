@@ -0,0 +1,78 @@
+import time
+
+from allocation import bootstrap
+from allocation.adapters import repository
+from allocation.service_layer import unit_of_work
+
+
+def timed(fn, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def report(title, rows, headers):
+    print(f"\n{title}")
+    widths = [max(len(str(h)), *(len(str(r[i])) for r in rows)) for i, h in enumerate(headers)]
+    print("  ".join(str(h).rjust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(str(c).rjust(w) for c, w in zip(row, widths)))
+
+
+class InMemoryProductRepository(repository.AbstractProductRepository):
+    def __init__(self):
+        super().__init__()
+        self._products = {}
+        self._skus_by_batchref = {}
+
+    def _add(self, product):
+        self._products[product.sku] = product
+
+    def _get(self, sku):
+        return self._products.get(sku)
+
+    def _get_by_batchref(self, batchref):
+        for product in self._products.values():
+            for batch in product.batches:
+                self._skus_by_batchref.setdefault(batch.reference, product.sku)
+        return self._products.get(self._skus_by_batchref.get(batchref))
+
+
+class NullSession:
+    # stands in for the read model's SQL, optionally with a round trip
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def execute(self, *args, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class InMemoryUnitOfWork(unit_of_work.AbstractUnitOfWork):
+    def __init__(self, latency=0.0):
+        self.products = InMemoryProductRepository()
+        self.session = NullSession(latency)
+
+    def __enter__(self):
+        self.products.seen.clear()
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def _commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def in_memory_bus(uow=None, **kwargs):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow or InMemoryUnitOfWork(),
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        **kwargs,
+    )
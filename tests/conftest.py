@@ -6,7 +6,7 @@ from pathlib import Path
 import pytest
 import redis
 import requests
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from tenacity import retry, stop_after_delay
 
@@ -28,6 +28,25 @@ def sqlite_session_factory(in_memory_sqlite_db):
     yield sessionmaker(bind=in_memory_sqlite_db)
 
 
+@pytest.fixture
+def sqlite_file_session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+
+
+@pytest.fixture
+def sql_statements(in_memory_sqlite_db):
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(in_memory_sqlite_db, "before_cursor_execute", record)
+    yield statements
+    event.remove(in_memory_sqlite_db, "before_cursor_execute", record)
+
+
 @pytest.fixture
 def mappers():
     start_mappers()
@@ -78,11 +97,20 @@ def restart_api():
 
 @pytest.fixture
 def restart_redis_pubsub():
+    restart_consumer("redis_pubsub")
+
+
+@pytest.fixture
+def restart_redis_streams():
+    restart_consumer("redis_streams")
+
+
+def restart_consumer(service):
     wait_for_redis_to_come_up()
     if not shutil.which("docker-compose"):
         print("skipping restart, assumes running in container")
         return
     subprocess.run(
-        ["docker-compose", "restart", "-t", "0", "redis_pubsub"],
+        ["docker-compose", "restart", "-t", "0", service],
         check=True,
     )
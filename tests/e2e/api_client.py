@@ -1,3 +1,5 @@
+import json
+
 import requests
 
 from allocation import config
@@ -12,6 +14,22 @@ def post_to_add_batch(ref, sku, qty, eta):
     assert r.status_code == 201
 
 
+def post_to_add_batches(batches):
+    url = config.get_api_url()
+    body = ''.join(
+        json.dumps({'ref': ref, 'sku': sku, 'qty': qty, 'eta': eta}) + '\n'
+        for ref, sku, qty, eta in batches
+    )
+    r = requests.post(
+        f'{url}/add_batches',
+        data=body,
+        headers={'Content-Type': 'application/x-ndjson'},
+        stream=True,
+    )
+    assert r.status_code == 200
+    return [json.loads(line) for line in r.iter_lines() if line]
+
+
 def post_to_allocate(orderid, sku, qty, expect_success=True):
     url = config.get_api_url()
     r = requests.post(f'{url}/allocate', json={
@@ -22,7 +40,42 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
     return r
 
 
+def post_to_allocate_order(orderid, lines, expect_success=True):
+    url = config.get_api_url()
+    r = requests.post(f'{url}/allocate_order', json={
+        'orderid': orderid,
+        'lines': [{'sku': sku, 'qty': qty} for sku, qty in lines],
+    })
+    if expect_success:
+        assert r.status_code == 202
+    return r
+
+
 def get_allocation(orderid):
     url = config.get_api_url()
     r = requests.get(f'{url}/allocations/{orderid}')
     return r
+
+
+def get_allocations(orderids):
+    url = config.get_api_url()
+    return requests.get(f'{url}/allocations', params={'orderid': orderids})
+
+
+def get_stock(sku):
+    url = config.get_api_url()
+    return requests.get(f'{url}/stock/{sku}')
+
+
+def export_allocations(**filters):
+    url = config.get_api_url()
+    r = requests.get(f'{url}/export/allocations', params=filters, stream=True)
+    assert r.status_code == 200
+    return [json.loads(line) for line in r.iter_lines() if line]
+
+
+def get_metrics():
+    url = config.get_api_url()
+    r = requests.get(f'{url}/metrics')
+    assert r.status_code == 200
+    return r.text
@@ -36,3 +36,115 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = api_client.get_allocation(orderid)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_allocating_a_whole_order_returns_a_result_per_line():
+    orderid = random_orderid()
+    sku, othersku = random_sku(), random_sku("other")
+    batch, otherbatch = random_batchref(1), random_batchref(2)
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_add_batch(otherbatch, othersku, 5, None)
+
+    r = api_client.post_to_allocate_order(orderid, [(sku, 3), (othersku, 10)])
+
+    assert r.json() == [
+        {"sku": sku, "qty": 3, "batchref": batch},
+        {"sku": othersku, "qty": 10, "batchref": None},
+    ]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_400_message_for_an_order_with_a_repeated_line():
+    orderid, sku, batch = random_orderid(), random_sku(), random_batchref()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+
+    r = api_client.post_to_allocate_order(orderid, [(sku, 3), (sku, 3)], expect_success=False)
+
+    assert r.status_code == 400
+    assert r.json()["message"] == f"Duplicate line {sku} x 3"
+    assert api_client.get_allocation(orderid).status_code == 404
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_looks_up_allocations_for_several_orders_at_once():
+    sku, batch = random_sku(), random_batchref()
+    order1, order2, unknown = random_orderid(1), random_orderid(2), random_orderid(3)
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_allocate(order1, sku, 3)
+    api_client.post_to_allocate(order2, sku, 3)
+
+    r = api_client.get_allocations([order1, order2, unknown])
+
+    assert r.status_code == 200
+    assert r.json() == {
+        order1: [{"sku": sku, "batchref": batch}],
+        order2: [{"sku": sku, "batchref": batch}],
+        unknown: [],
+    }
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_adds_batches_in_bulk_with_a_result_per_row():
+    orderid = random_orderid()
+    sku, othersku = random_sku(), random_sku("other")
+    batch, otherbatch = random_batchref(1), random_batchref(2)
+
+    results = api_client.post_to_add_batches([
+        (batch, sku, 100, None),
+        (random_batchref(3), sku, -1, None),
+        (otherbatch, othersku, 100, "2011-01-02"),
+    ])
+
+    assert [r["status"] for r in results] == ["created", "error", "created"]
+    api_client.post_to_allocate(orderid, othersku, 3)
+    r = api_client.get_allocation(orderid)
+    assert r.json() == [{"sku": othersku, "batchref": otherbatch}]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_stock_shows_what_can_still_be_promised():
+    sku = random_sku()
+    api_client.post_to_add_batch(random_batchref(1), sku, 100, None)
+    api_client.post_to_add_batch(random_batchref(2), sku, 50, "2011-01-02")
+    api_client.post_to_allocate(random_orderid(), sku, 30)
+
+    r = api_client.get_stock(sku)
+
+    assert r.status_code == 200
+    assert r.json() == {"sku": sku, "purchased": 150, "allocated": 30, "available": 120}
+    assert api_client.get_stock(random_sku("unknown")).status_code == 404
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_exports_allocations_for_a_sku_as_ndjson():
+    sku, othersku, batch = random_sku(), random_sku("other"), random_batchref()
+    order1, order2 = random_orderid(1), random_orderid(2)
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_add_batch(random_batchref("other"), othersku, 100, None)
+    api_client.post_to_allocate(order1, sku, 3)
+    api_client.post_to_allocate(order2, othersku, 3)
+    api_client.post_to_allocate(order2, sku, 3)
+
+    rows = api_client.export_allocations(sku=sku)
+
+    assert [(r["orderid"], r["batchref"]) for r in rows] == [(order1, batch), (order2, batch)]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_metrics_count_handled_commands():
+    sku, batch = random_sku(), random_batchref()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_allocate(random_orderid(), sku, 3)
+
+    metrics = api_client.get_metrics()
+
+    assert 'allocation_handler_seconds_count{handler="allocate",message="Allocate"} 1' in metrics
+    assert 'allocation_handler_errors_total{handler="allocate",message="Allocate"} 0' in metrics
@@ -40,3 +40,24 @@ def test_change_batch_quantity_leading_to_reallocation():
             data = json.loads(messages[-1]["data"])
             assert data["orderid"] == orderid
             assert data["batchref"] == later_batch
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+@pytest.mark.usefixtures("restart_redis_streams")
+def test_change_batch_quantity_from_the_stream_leading_to_reallocation():
+    orderid, sku = random_orderid(), random_sku()
+    earlier_batch, later_batch = random_batchref("old"), random_batchref("newer")
+    api_client.post_to_add_batch(earlier_batch, sku, qty=10, eta="2011-01-01")
+    api_client.post_to_add_batch(later_batch, sku, qty=10, eta="2011-01-02")
+    api_client.post_to_allocate(orderid, sku, 10)
+
+    redis_client.add_to_stream(
+        "change_batch_quantity",
+        {"batchref": earlier_batch, "qty": 5},
+    )
+
+    for attempt in Retrying(stop=stop_after_delay(3), reraise=True):
+        with attempt:
+            response = api_client.get_allocation(orderid)
+            assert response.json()[0]["batchref"] == later_batch
@@ -0,0 +1,146 @@
+import threading
+import time
+from dataclasses import dataclass, field
+
+import redis
+
+
+class FakeBroker:
+    # the parts of the redis client our publishers and consumers use, kept
+    # in memory
+    def __init__(self):
+        self.published: list[tuple[str, str]] = []
+        self.fail_next_execute = False
+        self.streams: dict[str, FakeStream] = {}
+        self.condition = threading.Condition()
+
+    def publish(self, channel, payload):
+        self.published.append((channel, payload))
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def xadd(self, name, fields, id="*"):
+        with self.condition:
+            stream = self.streams.setdefault(name, FakeStream())
+            stream.sequence += 1
+            entry_id = f"{stream.sequence}-0"
+            stream.entries.append((entry_id, dict(fields)))
+            self.condition.notify_all()
+            return entry_id
+
+    def xlen(self, name):
+        with self.condition:
+            return len(self.streams.get(name, FakeStream()).entries)
+
+    def xgroup_create(self, name, groupname, id="$", mkstream=False):
+        with self.condition:
+            stream = self.streams.setdefault(name, FakeStream())
+            if groupname in stream.groups:
+                raise redis.ResponseError("BUSYGROUP Consumer Group name already exists")
+            stream.groups[groupname] = FakeGroup(
+                delivered=len(stream.entries) if id == "$" else 0
+            )
+            return True
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+        [(name, position)] = streams.items()
+        assert position == ">", "only new entries are read, pending ones are claimed"
+        deadline = time.monotonic() + (block or 0) / 1000
+        with self.condition:
+            stream = self.streams[name]
+            group = stream.groups[groupname]
+            while group.delivered == len(stream.entries):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self.condition.wait(remaining)
+            entries = stream.entries[group.delivered:][:count]
+            group.delivered += len(entries)
+            for entry_id, _ in entries:
+                group.pending[entry_id] = FakePending(consumername, time.monotonic(), 1)
+            return [[name, [(entry_id, dict(fields)) for entry_id, fields in entries]]]
+
+    def xack(self, name, groupname, *ids):
+        with self.condition:
+            pending = self.streams[name].groups[groupname].pending
+            return sum(pending.pop(entry_id, None) is not None for entry_id in ids)
+
+    def xautoclaim(self, name, groupname, consumername, min_idle_time, start_id="0-0", count=None):
+        with self.condition:
+            stream = self.streams[name]
+            pending = stream.groups[groupname].pending
+            now = time.monotonic()
+            claimed = []
+            for entry_id in sorted(pending, key=_id_key):
+                if _id_key(entry_id) < _id_key(start_id):
+                    continue
+                if count is not None and len(claimed) == count:
+                    return [entry_id, claimed, []]
+                owner = pending[entry_id]
+                if (now - owner.since) * 1000 >= min_idle_time:
+                    pending[entry_id] = FakePending(consumername, now, owner.times_delivered + 1)
+                    claimed.append((entry_id, dict(stream.fields(entry_id))))
+            return ["0-0", claimed, []]
+
+    def xpending_range(self, name, groupname, min, max, count, consumername=None):
+        with self.condition:
+            pending = self.streams[name].groups[groupname].pending
+            now = time.monotonic()
+            return [
+                dict(
+                    message_id=entry_id,
+                    consumer=pending[entry_id].consumer,
+                    time_since_delivered=int((now - pending[entry_id].since) * 1000),
+                    times_delivered=pending[entry_id].times_delivered,
+                )
+                for entry_id in sorted(pending, key=_id_key)
+                if _id_key(min) <= _id_key(entry_id) <= _id_key(max)
+                and consumername in (None, pending[entry_id].consumer)
+            ][:count]
+
+
+class FakePipeline:
+    def __init__(self, broker):
+        self.broker = broker
+        self.commands = []
+
+    def publish(self, channel, payload):
+        self.commands.append((channel, payload))
+
+    def execute(self):
+        if self.broker.fail_next_execute:
+            self.broker.fail_next_execute = False
+            raise ConnectionError("broker unavailable")
+        self.broker.published.extend(self.commands)
+        self.commands = []
+
+
+@dataclass
+class FakePending:
+    consumer: str
+    since: float
+    times_delivered: int
+
+
+@dataclass
+class FakeGroup:
+    delivered: int
+    pending: dict[str, FakePending] = field(default_factory=dict)
+
+
+@dataclass
+class FakeStream:
+    sequence: int = 0
+    entries: list[tuple[str, dict]] = field(default_factory=list)
+    groups: dict[str, FakeGroup] = field(default_factory=dict)
+
+    def fields(self, entry_id):
+        return next(fields for i, fields in self.entries if i == entry_id)
+
+
+def _id_key(entry_id):
+    if entry_id in ("-", "+"):
+        return (0, 0) if entry_id == "-" else (float("inf"), 0)
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
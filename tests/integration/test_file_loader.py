@@ -0,0 +1,96 @@
+import csv
+import io
+
+import pytest
+from sqlalchemy.sql import text
+
+from allocation import bootstrap
+from allocation.entrypoints import file_loader
+from allocation.service_layer import unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+BATCHES_CSV = """ref,sku,qty,eta
+lamp-1,LOADED-LAMP,10,
+lamp-2,LOADED-LAMP,10,2011-01-02
+rug-1,LOADED-RUG,5,
+bad-1,LOADED-RUG,lots,
+"""
+
+ORDERS_CSV = """orderid,sku,qty
+order1,LOADED-LAMP,8
+order2,LOADED-LAMP,8
+order2,LOADED-RUG,2
+order3,LOADED-RUG,0
+order4,LOADED-RUG,4
+order5,UNKNOWN-SKU,1
+"""
+
+
+def rows(text):
+    return csv.DictReader(io.StringIO(text))
+
+
+def loaded_allocations(session_factory):
+    session = session_factory()
+    return dict(
+        session.execute(
+            text(
+                "SELECT o.orderid || ':' || o.sku, b.reference FROM allocations AS a"
+                " JOIN order_lines AS o ON a.orderline_id = o.id"
+                " JOIN batches AS b ON a.batch_id = b.id"
+            )
+        ).all()
+    )
+
+
+@pytest.mark.parametrize("workers", [0, 3], ids=["one_bus", "sharded"])
+def test_loads_batches_then_replays_orders_in_file_order(sqlite_file_session_factory, workers):
+    kwargs = dict(
+        start_orm=False,
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        read_model_in_transaction=True,
+    )
+    if workers:
+        bus = bootstrap.bootstrap_sharded(
+            workers=workers,
+            uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+            **kwargs,
+        )
+    else:
+        bus = bootstrap.bootstrap(
+            uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory), **kwargs
+        )
+
+    batches = file_loader.load_batches(rows(BATCHES_CSV), bus, chunk_size=2)
+    orders = file_loader.load_orders(rows(ORDERS_CSV), bus, chunk_size=2)
+    if workers:
+        bus.shutdown()
+
+    assert (batches.read, batches.loaded, batches.failed) == (4, 3, 1)
+    assert (orders.read, orders.loaded, orders.failed, orders.unallocated) == (6, 4, 2, 1)
+    assert loaded_allocations(sqlite_file_session_factory) == {
+        "order1:LOADED-LAMP": "lamp-1",
+        "order2:LOADED-LAMP": "lamp-2",
+        "order2:LOADED-RUG": "rug-1",
+    }
+    [[purchased, allocated]] = sqlite_file_session_factory().execute(
+        text("SELECT purchased, allocated FROM stock_view WHERE sku = 'LOADED-RUG'")
+    )
+    assert (purchased, allocated) == (5, 2)
+
+
+def test_reports_progress_as_it_goes(caplog):
+    now = [0.0]
+    progress = file_loader.Progress("orders", report_every=2, clock=lambda: now[0])
+
+    with caplog.at_level("INFO", logger=file_loader.__name__):
+        for _ in range(4):
+            now[0] += 1
+            progress.update(loaded=10)
+
+    assert len(caplog.records) == 2
+    assert caplog.records[-1].getMessage() == (
+        "orders: 0 read, 40 loaded, 0 failed, 0 unallocated, 10 rows/s"
+    )
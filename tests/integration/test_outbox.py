@@ -0,0 +1,82 @@
+import functools
+import json
+
+import pytest
+from sqlalchemy.sql import text
+
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.entrypoints import outbox_relay, redis_eventpublisher
+from allocation.service_layer import unit_of_work
+from tests.fake_broker import FakeBroker
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+@pytest.fixture
+def published():
+    return []
+
+
+@pytest.fixture
+def outbox_bus(sqlite_session_factory, published):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        send_mail=lambda *args: None,
+        publish=lambda *args: published.append(args),
+        outbox=True,
+    )
+
+
+def outbox_rows(session_factory):
+    return list(session_factory().execute(text("SELECT sku, payload FROM outbox ORDER BY id")))
+
+
+def test_allocated_events_are_written_to_the_outbox_not_published(
+    outbox_bus, sqlite_session_factory, published
+):
+    outbox_bus.handle(commands.CreateBatch("b1", "CREAKY-BED", 100, None))
+    outbox_bus.handle(commands.Allocate("o1", "CREAKY-BED", 10))
+
+    [(sku, payload)] = outbox_rows(sqlite_session_factory)
+    assert sku == "CREAKY-BED"
+    assert json.loads(payload) == {
+        "orderid": "o1", "sku": "CREAKY-BED", "qty": 10, "batchref": "b1"
+    }
+    assert published == []
+
+
+def test_relay_publishes_in_order_and_empties_the_outbox(outbox_bus, sqlite_session_factory):
+    outbox_bus.handle(commands.CreateBatch("b1", "CREAKY-BED", 100, None))
+    for i in range(5):
+        outbox_bus.handle(commands.Allocate(f"o{i}", "CREAKY-BED", 1))
+    broker = FakeBroker()
+    publish_many = functools.partial(redis_eventpublisher.publish_many, client=broker)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+
+    assert outbox_relay.relay(uow, publish_many, batch_size=3) == 3
+    assert outbox_relay.relay(uow, publish_many, batch_size=3) == 2
+    assert outbox_relay.relay(uow, publish_many, batch_size=3) == 0
+
+    assert [json.loads(payload)["orderid"] for _, payload in broker.published] == [
+        "o0", "o1", "o2", "o3", "o4"
+    ]
+    assert {channel for channel, _ in broker.published} == {"line_allocated"}
+    assert outbox_rows(sqlite_session_factory) == []
+
+
+def test_relay_keeps_rows_when_the_broker_fails(outbox_bus, sqlite_session_factory):
+    outbox_bus.handle(commands.CreateBatch("b1", "CREAKY-BED", 100, None))
+    outbox_bus.handle(commands.Allocate("o1", "CREAKY-BED", 1))
+    broker = FakeBroker()
+    broker.fail_next_execute = True
+    publish_many = functools.partial(redis_eventpublisher.publish_many, client=broker)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+
+    with pytest.raises(ConnectionError):
+        outbox_relay.relay(uow, publish_many)
+    assert len(outbox_rows(sqlite_session_factory)) == 1
+
+    assert outbox_relay.relay(uow, publish_many) == 1
+    assert len(broker.published) == 1
@@ -0,0 +1,111 @@
+import pytest
+
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.service_layer import handlers, metrics, tracing, unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+def add_batches_with_allocations(uow, sku, batch_count):
+    for i in range(batch_count):
+        handlers.add_batch(commands.CreateBatch(f"batch{i}", sku, 10, None), uow)
+        handlers.allocate(commands.Allocate(f"order{i}", sku, 10), uow)
+
+
+def selects(statements):
+    return [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+
+
+@pytest.mark.parametrize("batch_count", [1, 10])
+def test_allocate_loads_product_in_three_selects(
+    sqlite_session_factory, sql_statements, batch_count
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    add_batches_with_allocations(uow, "HEAVY-ANVIL", batch_count)
+    handlers.add_batch(commands.CreateBatch("spare", "HEAVY-ANVIL", 10, None), uow)
+    sql_statements.clear()
+
+    handlers.allocate(commands.Allocate("new-order", "HEAVY-ANVIL", 1), uow)
+
+    # product, its batches and their allocations; then the order line,
+    # the allocation and the version number
+    assert len(selects(sql_statements)) == 3
+    assert len(sql_statements) == 6
+
+
+@pytest.mark.parametrize("batch_count", [1, 10])
+def test_change_batch_quantity_loads_product_in_three_selects(
+    sqlite_session_factory, sql_statements, batch_count
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    add_batches_with_allocations(uow, "HEAVY-ANVIL", batch_count)
+    sql_statements.clear()
+
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity("batch0", 5), uow)
+
+    # product, its batches and their allocations; then the batch quantity,
+    # the deallocated line and the version number
+    assert len(selects(sql_statements)) == 3
+    assert len(sql_statements) == 6
+
+
+def test_lazy_loading_can_be_chosen_per_unit_of_work(sqlite_session_factory, sql_statements):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, batches_loading="select", allocations_loading="select"
+    )
+    add_batches_with_allocations(uow, "HEAVY-ANVIL", 10)
+    sql_statements.clear()
+
+    handlers.allocate(commands.Allocate("new-order", "HEAVY-ANVIL", 1), uow)
+
+    assert len(selects(sql_statements)) == 2 + 10
+
+
+def test_unknown_loading_strategies_are_rejected(sqlite_session_factory):
+    with pytest.raises(ValueError, match="Unknown loading strategy 'selectinload'"):
+        unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, batches_loading="selectinload")
+
+
+def test_metrics_attribute_sql_statements_to_handlers(sqlite_session_factory, sql_statements):
+    recorded = metrics.Metrics()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        metrics=recorded,
+    )
+    try:
+        bus.handle(commands.CreateBatch("batch", "HEAVY-ANVIL", 10, None))
+        sql_statements.clear()
+        before = sum(s.statements for s in recorded.handlers.values())
+        bus.handle(commands.Allocate("order", "HEAVY-ANVIL", 1))
+    finally:
+        recorded.stop_watching_sql()
+
+    after = sum(s.statements for s in recorded.handlers.values())
+    assert after - before == len(sql_statements)
+    assert recorded.handlers["add_allocation_to_read_model", "Allocated"].statements == 1
+
+
+def test_tracer_attributes_sql_time_to_handler_spans(sqlite_session_factory, sql_statements):
+    tracer = tracing.Tracer()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        tracer=tracer,
+    )
+    try:
+        bus.handle(commands.CreateBatch("batch", "HEAVY-ANVIL", 10, None))
+        sql_statements.clear()
+        tracer.spans.clear()
+        bus.handle(commands.Allocate("order", "HEAVY-ANVIL", 1))
+    finally:
+        tracer.stop_watching_sql()
+
+    handler_spans = [s for s in tracer.spans if s.kind == "handler"]
+    assert sum(s.sql_statements for s in handler_spans) == len(sql_statements)
+    assert all(0 < s.sql_seconds <= s.duration for s in handler_spans if s.sql_statements)
@@ -0,0 +1,43 @@
+import pytest
+from sqlalchemy.sql import text
+
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+def test_shards_allocate_every_sku_against_one_database(sqlite_file_session_factory):
+    executor = bootstrap.bootstrap_sharded(
+        workers=3,
+        start_orm=False,
+        uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+    )
+    skus = [f"SHARDED-{i}" for i in range(6)]
+    for sku in skus:
+        executor.handle(commands.CreateBatch(f"{sku}-batch", sku, 5, None))
+    futures = [
+        executor.submit(commands.Allocate(f"o{i}", sku, 1))
+        for i in range(5)
+        for sku in skus
+    ]
+    for future in futures:
+        future.result()
+
+    # looked up in the batches table to find the shard
+    executor.handle(commands.ChangeBatchQuantity(f"{skus[0]}-batch", 3))
+    executor.shutdown()
+
+    session = sqlite_file_session_factory()
+    rows = dict(
+        session.execute(
+            text(
+                "SELECT b.sku, count(*) FROM allocations AS a"
+                " JOIN batches AS b ON a.batch_id = b.id GROUP BY b.sku"
+            )
+        ).all()
+    )
+    assert rows == {sku: 3 if sku == skus[0] else 5 for sku in skus}
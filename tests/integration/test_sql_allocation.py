@@ -0,0 +1,105 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import text
+
+from allocation import bootstrap
+from allocation.adapters.orm import metadata
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+SKUS = ["RED-CHAIR", "BLUE-CHAIR", "GREEN-CHAIR"]
+
+
+def random_workload(seed, length=200):
+    rng = random.Random(seed)
+    today = date.today()
+    allocated = []
+    for i in range(length):
+        sku = rng.choice(SKUS + ["UNKNOWN-CHAIR"] if i else SKUS)
+        if rng.random() < 0.2 and sku != "UNKNOWN-CHAIR":
+            eta = rng.choice([None, today + timedelta(days=rng.randint(0, 5))])
+            yield commands.CreateBatch(f"batch{i}", sku, rng.randint(5, 50), eta)
+        elif rng.random() < 0.2 and allocated:
+            # the same line again
+            yield rng.choice(allocated)
+        else:
+            allocated.append(commands.Allocate(f"order{i}", sku, rng.randint(1, 15)))
+            yield allocated[-1]
+
+
+def run(workload, sql_allocation):
+    engine = create_engine("sqlite:///:memory:")
+    metadata.create_all(engine)
+    published, mails = [], []
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+        send_mail=lambda *args: mails.append(args),
+        publish=lambda channel, event: published.append((channel, event)),
+        sql_allocation=sql_allocation,
+    )
+    results = []
+    for command in workload:
+        try:
+            results.append(bus.handle(command))
+        except handlers.InvalidSku as e:
+            results.append(str(e))
+    with engine.connect() as conn:
+        tables = {
+            table: sorted(conn.execute(text(query)))
+            for table, query in [
+                ("products", "SELECT sku, version_number FROM products"),
+                ("allocations", (
+                    "SELECT l.orderid, l.sku, l.qty, b.reference FROM allocations a"
+                    " JOIN order_lines l ON a.orderline_id = l.id"
+                    " JOIN batches b ON a.batch_id = b.id"
+                )),
+                ("allocations_view", "SELECT orderid, sku, batchref FROM allocations_view"),
+            ]
+        }
+    return results, published, mails, tables
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_sql_allocation_matches_the_domain_model(seed):
+    workload = list(random_workload(seed))
+
+    assert run(workload, sql_allocation=True) == run(workload, sql_allocation=False)
+
+
+def test_sql_allocation_prefers_warehouse_stock_then_earliest_eta():
+    today = date.today()
+    workload = [
+        commands.CreateBatch("later", "RED-CHAIR", 10, today + timedelta(days=2)),
+        commands.CreateBatch("sooner", "RED-CHAIR", 10, today),
+        commands.CreateBatch("in-stock", "RED-CHAIR", 5, None),
+        commands.Allocate("order1", "RED-CHAIR", 5),
+        commands.Allocate("order2", "RED-CHAIR", 5),
+        commands.Allocate("order3", "RED-CHAIR", 10),
+        commands.Allocate("order4", "RED-CHAIR", 10),
+    ]
+
+    results, _, mails, _ = run(workload, sql_allocation=True)
+
+    assert results[3:] == [["in-stock"], ["sooner"], ["later"], [None]]
+    assert len(mails) == 1
+
+
+def test_a_lost_version_swap_names_the_sku(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    handlers.add_batch(commands.CreateBatch("batch1", "RED-CHAIR", 10, None), uow)
+    line = model.OrderLine("order1", "RED-CHAIR", 1)
+
+    with pytest.raises(unit_of_work.ConcurrencyError, match="RED-CHAIR") as error:
+        with uow:
+            version_number, batch_id, _, _ = uow.products.find_batch_for(line)
+            # as if another transaction had allocated in between
+            uow.products.add_allocation(line, batch_id, version_number - 1)
+
+    assert error.value.skus == {"RED-CHAIR"}
@@ -0,0 +1,136 @@
+import json
+from concurrent.futures import Future
+
+import pytest
+from sqlalchemy.sql import text
+
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.entrypoints import redis_streamconsumer
+from allocation.service_layer import unit_of_work
+from tests.fake_broker import FakeBroker
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+@pytest.fixture
+def executor(sqlite_file_session_factory):
+    executor = bootstrap.bootstrap_sharded(
+        workers=3,
+        start_orm=False,
+        uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+    )
+    yield executor
+    executor.shutdown()
+
+
+@pytest.fixture
+def broker():
+    return FakeBroker()
+
+
+def consumer(broker, executor, name, **kwargs):
+    consumer = redis_streamconsumer.StreamConsumer(broker, executor, name, block_ms=0, **kwargs)
+    consumer.create_group()
+    return consumer
+
+
+def change_batch_quantity(broker, batchref, qty):
+    broker.xadd(redis_streamconsumer.STREAM, {"data": json.dumps({"batchref": batchref, "qty": qty})})
+
+
+def purchased_quantities(session_factory):
+    return dict(
+        session_factory().execute(text("SELECT reference, _purchased_quantity FROM batches")).all()
+    )
+
+
+def pending(broker):
+    return broker.xpending_range(
+        redis_streamconsumer.STREAM, redis_streamconsumer.GROUP, "-", "+", 100
+    )
+
+
+def test_handles_the_latest_entry_per_batchref_and_acks_them_all(broker, executor, sqlite_file_session_factory):
+    for i in range(4):
+        executor.handle(commands.CreateBatch(f"batch-{i}", f"STREAMED-{i}", 100, None))
+    reader = consumer(broker, executor, "reader", count=10)
+    change_batch_quantity(broker, "batch-0", 50)
+    for i in range(4):
+        change_batch_quantity(broker, f"batch-{i}", 10 + i)
+
+    assert reader.poll() == 5
+    assert reader.poll() == 0
+
+    assert purchased_quantities(sqlite_file_session_factory) == {
+        "batch-0": 10, "batch-1": 11, "batch-2": 12, "batch-3": 13
+    }
+    # batch-0's first quantity was replaced before it was applied
+    assert (reader.handled, reader.coalesced) == (4, 1)
+    assert pending(broker) == []
+
+
+def test_claims_entries_left_pending_by_a_dead_consumer(
+    broker, executor, sqlite_file_session_factory
+):
+    executor.handle(commands.CreateBatch("batch-1", "STREAMED-1", 100, None))
+    change_batch_quantity(broker, "batch-1", 10)
+    dead = consumer(broker, executor, "dead")
+    survivor = consumer(broker, executor, "survivor", claim_idle_ms=0)
+
+    # read, then gone before handling it
+    assert len(dead._read()) == 1
+    assert survivor.poll() == 1
+
+    assert survivor.claimed == 1
+    assert purchased_quantities(sqlite_file_session_factory) == {"batch-1": 10}
+    assert pending(broker) == []
+
+
+def test_retries_failures_then_moves_them_to_the_dead_letter_stream(broker, executor):
+    reader = consumer(broker, executor, "reader", claim_idle_ms=0, max_deliveries=2)
+    change_batch_quantity(broker, "no-such-batch", 10)
+    broker.xadd(redis_streamconsumer.STREAM, {"data": "not json"})
+
+    reader.poll()
+    [entry] = pending(broker)
+    assert entry["times_delivered"] == 1
+    assert broker.xlen(reader.dead_letters) == 1
+
+    reader.poll()
+    assert pending(broker) == []
+    assert broker.xlen(reader.dead_letters) == 2
+    assert (reader.handled, reader.failed, reader.dead_lettered) == (0, 3, 2)
+
+
+def test_a_reclaimed_entry_does_not_overwrite_a_newer_quantity(
+    broker, executor, sqlite_file_session_factory
+):
+    class FailingOnce:
+        def __init__(self, executor):
+            self.executor, self.failed = executor, False
+
+        def submit(self, command):
+            if self.failed:
+                return self.executor.submit(command)
+            self.failed = True
+            future = Future()
+            future.set_exception(ConnectionError("database unavailable"))
+            return future
+
+    executor.handle(commands.CreateBatch("batch-1", "STREAMED-1", 100, None))
+    reader = consumer(broker, FailingOnce(executor), "reader")
+    change_batch_quantity(broker, "batch-1", 50)
+    reader.poll()
+    change_batch_quantity(broker, "batch-1", 70)
+    reader.poll()
+    assert purchased_quantities(sqlite_file_session_factory) == {"batch-1": 70}
+
+    reader.claim_idle_ms = 0
+    assert reader.poll() == 1
+
+    assert purchased_quantities(sqlite_file_session_factory) == {"batch-1": 70}
+    assert pending(broker) == []
+    assert (reader.handled, reader.coalesced) == (1, 1)
@@ -1,10 +1,13 @@
+import threading
 import time
 import traceback
 
 import pytest
 from sqlalchemy.sql import text
 
-from allocation.domain import model
+from allocation import bootstrap
+from allocation.adapters import repository
+from allocation.domain import commands, model
 from allocation.service_layer import unit_of_work
 
 pytestmark = pytest.mark.usefixtures("mappers")
@@ -55,6 +58,149 @@ def test_uow_can_retrieve_a_batch_and_allocate_to_it(sqlite_session_factory):
     assert batchref == "batch1"
 
 
+def test_uow_rebuilds_allocated_quantity_of_loaded_batches(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "SHINY-DRESSER", 100, None)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        product = uow.products.get(sku="SHINY-DRESSER")
+        product.allocate(model.OrderLine("o1", "SHINY-DRESSER", 10))
+        product.allocate(model.OrderLine("o2", "SHINY-DRESSER", 15))
+        uow.commit()
+
+    with uow:
+        [batch] = uow.products.get(sku="SHINY-DRESSER").batches
+        assert batch.available_quantity == 75
+        batch.deallocate(model.OrderLine("o1", "SHINY-DRESSER", 10))
+        assert batch.available_quantity == 85
+
+
+def test_uow_reuses_cached_product_while_its_version_is_current(
+    sqlite_session_factory, sql_statements
+):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "DUSTY-MIRROR", 100, None)
+    session.commit()
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, cache=cache)
+    with uow:
+        uow.products.get(sku="DUSTY-MIRROR").allocate(model.OrderLine("o1", "DUSTY-MIRROR", 10))
+        uow.commit()
+    list(uow.collect_new_events())
+    sql_statements.clear()
+
+    with uow:
+        product = uow.products.get(sku="DUSTY-MIRROR")
+        product.allocate(model.OrderLine("o2", "DUSTY-MIRROR", 10))
+        uow.commit()
+
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert sql_statements[0].lstrip().startswith("SELECT products.version_number")
+    assert len([s for s in sql_statements if s.lstrip().startswith("SELECT")]) == 1
+    assert get_allocated_batch_ref(session, "o2", "DUSTY-MIRROR") == "batch1"
+
+
+def test_uow_reloads_cached_product_changed_elsewhere(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "DUSTY-MIRROR", 100, None)
+    session.commit()
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, cache=cache)
+    with uow:
+        uow.products.get(sku="DUSTY-MIRROR").allocate(model.OrderLine("o1", "DUSTY-MIRROR", 10))
+        uow.commit()
+    list(uow.collect_new_events())
+
+    session.execute(text("UPDATE batches SET _purchased_quantity = 50"))
+    session.execute(text("UPDATE products SET version_number = version_number + 1"))
+    session.commit()
+
+    with uow:
+        [batch] = uow.products.get(sku="DUSTY-MIRROR").batches
+        assert batch.available_quantity == 40
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_uow_does_not_cache_products_from_rolled_back_work(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "DUSTY-MIRROR", 100, None)
+    session.commit()
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, cache=cache)
+    with uow:
+        uow.products.get(sku="DUSTY-MIRROR").allocate(model.OrderLine("o1", "DUSTY-MIRROR", 10))
+
+    assert len(cache) == 0
+
+
+def test_uow_caches_products_only_once_their_events_are_collected(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "DUSTY-MIRROR", 100, None)
+    session.commit()
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, cache=cache)
+    with uow:
+        uow.products.get(sku="DUSTY-MIRROR").allocate(model.OrderLine("o1", "DUSTY-MIRROR", 10))
+        uow.commit()
+    assert len(cache) == 0
+
+    [event] = uow.collect_new_events()
+
+    assert event.orderid == "o1"
+    assert len(cache) == 1
+
+
+def test_units_of_work_sharing_a_cache_never_share_a_product(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "DUSTY-MIRROR", 100, None)
+    session.commit()
+    cache = repository.ProductCache()
+    uow, other_uow = (
+        unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, cache=cache) for _ in range(2)
+    )
+    line = model.OrderLine("o1", "DUSTY-MIRROR", 10)
+    with uow:
+        uow.products.get(sku="DUSTY-MIRROR").allocate(line)
+        uow.commit()
+    list(uow.collect_new_events())
+
+    with uow:
+        # already allocated, so no events to wait for
+        uow.products.get(sku="DUSTY-MIRROR").allocate(line)
+        uow.commit()
+        with other_uow:
+            [batch] = other_uow.products.get(sku="DUSTY-MIRROR").batches
+            assert batch.available_quantity == 90
+
+    assert cache.hits == 2
+
+
+def test_batch_quantities_follow_allocations_reloaded_after_an_expiry(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "DUSTY-MIRROR", 100, None)
+    session.commit()
+    product = session.query(model.Product).filter_by(sku="DUSTY-MIRROR").one()
+    [batch] = product.batches
+    assert batch.available_quantity == 100
+
+    other_session = sqlite_session_factory()
+    other = other_session.query(model.Product).filter_by(sku="DUSTY-MIRROR").one()
+    other.allocate(model.OrderLine("o1", "DUSTY-MIRROR", 30))
+    other_session.commit()
+    session.expire_all()
+
+    assert batch.available_quantity == 70
+    assert product.allocate(model.OrderLine("o2", "DUSTY-MIRROR", 75)) is None
+
+    session.refresh(batch)
+    other_session.execute(text("DELETE FROM allocations"))
+    other_session.commit()
+    session.refresh(batch, ["_allocations"])
+    assert batch.available_quantity == 100
+
+
 def test_rolls_back_uncommitted_work_by_default(sqlite_session_factory):
     uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
     with uow:
@@ -80,6 +226,104 @@ def test_rolls_back_on_error(sqlite_session_factory):
     assert rows == []
 
 
+def test_concurrent_updates_to_version_are_not_allowed(sqlite_file_session_factory):
+    session = sqlite_file_session_factory()
+    insert_batch(session, "batch1", "GLOSSY-TABLE", 100, None, product_version=3)
+    session.commit()
+    first = unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory)
+    second = unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory)
+
+    with pytest.raises(unit_of_work.ConcurrencyError, match="GLOSSY-TABLE"):
+        with first:
+            product = first.products.get(sku="GLOSSY-TABLE")
+            with second:
+                second.products.get(sku="GLOSSY-TABLE").allocate(
+                    model.OrderLine("order1", "GLOSSY-TABLE", 10)
+                )
+                second.commit()
+            product.allocate(model.OrderLine("order2", "GLOSSY-TABLE", 10))
+            first.commit()
+
+    [[version]] = session.execute(
+        text("SELECT version_number FROM products WHERE sku=:sku"),
+        dict(sku="GLOSSY-TABLE"),
+    )
+    assert version == 4
+    assert get_allocated_batch_ref(session, "order1", "GLOSSY-TABLE") == "batch1"
+    orders = session.execute(text("SELECT orderid FROM order_lines"))
+    assert [orderid for orderid, in orders] == ["order1"]
+
+
+def test_default_session_factory_is_built_once_per_process(monkeypatch):
+    factory = unit_of_work.default_session_factory()
+    assert unit_of_work.default_session_factory() is factory
+
+    monkeypatch.setattr(unit_of_work.os, "getpid", lambda: -1)
+    forked = unit_of_work.default_session_factory()
+    assert forked is not factory
+    assert forked.kw["bind"] is not factory.kw["bind"]
+
+
+def test_one_uow_gives_each_thread_its_own_session(sqlite_file_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory)
+    entered, release = threading.Barrier(2), threading.Event()
+    sessions = {}
+
+    def hold_a_session(name):
+        with uow:
+            sessions[name] = (uow.session, uow.products)
+            entered.wait()
+            release.wait(timeout=5)
+            sessions[name] += (uow.session,)
+
+    threads = [threading.Thread(target=hold_a_session, args=(n,)) for n in "ab"]
+    for t in threads:
+        t.start()
+    release.set()
+    for t in threads:
+        t.join()
+
+    # still their own after the other thread entered
+    for session, products, session_on_exit in sessions.values():
+        assert session_on_exit is session
+    assert sessions["a"][0] is not sessions["b"][0]
+    assert sessions["a"][1] is not sessions["b"][1]
+
+
+def test_a_shared_bus_survives_concurrent_dispatches(sqlite_file_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        retry_attempts=20,
+        retry_backoff=0.01,
+    )
+    skus = [f"THREADED-{i}" for i in range(4)]
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 1000, None))
+    exceptions = []
+
+    def allocate_many(thread):
+        try:
+            for i in range(15):
+                bus.handle(commands.Allocate(f"order-{thread}-{i}", skus[i % len(skus)], 1))
+        except Exception as e:
+            exceptions.append(e)
+
+    threads = [threading.Thread(target=allocate_many, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert exceptions == []
+    session = sqlite_file_session_factory()
+    [[allocated]] = session.execute(text("SELECT count(*) FROM allocations"))
+    [[viewed]] = session.execute(text("SELECT count(*) FROM allocations_view"))
+    assert allocated == viewed == 8 * 15
+
+
 def try_to_allocate(orderid, sku, exceptions):
     line = model.OrderLine(orderid, sku, 10)
     try:
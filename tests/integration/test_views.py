@@ -2,6 +2,7 @@ from datetime import date
 
 import pytest
 from sqlalchemy.orm import clear_mappers
+from sqlalchemy.sql import text
 
 from allocation import bootstrap, views
 from allocation.domain import commands
@@ -10,13 +11,14 @@ from allocation.service_layer import unit_of_work
 today = date.today()
 
 
-@pytest.fixture
-def sqlite_bus(sqlite_session_factory):
+@pytest.fixture(params=[False, True], ids=["after_commit", "in_transaction"])
+def sqlite_bus(request, sqlite_session_factory):
     bus = bootstrap.bootstrap(
         start_orm=True,
         uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
         send_mail=lambda *args: None,
         publish=lambda *args: None,
+        read_model_in_transaction=request.param,
     )
     yield bus
     clear_mappers()
@@ -36,3 +38,184 @@ def test_allocations_view(sqlite_bus):
         {"sku": "sku1", "batchref": "sku1batch"},
         {"sku": "sku2", "batchref": "sku2batch"},
     ]
+
+
+def test_in_transaction_projection_batches_inserts(sqlite_session_factory, sql_statements):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        read_model_in_transaction=True,
+    )
+    try:
+        bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
+        bus.handle(commands.CreateBatch("sku2batch", "sku2", 50, None))
+        sql_statements.clear()
+
+        bus.handle(commands.AllocateOrder("order1", [("sku1", 1), ("sku1", 2), ("sku2", 3)]))
+        inserts = [s for s in sql_statements if "allocations_view" in s]
+        results = views.allocations("order1", bus.uow)
+    finally:
+        clear_mappers()
+
+    assert len(inserts) == 1
+    assert sorted(results, key=lambda r: r["sku"]) == [
+        {"sku": "sku1", "batchref": "sku1batch"},
+        {"sku": "sku1", "batchref": "sku1batch"},
+        {"sku": "sku2", "batchref": "sku2batch"},
+    ]
+
+
+def test_cached_allocations_are_invalidated_by_allocated_events(
+    sqlite_session_factory, sql_statements
+):
+    cache = views.AllocationsCache()
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        allocations_cache=cache,
+    )
+    try:
+        bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
+        bus.handle(commands.CreateBatch("sku2batch", "sku2", 50, None))
+        bus.handle(commands.Allocate("order1", "sku1", 20))
+        assert views.allocations("order1", bus.uow, cache) == [
+            {"sku": "sku1", "batchref": "sku1batch"},
+        ]
+        sql_statements.clear()
+        views.allocations("order1", bus.uow, cache)
+        assert sql_statements == []
+
+        bus.handle(commands.Allocate("order1", "sku2", 20))
+        results = views.allocations("order1", bus.uow, cache)
+    finally:
+        clear_mappers()
+
+    assert results == [
+        {"sku": "sku1", "batchref": "sku1batch"},
+        {"sku": "sku2", "batchref": "sku2batch"},
+    ]
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_allocations_for_several_orders_in_one_statement(sqlite_bus, sql_statements):
+    sqlite_bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("sku2batch", "sku2", 50, None))
+    sqlite_bus.handle(commands.Allocate("order1", "sku1", 20))
+    sqlite_bus.handle(commands.Allocate("order1", "sku2", 20))
+    sqlite_bus.handle(commands.Allocate("order2", "sku1", 10))
+    cache = views.AllocationsCache()
+    views.allocations("order2", sqlite_bus.uow, cache)
+    sql_statements.clear()
+
+    results = views.allocations_for_orders(
+        ["order1", "order2", "order3"], sqlite_bus.uow, cache
+    )
+
+    assert results == {
+        "order1": [
+            {"sku": "sku1", "batchref": "sku1batch"},
+            {"sku": "sku2", "batchref": "sku2batch"},
+        ],
+        "order2": [{"sku": "sku1", "batchref": "sku1batch"}],
+        "order3": [],
+    }
+    # order2 came from the cache
+    [select] = [s for s in sql_statements if "allocations_view" in s]
+    assert select.count("?") == 2
+
+
+def test_stock_view_follows_batches_and_reallocations(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("batch1", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("batch2", "sku1", 50, today))
+    sqlite_bus.handle(commands.Allocate("order1", "sku1", 20))
+    sqlite_bus.handle(commands.Allocate("order2", "sku1", 20))
+    sqlite_bus.handle(commands.ChangeBatchQuantity("batch1", 25))
+    sqlite_bus.handle(commands.Allocate("order3", "sku1", 100))
+
+    # one of the orders moved to batch2 and order3 didn't fit anywhere
+    assert views.stock("sku1", sqlite_bus.uow) == {
+        "sku": "sku1", "purchased": 75, "allocated": 40, "available": 35,
+    }
+    assert views.stock("sku2", sqlite_bus.uow) is None
+    batchrefs = views.allocations_for_orders(["order1", "order2"], sqlite_bus.uow)
+    assert sorted(r["batchref"] for rows in batchrefs.values() for r in rows) == [
+        "batch1", "batch2",
+    ]
+
+
+def test_export_streams_allocations_in_keyset_pages(sqlite_bus, sql_statements):
+    sqlite_bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("sku2batch", "sku2", 50, None))
+    for i in range(5):
+        sqlite_bus.handle(commands.Allocate(f"order{i}", "sku1", 1))
+        sqlite_bus.handle(commands.Allocate(f"order{i}", "sku2", 1))
+    sql_statements.clear()
+
+    exported = list(views.export_allocations(sqlite_bus.uow, page_size=4))
+
+    assert [r["orderid"] for r in exported] == [f"order{i}" for i in range(5) for _ in "12"]
+    assert [r["id"] for r in exported] == sorted(r["id"] for r in exported)
+    pages = [s for s in sql_statements if "allocations_view" in s]
+    assert len(pages) == 3
+
+    only_sku2 = views.export_allocations(sqlite_bus.uow, sku="sku2", page_size=2)
+    assert [r["orderid"] for r in only_sku2] == [f"order{i}" for i in range(5)]
+    resumed = views.export_allocations(sqlite_bus.uow, batchref="sku1batch", after=exported[5]["id"])
+    assert [r["orderid"] for r in resumed] == ["order3", "order4"]
+
+
+def test_bulk_batches_create_products_and_stock_in_one_transaction(
+    sqlite_session_factory, sql_statements
+):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        send_mail=lambda *args: None,
+        publish=lambda *args: None,
+        read_model_in_transaction=True,
+    )
+    try:
+        bus.handle(commands.CreateBatch("rug-1", "BULK-RUG", 10, None))
+        with bus.uow:
+            [[version_before]] = bus.uow.session.execute(
+                text("SELECT version_number FROM products WHERE sku = 'BULK-RUG'")
+            )
+        sql_statements.clear()
+
+        bus.handle(commands.CreateBatches(
+            [commands.CreateBatch(f"lamp-{i}", "BULK-LAMP", 5, None) for i in range(50)]
+            + [commands.CreateBatch("rug-2", "BULK-RUG", 20, today)]
+        ))
+        statements = list(sql_statements)
+
+        with bus.uow:
+            versions = dict(bus.uow.session.execute(
+                text("SELECT sku, version_number FROM products ORDER BY sku")
+            ).all())
+        assert versions == {"BULK-LAMP": 1, "BULK-RUG": version_before + 1}
+        assert views.stock("BULK-LAMP", bus.uow)["purchased"] == 250
+        assert views.stock("BULK-RUG", bus.uow)["purchased"] == 30
+        bus.handle(commands.Allocate("order1", "BULK-RUG", 15))
+        assert views.allocations("order1", bus.uow) == [{"sku": "BULK-RUG", "batchref": "rug-2"}]
+    finally:
+        clear_mappers()
+
+    # a lookup, two product writes, the batches and the stock upsert
+    assert len([s for s in statements if not s.startswith(("BEGIN", "COMMIT"))]) <= 5
+
+
+def test_deallocating_one_of_an_orders_lines_for_a_sku_keeps_the_other(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "TWO-LINES", 11, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "TWO-LINES", 50, today))
+    sqlite_bus.handle(commands.Allocate("order1", "TWO-LINES", 5))
+    sqlite_bus.handle(commands.Allocate("order1", "TWO-LINES", 6))
+
+    # either line can be the one that moves, the other stays on b1
+    sqlite_bus.handle(commands.ChangeBatchQuantity("b1", 6))
+
+    rows = views.allocations("order1", sqlite_bus.uow)
+    assert sorted(r["batchref"] for r in rows) == ["b1", "b2"]
@@ -0,0 +1,120 @@
+import json
+import threading
+import time
+
+import redis
+
+from allocation.entrypoints import redis_eventconsumer
+from allocation.views import AllocationsCache
+
+ROWS = [{"sku": "LUMPY-CUSHION", "batchref": "b1"}]
+
+
+def test_hits_until_the_order_is_invalidated():
+    cache = AllocationsCache()
+    _, token = cache.get("o1")
+    cache.put("o1", ROWS, token)
+
+    assert cache.get("o1")[0] == ROWS
+    cache.invalidate("o1")
+    assert cache.get("o1")[0] is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_refuses_rows_read_before_an_invalidation():
+    cache = AllocationsCache()
+    _, token = cache.get("o1")
+    cache.invalidate("o1")
+    cache.put("o1", ROWS, token)
+
+    assert cache.get("o1")[0] is None
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    cache = AllocationsCache(ttl=10)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache.put("o1", ROWS, cache.get("o1")[1])
+
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert cache.get("o1")[0] is None
+    assert len(cache) == 0
+
+
+def test_evicts_least_recently_used_orders_beyond_max_entries():
+    cache = AllocationsCache(max_entries=2)
+    for orderid in ["o1", "o2"]:
+        cache.put(orderid, ROWS, cache.get(orderid)[1])
+    cache.get("o1")
+    cache.put("o3", ROWS, cache.get("o3")[1])
+
+    assert cache.get("o2")[0] is None
+    assert cache.get("o1")[0] == ROWS
+    assert cache.evictions == 1
+
+
+def test_invalidates_orders_from_other_processes_events():
+    class FakePubSub:
+        def listen(self):
+            yield {"data": json.dumps({"orderid": "o1", "sku": "LUMPY-CUSHION", "qty": 1})}
+
+    cache = AllocationsCache()
+    cache.put("o1", ROWS, cache.get("o1")[1])
+
+    redis_eventconsumer.invalidate_cached_allocations(FakePubSub(), cache)
+
+    assert cache.get("o1")[0] is None
+
+
+def test_resubscribes_and_drops_everything_cached_after_losing_redis():
+    subscribed = threading.Event()
+
+    class FakePubSub:
+        def __init__(self, messages):
+            self.messages = messages
+
+        def subscribe(self, *channels):
+            pass
+
+        def listen(self):
+            for m in self.messages:
+                if isinstance(m, Exception):
+                    raise m
+                yield m
+            subscribed.set()
+            threading.Event().wait()
+
+    class FakeRedis:
+        def __init__(self):
+            self.pubsubs = [
+                FakePubSub([redis.ConnectionError("connection reset")]),
+                FakePubSub([{"data": json.dumps({"orderid": "o1"})}]),
+            ]
+
+        def pubsub(self, ignore_subscribe_messages=False):
+            return self.pubsubs.pop(0)
+
+    cache = AllocationsCache()
+    for orderid in ["o1", "o2"]:
+        cache.put(orderid, ROWS, cache.get(orderid)[1])
+
+    redis_eventconsumer.listen_for_invalidations(cache, FakeRedis(), retry_wait=0)
+
+    assert subscribed.wait(timeout=1)
+    assert len(cache) == 0
+
+
+def test_flask_app_starts_the_listener_on_first_use_once_per_process(monkeypatch):
+    from allocation.entrypoints import flask_app
+
+    started = []
+    monkeypatch.setattr(flask_app, "_listener_pid", None)
+    monkeypatch.setattr(redis_eventconsumer, "listen_for_invalidations", started.append)
+
+    flask_app.get_allocations_cache()
+    flask_app.get_allocations_cache()
+    assert started == [flask_app._allocations_cache]
+
+    monkeypatch.setattr(flask_app, "_listener_pid", -1)
+    flask_app.get_allocations_cache()
+    assert len(started) == 2
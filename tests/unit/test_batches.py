@@ -54,3 +54,20 @@ def test_can_only_deallocate_allocated_lines():
     batch, unallocated_line = make_batch_and_line("DECORATIVE-TRINKET", 20, 2)
     batch.deallocate(unallocated_line)
     assert batch.available_quantity == 20
+
+
+def test_deallocate_one_returns_line_and_frees_its_quantity():
+    batch, line = make_batch_and_line("SHABBY-WARDROBE", 20, 2)
+    batch.allocate(line)
+    assert batch.deallocate_one() == line
+    assert batch.available_quantity == 20
+
+
+def test_allocated_quantity_tracks_many_allocations():
+    batch = Batch("batch-001", "LUMPY-BEANBAG", 100, eta=None)
+    lines = [OrderLine(f"order-{i}", "LUMPY-BEANBAG", 3) for i in range(10)]
+    for line in lines:
+        batch.allocate(line)
+    batch.deallocate(lines[0])
+    assert batch.allocated_quantity == 27
+    assert batch.allocated_quantity == sum(l.qty for l in batch._allocations)
@@ -0,0 +1,76 @@
+import io
+from datetime import date
+
+import pytest
+
+from allocation.domain import commands
+from allocation.entrypoints import bulk
+
+
+def test_reads_json_array_elements_across_small_reads():
+    body = b'[{"ref": "b1", "qty": 12345}, {"ref": "b2", "eta": "2011-01-02"} ,\n 67890 ]'
+
+    values = list(bulk.iter_json_array(io.BytesIO(body), read_size=3))
+
+    assert values == [{"ref": "b1", "qty": 12345}, {"ref": "b2", "eta": "2011-01-02"}, 67890]
+    assert list(bulk.iter_json_array(io.BytesIO(b" [ ] "))) == []
+
+
+def test_reads_numbers_split_across_reads_anywhere():
+    body = b'[1786.45, -3e10, 2E-5, 12, true, -0.5e+3]'
+
+    for read_size in range(1, len(body) + 1):
+        values = list(bulk.iter_json_array(io.BytesIO(body), read_size=read_size))
+        assert values == [1786.45, -3e10, 2e-5, 12, True, -500.0], read_size
+
+
+def test_malformed_json_array_fails_after_the_elements_before_it():
+    values = bulk.iter_json_array(io.BytesIO(b'[{"ref": "b1"} {"ref": "b2"}]'), read_size=4)
+
+    assert next(values) == {"ref": "b1"}
+    with pytest.raises(ValueError):
+        next(values)
+
+
+def test_reports_a_result_per_row_and_commits_per_chunk():
+    class RecordingBus:
+        def __init__(self):
+            self.handled = []
+
+        def handle(self, command):
+            self.handled.append(command)
+            return [None]
+
+    bus = RecordingBus()
+    rows = bulk.iter_ndjson(io.BytesIO(
+        b'{"ref": "b1", "sku": "LAMP", "qty": 10, "eta": null}\n'
+        b'not json\n'
+        b'\n'
+        b'{"ref": "b2", "sku": "LAMP", "qty": -1}\n'
+        b'{"ref": "b3", "sku": "RUG", "qty": 5, "eta": "2011-01-02"}\n'
+    ))
+
+    results = list(bulk.ingest_batches(rows, bus, chunk_size=2))
+
+    assert [r["status"] for r in results] == ["created", "error", "error", "created"]
+    assert results[1]["error"].startswith("invalid JSON")
+    assert results[2]["error"] == "qty must be a non-negative integer"
+    assert bus.handled == [
+        commands.CreateBatches([commands.CreateBatch("b1", "LAMP", 10, None)]),
+        commands.CreateBatches([commands.CreateBatch("b3", "RUG", 5, date(2011, 1, 2))]),
+    ]
+
+
+def test_rows_of_a_failed_chunk_are_reported_as_not_saved():
+    class FailingBus:
+        def handle(self, command):
+            raise RuntimeError("database unavailable")
+
+    rows = [{"ref": "b1", "sku": "LAMP", "qty": 10}, {"sku": "LAMP"}]
+
+    results = list(bulk.ingest_batches(rows, FailingBus()))
+
+    assert results == [
+        {"row": 0, "ref": "b1", "status": "error", "error": "not saved: database unavailable"},
+        {"row": 1, "status": "error", "error": "ref must be a non-empty string"},
+    ]
@@ -0,0 +1,70 @@
+from concurrent.futures import Future
+
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+
+
+class RecordingExecutor:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, command):
+        self.submitted.append(command)
+        future = Future()
+        future.set_result([None])
+        return future
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def change(ref, qty):
+    return commands.ChangeBatchQuantity(ref, qty)
+
+
+def test_keeps_the_latest_quantity_per_batch_until_the_window_closes():
+    executor, clock = RecordingExecutor(), FakeClock()
+    coalescer = redis_eventconsumer.Coalescer(executor, window=0.5, clock=clock)
+
+    coalescer.add(change("b1", 10))
+    clock.now += 0.25
+    coalescer.add(change("b2", 5))
+    coalescer.add(change("b1", 7))
+    coalescer.flush_due()
+    assert executor.submitted == []
+    assert coalescer.time_to_flush() == 0.25
+
+    # measured from the first message, so none waits longer than the window
+    clock.now += 0.25
+    coalescer.flush_due()
+
+    assert executor.submitted == [change("b1", 7), change("b2", 5)]
+    assert (coalescer.received, coalescer.coalesced, coalescer.dispatched) == (3, 1, 2)
+    assert coalescer.time_to_flush() is None
+
+
+def test_flushes_early_when_too_many_batches_are_waiting():
+    executor = RecordingExecutor()
+    coalescer = redis_eventconsumer.Coalescer(executor, window=10, max_pending=2, clock=FakeClock())
+
+    coalescer.add(change("b1", 1))
+    coalescer.add(change("b1", 2))
+    assert executor.submitted == []
+    coalescer.add(change("b2", 3))
+
+    assert executor.submitted == [change("b1", 2), change("b2", 3)]
+
+
+def test_no_window_dispatches_every_message_straight_away():
+    executor = RecordingExecutor()
+    coalescer = redis_eventconsumer.Coalescer(executor, window=0)
+
+    coalescer.add(change("b1", 1))
+    coalescer.add(change("b1", 2))
+
+    assert executor.submitted == [change("b1", 1), change("b1", 2)]
@@ -1,14 +1,19 @@
+import asyncio
+import json
 from datetime import date
 
+import pytest
+
 from allocation import bootstrap
 from allocation.adapters import repository
-from allocation.domain import commands
-from allocation.service_layer import messagebus, unit_of_work
+from allocation.domain import commands, events
+from allocation.entrypoints import redis_eventpublisher
+from allocation.service_layer import handlers, messagebus, metrics, tracing, unit_of_work
 
 
 class FakeProductRepository(repository.AbstractProductRepository):
-    def __init__(self, products):
-        super().__init__()
+    def __init__(self, products, cache=None):
+        super().__init__(cache)
         self._products = set(products)
 
     def _add(self, product):
@@ -23,10 +28,19 @@ class FakeProductRepository(repository.AbstractProductRepository):
             None,
         )
 
+    def _get_version_number(self, sku):
+        return next((p.version_number for p in self._products if p.sku == sku), None)
+
+    def _attach(self, product):
+        self._products.add(product)
+
+    def _detach(self, product):
+        pass
+
 
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
-    def __init__(self):
-        self.products = FakeProductRepository([])
+    def __init__(self, cache=None):
+        self.products = FakeProductRepository([], cache)
         self.committed = False
 
     def __enter__(self):
@@ -42,12 +56,13 @@ class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
         pass
 
 
-def bootstrap_test_app():
+def bootstrap_test_app(**kwargs):
     return bootstrap.bootstrap(
         start_orm=False,
         uow=FakeUnitOfWork(),
         send_mail=lambda *args: None,
         publish=lambda *args: None,
+        **kwargs,
     )
 
 
@@ -58,6 +73,391 @@ class TestAddBatch:
         assert bus.uow.products.get("CRUNCHY-ARMCHAIR") is not None
         assert bus.uow.committed
 
+    def test_in_bulk_for_new_and_existing_products(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "GARISH-RUG", 100, None))
+
+        bus.handle(commands.CreateBatches([
+            commands.CreateBatch("b2", "GARISH-RUG", 10, None),
+            commands.CreateBatch("b3", "DIM-LAMP", 20, None),
+        ]))
+
+        rug, lamp = bus.uow.products.get("GARISH-RUG"), bus.uow.products.get("DIM-LAMP")
+        assert [b.reference for b in rug.batches] == ["b1", "b2"]
+        assert [b.reference for b in lamp.batches] == ["b3"]
+
+
+class TestAllocateOrder:
+    def test_allocates_every_line_in_one_commit(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "SQUEAKY-CHAIR", 100, None))
+        bus.handle(commands.CreateBatch("b2", "BUMPY-RUG", 100, None))
+        bus.uow.committed = False
+
+        [batchrefs] = bus.handle(
+            commands.AllocateOrder(
+                "o1", [("SQUEAKY-CHAIR", 10), ("BUMPY-RUG", 5), ("SQUEAKY-CHAIR", 1)]
+            )
+        )
+
+        assert batchrefs == ["b1", "b2", "b1"]
+        assert bus.uow.committed
+        [batch] = bus.uow.products.get("SQUEAKY-CHAIR").batches
+        assert batch.available_quantity == 89
+
+    def test_returns_none_for_lines_out_of_stock(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "TINY-SOFA", 10, None))
+        [batchrefs] = bus.handle(
+            commands.AllocateOrder("o1", [("TINY-SOFA", 8), ("TINY-SOFA", 5)])
+        )
+        assert batchrefs == ["b1", None]
+
+    def test_errors_for_invalid_sku_without_committing(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "REAL-SKU", 100, None))
+        bus.uow.committed = False
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENT"):
+            bus.handle(commands.AllocateOrder("o1", [("REAL-SKU", 1), ("NONEXISTENT", 1)]))
+        assert not bus.uow.committed
+
+
+    def test_errors_for_a_repeated_line_without_committing(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "TWIN-LAMP", 100, None))
+        bus.uow.committed = False
+
+        with pytest.raises(handlers.DuplicateLine, match="Duplicate line TWIN-LAMP x 5"):
+            bus.handle(
+                commands.AllocateOrder("o1", [("TWIN-LAMP", 5), ("TWIN-LAMP", 1), ("TWIN-LAMP", 5)])
+            )
+        assert not bus.uow.committed
+        [batch] = bus.uow.products.get("TWIN-LAMP").batches
+        assert batch.available_quantity == 100
+
+    def test_allocating_an_allocated_line_again_changes_nothing(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "TWIN-LAMP", 100, None))
+        bus.handle(commands.AllocateOrder("o1", [("TWIN-LAMP", 5)]))
+        product = bus.uow.products.get("TWIN-LAMP")
+        version_number = product.version_number
+
+        [batchref] = bus.handle(commands.Allocate("o1", "TWIN-LAMP", 5))
+
+        assert batchref == "b1"
+        assert product.version_number == version_number
+        assert product.batches[0].available_quantity == 95
+
+class TestProductCache:
+    def test_products_are_cached_on_commit_and_reused(self):
+        cache = repository.ProductCache()
+        uow = FakeUnitOfWork(cache)
+        bus = bootstrap.bootstrap(
+            start_orm=False, uow=uow, send_mail=lambda *args: None, publish=lambda *args: None
+        )
+        bus.handle(commands.CreateBatch("b1", "SOGGY-CUSHION", 100, None))
+        uow.products.seen.clear()
+
+        bus.handle(commands.Allocate("o1", "SOGGY-CUSHION", 10))
+
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert len(cache) == 1
+
+
+class TestConcurrencyRetries:
+    def flaky_handler(self, failures):
+        calls = []
+
+        def handler(command):
+            calls.append(command)
+            if len(calls) <= failures:
+                raise unit_of_work.ConcurrencyError({command.sku})
+            return "batch1"
+
+        return handler
+
+    def test_retries_commands_that_lose_a_concurrent_update(self):
+        bus = bootstrap_test_app(retry_attempts=3, retry_backoff=0)
+        bus.command_handlers[commands.Allocate] = self.flaky_handler(failures=2)
+
+        results = bus.handle(commands.Allocate("o1", "POPULAR-LAMP", 1))
+
+        assert results == ["batch1"]
+        assert bus.conflicts == {"POPULAR-LAMP": 2}
+        assert bus.retries == {"POPULAR-LAMP": 2}
+
+    def test_gives_up_after_the_last_attempt(self):
+        bus = bootstrap_test_app(retry_attempts=2, retry_backoff=0)
+        bus.command_handlers[commands.Allocate] = self.flaky_handler(failures=5)
+
+        with pytest.raises(unit_of_work.ConcurrencyError):
+            bus.handle(commands.Allocate("o1", "POPULAR-LAMP", 1))
+        assert bus.conflicts == {"POPULAR-LAMP": 2}
+        assert bus.retries == {"POPULAR-LAMP": 1}
+
+    def test_exports_conflicts_and_retries_per_sku(self):
+        recorded = metrics.Metrics()
+        bus = bootstrap_test_app(retry_attempts=3, retry_backoff=0, metrics=recorded)
+        bus.command_handlers[commands.Allocate] = self.flaky_handler(failures=2)
+
+        bus.handle(commands.Allocate("o1", "POPULAR-LAMP", 1))
+        recorded.stop_watching_sql()
+
+        text = recorded.render()
+        assert 'allocation_concurrency_conflicts_total{sku="POPULAR-LAMP"} 2' in text
+        assert 'allocation_concurrency_retries_total{sku="POPULAR-LAMP"} 2' in text
+
+
+class TestMessageBus:
+    def test_nested_dispatch_does_not_drop_queued_messages(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "NESTED-SKU", 100, None))
+        handled = []
+
+        def handle_and_dispatch(event):
+            handled.append(event.orderid)
+            bus.handle(commands.CreateBatch(f"for-{event.orderid}", "OTHER-SKU", 1, None))
+
+        bus.event_handlers[events.Allocated] = [handle_and_dispatch]
+        bus.handle(commands.AllocateOrder("o1", [("NESTED-SKU", 1), ("NESTED-SKU", 2)]))
+
+        assert handled == ["o1", "o1"]
+        assert len(bus.uow.products.get("OTHER-SKU").batches) == 2
+
+
+class TestBufferedPublishing:
+    def bootstrap_buffered_test_app(self, batches, **kwargs):
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            send_mail=lambda *args: None,
+            publish=redis_eventpublisher.BufferedPublisher(batches.append, **kwargs),
+        )
+
+    def test_publishes_a_whole_cascade_in_one_batch_after_the_dispatch(self):
+        batches = []
+        bus = self.bootstrap_buffered_test_app(batches)
+        bus.handle(commands.CreateBatch("batch1", "BUFFERED-TABLE", 50, None))
+        bus.handle(commands.CreateBatch("batch2", "BUFFERED-TABLE", 50, date.today()))
+        bus.handle(commands.Allocate("order1", "BUFFERED-TABLE", 20))
+        bus.handle(commands.Allocate("order2", "BUFFERED-TABLE", 20))
+        assert len(batches) == 2
+
+        bus.handle(commands.ChangeBatchQuantity("batch1", 10))
+
+        [channels, payloads] = zip(*batches[-1])
+        assert channels == ("line_deallocated",) * 2 + ("line_allocated",) * 2
+        assert {json.loads(p)["batchref"] for p in payloads[2:]} == {"batch2"}
+        assert json.loads(batches[0][0][1]) == {
+            "orderid": "order1", "sku": "BUFFERED-TABLE", "qty": 20, "batchref": "batch1"
+        }
+
+    def test_sends_long_cascades_in_batches_of_max_batch(self):
+        batches = []
+        bus = self.bootstrap_buffered_test_app(batches, max_batch=2)
+        bus.handle(commands.CreateBatch("batch1", "BUFFERED-LAMP", 100, None))
+
+        bus.handle(commands.AllocateOrder("order1", [("BUFFERED-LAMP", q) for q in range(1, 6)]))
+
+        assert [len(b) for b in batches] == [2, 2, 1]
+
+    def test_sends_early_once_the_oldest_event_has_waited_flush_interval(self):
+        batches, now = [], [0.0]
+        publish = redis_eventpublisher.BufferedPublisher(
+            batches.append, flush_interval=0.5, clock=lambda: now[0]
+        )
+        allocated = [events.Allocated(f"o{i}", "BUFFERED-VASE", 1, "b1") for i in range(3)]
+
+        publish("line_allocated", allocated[0])
+        now[0] += 0.25
+        publish("line_allocated", allocated[1])
+        assert batches == []
+        now[0] += 0.25
+        publish("line_allocated", allocated[2])
+
+        assert [len(b) for b in batches] == [3]
+
+    def test_a_failed_flush_does_not_fail_the_dispatch(self):
+        def unavailable(messages):
+            raise ConnectionError("broker unavailable")
+
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            send_mail=lambda *args: None,
+            publish=redis_eventpublisher.BufferedPublisher(unavailable),
+        )
+        bus.handle(commands.CreateBatch("batch1", "BUFFERED-RUG", 100, None))
+
+        assert bus.handle(commands.Allocate("order1", "BUFFERED-RUG", 1)) == ["batch1"]
+
+
+class TestAsyncMessageBus:
+    def bootstrap_async_test_app(self, published, mails):
+        async def publish(channel, event):
+            published.append(event)
+
+        async def send_mail(*args):
+            mails.append(args)
+
+        return bootstrap.bootstrap_async(
+            start_orm=False, uow=FakeUnitOfWork(), send_mail=send_mail, publish=publish
+        )
+
+    def test_awaits_async_publish_and_send_mail(self):
+        published, mails = [], []
+        bus = self.bootstrap_async_test_app(published, mails)
+
+        async def scenario():
+            await bus.handle(commands.CreateBatch("b1", "ASYNC-SKU", 10, None))
+            return await bus.handle(
+                commands.AllocateOrder("o1", [("ASYNC-SKU", 6), ("ASYNC-SKU", 5)])
+            )
+
+        [batchrefs] = asyncio.run(scenario())
+
+        assert batchrefs == ["b1", None]
+        assert [e.orderid for e in published] == ["o1"]
+        assert mails == [("stock@made.com", "Out of stock for ASYNC-SKU")]
+
+    def test_runs_awaitables_for_one_event_concurrently(self):
+        bus = self.bootstrap_async_test_app([], [])
+        first, second = asyncio.Event(), asyncio.Event()
+
+        async def wait_for_each_other(mine, other):
+            mine.set()
+            await asyncio.wait_for(other.wait(), timeout=1)
+
+        bus.event_handlers[events.Allocated] = [
+            lambda event: wait_for_each_other(first, second),
+            lambda event: wait_for_each_other(second, first),
+        ]
+
+        async def scenario():
+            await bus.handle(commands.CreateBatch("b1", "ASYNC-SKU", 10, None))
+            await bus.handle(commands.Allocate("o1", "ASYNC-SKU", 1))
+
+        asyncio.run(scenario())
+        assert first.is_set() and second.is_set()
+
+
+class TestShardedExecutor:
+    def bootstrap_sharded_test_app(self, skus_by_batchref):
+        return bootstrap.bootstrap_sharded(
+            workers=4,
+            start_orm=False,
+            uow_factory=FakeUnitOfWork,
+            sku_for_batch=skus_by_batchref.get,
+            send_mail=lambda *args: None,
+            publish=lambda *args: None,
+        )
+
+    def test_routes_batch_commands_to_the_shard_of_their_sku(self):
+        executor = self.bootstrap_sharded_test_app({"b1": "SHARDED-SKU"})
+        executor.handle(commands.CreateBatch("b1", "SHARDED-SKU", 10, None))
+
+        shard = executor.shard_for(commands.Allocate("o1", "SHARDED-SKU", 1))
+        assert executor.shard_for(commands.ChangeBatchQuantity("b1", 5)) == shard
+        assert executor.handle(commands.Allocate("o1", "SHARDED-SKU", 1)) == ["b1"]
+        executor.handle(commands.ChangeBatchQuantity("b1", 5))
+
+        [product] = executor.buses[shard].uow.products._products
+        assert product.batches[0].available_quantity == 4
+        executor.shutdown()
+
+    def test_keeps_submission_order_within_each_sku(self):
+        skus = [f"SKU-{i}" for i in range(8)]
+        executor = self.bootstrap_sharded_test_app({})
+        for sku in skus:
+            executor.submit(commands.CreateBatch(f"{sku}-batch", sku, 10, None))
+        futures = {
+            sku: [executor.submit(commands.Allocate(f"o{i}", sku, 1)) for i in range(15)]
+            for sku in skus
+        }
+
+        for sku in skus:
+            results = [f.result() for f in futures[sku]]
+            assert results == [[f"{sku}-batch"]] * 10 + [[None]] * 5
+        executor.shutdown()
+
+
+class TestMetrics:
+    def test_records_calls_errors_and_queue_depth_per_handler(self):
+        recorded = metrics.Metrics()
+        bus = bootstrap_test_app(metrics=recorded)
+        bus.handle(commands.CreateBatch("b1", "MEASURED-SKU", 10, None))
+        bus.handle(commands.Allocate("o1", "MEASURED-SKU", 1))
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o2", "UNKNOWN-SKU", 1))
+        recorded.stop_watching_sql()
+
+        allocate = recorded.handlers["allocate", "Allocate"]
+        assert allocate.latency.count == 2
+        assert allocate.errors == 1
+        assert recorded.handlers["publish_allocated_event", "Allocated"].latency.count == 1
+        # three commands, BatchCreated and Allocated
+        assert recorded.queue_depth.count == 5
+        assert recorded.commit_latency.count == 2
+
+        text = recorded.render()
+        assert 'allocation_handler_seconds_count{handler="allocate",message="Allocate"} 2' in text
+        assert 'allocation_handler_errors_total{handler="allocate",message="Allocate"} 1' in text
+        assert 'allocation_bus_queue_depth_bucket{le="+Inf"} 5' in text
+
+
+class TestTracing:
+    def test_records_the_cascade_of_a_batch_quantity_change_as_a_tree(self):
+        tracer = tracing.Tracer(profile_sample_rate=1.0, profile_threshold=0.0)
+        bus = bootstrap_test_app(tracer=tracer)
+        bus.handle(commands.CreateBatch("b1", "TRACED-SKU", 10, None))
+        bus.handle(commands.CreateBatch("b2", "TRACED-SKU", 10, None))
+        bus.handle(commands.Allocate("o1", "TRACED-SKU", 10))
+        tracer.spans.clear()
+
+        bus.handle(commands.ChangeBatchQuantity("b1", 5))
+        tracer.stop_watching_sql()
+
+        by_id = {s.id: s for s in tracer.spans}
+
+        def path(span):
+            names = []
+            while span is not None:
+                names.append(span.name)
+                span = by_id.get(span.parent_id)
+            return list(reversed(names))
+
+        assert {tuple(path(s)) for s in tracer.spans} >= {
+            ("ChangeBatchQuantity", "change_batch_quantity", "Allocate", "allocate"),
+            (
+                "ChangeBatchQuantity", "change_batch_quantity", "Allocate", "allocate",
+                "Allocated", "publish_allocated_event",
+            ),
+        }
+        [profile] = [p for p in tracer.profiles if "ChangeBatchQuantity" in p["message"]]
+        assert "function calls" in profile["stats"]
+
+        trace = json.loads(tracer.to_chrome_trace())
+        assert {e["name"] for e in trace["traceEvents"]} >= {"ChangeBatchQuantity", "Allocated"}
+        assert all(e["ph"] == "X" for e in trace["traceEvents"])
+        assert len(json.loads(tracer.to_json())["spans"]) == len(tracer.spans)
+
+    def test_links_a_nested_dispatch_to_the_handler_that_made_it(self):
+        tracer = tracing.Tracer()
+        bus = bootstrap_test_app(tracer=tracer)
+        bus.handle(commands.CreateBatch("b1", "NESTED-SKU", 100, None))
+
+        def nested(event):
+            bus.handle(commands.Allocate("nested-order", event.sku, 1))
+
+        bus.event_handlers[events.Allocated] = [nested]
+        bus.handle(commands.Allocate("o1", "NESTED-SKU", 1))
+        tracer.stop_watching_sql()
+
+        handler_span = next(s for s in tracer.spans if s.name == "nested")
+        [nested_command] = [s for s in tracer.spans if s.parent_id == handler_span.id]
+        assert nested_command.name == "Allocate"
+
 
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
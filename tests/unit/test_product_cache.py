@@ -0,0 +1,39 @@
+from allocation.adapters.repository import ProductCache
+from allocation.domain import model
+
+
+def make_product(sku, batch_count=1, version_number=1):
+    batches = [model.Batch(f"{sku}-{i}", sku, 100, eta=None) for i in range(batch_count)]
+    return model.Product(sku, batches, version_number=version_number)
+
+
+def test_checkout_hits_only_for_current_version():
+    cache = ProductCache()
+    product = make_product("RICKETY-SHELF", version_number=3)
+    cache.put(product)
+
+    assert cache.checkout("RICKETY-SHELF", 3) is product
+    assert cache.checkout("RICKETY-SHELF", 3) is None
+    cache.put(product)
+    assert cache.checkout("RICKETY-SHELF", 4) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_evicts_least_recently_used_products_beyond_max_products():
+    cache = ProductCache(max_products=2)
+    for sku in ["A", "B", "C"]:
+        cache.put(make_product(sku))
+
+    assert cache.checkout("A", 1) is None
+    assert cache.checkout("C", 1) is not None
+    assert cache.evictions == 1
+
+
+def test_evicts_products_beyond_max_objects():
+    cache = ProductCache(max_objects=10)
+    cache.put(make_product("SMALL", batch_count=2))
+    cache.put(make_product("LARGE", batch_count=7))
+
+    assert len(cache) == 1
+    assert cache.objects == 8
+    assert cache.evictions == 1
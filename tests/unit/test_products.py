@@ -1,6 +1,6 @@
 from datetime import date, timedelta
 
-from allocation.domain import model, events
+from allocation.domain import commands, model, events
 
 
 today = date.today()
@@ -53,6 +53,42 @@ def test_increments_version_number():
     assert product.version_number == 8
 
 
+def test_allocate_many_increments_version_number_once():
+    product = model.Product(
+        sku="SCANDI-PEN", batches=[model.Batch("b1", "SCANDI-PEN", 100, eta=None)]
+    )
+    product.version_number = 7
+    lines = [model.OrderLine(f"order{i}", "SCANDI-PEN", 10) for i in range(3)]
+
+    assert product.allocate_many(lines) == ["b1", "b1", "b1"]
+    assert product.version_number == 8
+    assert [e.orderid for e in product.events] == ["order0", "order1", "order2"]
+
+
+def test_allocating_a_line_again_does_not_add_it_twice():
+    batch = model.Batch("b1", "SCANDI-PEN", 100, eta=None)
+    product = model.Product(sku="SCANDI-PEN", batches=[batch], version_number=7)
+    line = model.OrderLine("order1", "SCANDI-PEN", 10)
+    product.allocate(line)
+
+    assert product.allocate(line) == "b1"
+    assert batch.available_quantity == 90
+    assert product.version_number == 8
+    assert len(product.events) == 1
+
+
+def test_allocating_a_line_again_finds_it_in_a_batch_that_is_now_full():
+    full = model.Batch("b1", "SCANDI-PEN", 10, eta=None)
+    other = model.Batch("b2", "SCANDI-PEN", 100, eta=None)
+    product = model.Product(sku="SCANDI-PEN", batches=[full, other])
+    line = model.OrderLine("order1", "SCANDI-PEN", 10)
+
+    assert product.allocate(line) == "b1"
+    assert product.allocate(line) == "b1"
+    assert other.available_quantity == 100
+    assert len(product.events) == 1
+
+
 def test_records_out_of_stock_event_if_cannot_allocate():
     batch = model.Batch("batch1", "SMALL-FORK", 10, eta=today)
     product = model.Product(sku="SMALL-FORK", batches=[batch])
@@ -61,3 +97,50 @@ def test_records_out_of_stock_event_if_cannot_allocate():
     allocation = product.allocate(model.OrderLine("order2", "SMALL-FORK", 1))
     assert product.events[-1] == events.OutOfStock(sku="SMALL-FORK")
     assert allocation is None
+
+
+def test_allocates_to_batches_added_later_in_eta_order():
+    product = model.Product(sku="GAUDY-LAMP", batches=[])
+    product.add_batch(model.Batch("slow-batch", "GAUDY-LAMP", 100, eta=later))
+    product.allocate(model.OrderLine("order1", "GAUDY-LAMP", 10))
+    product.add_batch(model.Batch("speedy-batch", "GAUDY-LAMP", 100, eta=today))
+    product.add_batch(model.Batch("in-stock-batch", "GAUDY-LAMP", 100, eta=None))
+
+    allocation = product.allocate(model.OrderLine("order2", "GAUDY-LAMP", 10))
+
+    assert allocation == "in-stock-batch"
+
+
+def test_skips_exhausted_batches_until_their_quantity_is_raised():
+    earliest = model.Batch("speedy-batch", "WOBBLY-STOOL", 10, eta=today)
+    latest = model.Batch("slow-batch", "WOBBLY-STOOL", 100, eta=later)
+    product = model.Product(sku="WOBBLY-STOOL", batches=[latest, earliest])
+
+    assert product.allocate(model.OrderLine("order1", "WOBBLY-STOOL", 10)) == "speedy-batch"
+    assert product.allocate(model.OrderLine("order2", "WOBBLY-STOOL", 10)) == "slow-batch"
+
+    product.change_batch_quantity("speedy-batch", 20)
+    assert product.allocate(model.OrderLine("order3", "WOBBLY-STOOL", 10)) == "speedy-batch"
+
+
+def test_batches_appended_directly_are_still_considered():
+    product = model.Product(sku="BENDY-SPOON", batches=[])
+    product.allocate(model.OrderLine("order1", "BENDY-SPOON", 10))
+    product.batches.append(model.Batch("batch1", "BENDY-SPOON", 100, eta=None))
+
+    assert product.allocate(model.OrderLine("order2", "BENDY-SPOON", 10)) == "batch1"
+
+
+def test_records_batch_and_quantity_change_events_for_the_stock_view():
+    product = model.Product(sku="TALL-VASE", batches=[])
+    product.add_batch(model.Batch("batch1", "TALL-VASE", 20, eta=None))
+    product.allocate(model.OrderLine("order1", "TALL-VASE", 15))
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", 10)
+
+    assert list(product.events) == [
+        events.BatchQuantityChanged("batch1", "TALL-VASE", qty=10, previous_qty=20),
+        events.Deallocated("order1", "TALL-VASE", 15, "batch1"),
+        commands.Allocate("order1", "TALL-VASE", 15),
+    ]